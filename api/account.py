@@ -6,13 +6,13 @@ import hmac
 import hashlib
 import json
 from decimal import Decimal, ROUND_DOWN
-import aiohttp
 from dotenv import load_dotenv
 
 import code.settings as st
+from code.api.client import get_client
 from code.db.positions import PositionsOperations
 
-from code.db.users import UsersOperations
+from code.db.users import get_users_cache
 
 load_dotenv()
 
@@ -38,14 +38,14 @@ async def post_data(url, data, headers):
     """
     Makes asincio post request (used in post_bybit_signed)
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, data=data, headers=headers) as response:
-            return await response.json()
+    return await get_client().post_json(url, data=data, headers=headers)
 
 async def post_bybit_signed(url, API_KEY, SECRET_KEY, **kwargs):
     """
     Sends signed post requests with aiohttp
     """
+    # ждем бюджет лимита до подписи, чтобы не выйти за recv_window
+    await get_client().acquire(API_KEY, url)
     timestamp = int(time.time() * 1000)
     recv_wind = 5000
     data = json.dumps({key: str(value) for key, value in kwargs.items()})
@@ -64,9 +64,7 @@ async def post_bybit_signed(url, API_KEY, SECRET_KEY, **kwargs):
         headers)
 
 async def get_wallet_balance(telegram_id, demo=None, coin=None):
-    user_op = UsersOperations(DATABASE_URL)
-
-    settings = await user_op.get_user_data(telegram_id)
+    settings = await get_users_cache(DATABASE_URL).get_user_data(telegram_id)
 
 
     if demo:
@@ -83,6 +81,8 @@ async def get_wallet_balance(telegram_id, demo=None, coin=None):
     if not secret_key:
         return -1
 
+    # ждем бюджет лимита до подписи, чтобы не выйти за recv_window
+    await get_client().acquire(api_key, url)
     timestamp = str(int(time.time() * 1000))
     headers = {
         'X-BAPI-API-KEY': api_key,
@@ -95,18 +95,14 @@ async def get_wallet_balance(telegram_id, demo=None, coin=None):
     headers['X-BAPI-SIGN'] = gen_signature_get(params, timestamp, api_key, secret_key)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers, params=params) as response:
-                data = await response.json()
+        data = await get_client().get_json(url, params=params, headers=headers)
         return data.get('result').get('list')[0].get('totalWalletBalance')
     except:
         return -1
 
 
 async def find_usdt_budget(telegram_id, demo=False):
-    user_op = UsersOperations(DATABASE_URL)
-
-    settings = await user_op.get_user_data(telegram_id)
+    settings = await get_users_cache(DATABASE_URL).get_user_data(telegram_id)
     if demo:
         api_key = settings.get('demo_api_key')
         secret_key = settings.get('demo_secret_key')
@@ -121,6 +117,8 @@ async def find_usdt_budget(telegram_id, demo=False):
     if not secret_key:
         return -1
 
+    # ждем бюджет лимита до подписи, чтобы не выйти за recv_window
+    await get_client().acquire(api_key, url)
     timestamp = str(int(time.time() * 1000))
     headers = {
         'X-BAPI-API-KEY': api_key,
@@ -132,18 +130,14 @@ async def find_usdt_budget(telegram_id, demo=False):
     headers['X-BAPI-SIGN'] = gen_signature_get(params, timestamp, api_key, secret_key)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers, params=params) as response:
-                data = await response.json()
+        data = await get_client().get_json(url, params=params, headers=headers)
         return data.get('result').get('list')[0].get('coin')[0].get('walletBalance')
     except:
         return -1
 
 
 async def get_user_orders(telegram_id, url, category, openOnly=0, demo=None):
-    user_op = UsersOperations(DATABASE_URL)
-
-    settings = await user_op.get_user_data(telegram_id)
+    settings = await get_users_cache(DATABASE_URL).get_user_data(telegram_id)
 
     if demo:
         api_key = settings.get('demo_api_key')
@@ -164,6 +158,8 @@ async def get_user_orders(telegram_id, url, category, openOnly=0, demo=None):
         #print('no_secret')
         return []
 
+    # ждем бюджет лимита до подписи, чтобы не выйти за recv_window
+    await get_client().acquire(api_key, url)
     timestamp = str(int(time.time() * 1000))
     headers = {
         'X-BAPI-API-KEY': api_key,
@@ -181,9 +177,7 @@ async def get_user_orders(telegram_id, url, category, openOnly=0, demo=None):
     headers['X-BAPI-SIGN'] = gen_signature_get(params, timestamp, api_key, secret_key)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers, params=params) as response:
-                data = await response.json()
+        data = await get_client().get_json(url, params=params, headers=headers)
         return data.get('result').get('list')
 
     except Exception as e:
@@ -210,6 +204,8 @@ async def get_user_positions(settings, demo=None):
         #print('no_secret')
         return []
 
+    # ждем бюджет лимита до подписи, чтобы не выйти за recv_window
+    await get_client().acquire(api_key, url)
     timestamp = str(int(time.time() * 1000))
     headers = {
         'X-BAPI-API-KEY': api_key,
@@ -228,9 +224,7 @@ async def get_user_positions(settings, demo=None):
     headers['X-BAPI-SIGN'] = gen_signature_get(params, timestamp, api_key, secret_key)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers, params=params) as response:
-                data = await response.json()
+        data = await get_client().get_json(url, params=params, headers=headers)
         #print(data)
         if data.get('retMsg') == 'OK':
             return data.get('result').get('list')
@@ -246,9 +240,7 @@ async def get_user_positions(settings, demo=None):
 
 async def get_order_by_id(telegram_id, category, orderLinkId, demo=None):
 
-    user_op = UsersOperations(DATABASE_URL)
-
-    settings = await user_op.get_user_data(telegram_id)
+    settings = await get_users_cache(DATABASE_URL).get_user_data(telegram_id)
 
     if demo:
         api_key = settings.get('demo_api_key')
@@ -268,6 +260,8 @@ async def get_order_by_id(telegram_id, category, orderLinkId, demo=None):
         # print('no_secret')
         return -1
 
+    # ждем бюджет лимита до подписи, чтобы не выйти за recv_window
+    await get_client().acquire(api_key, url)
     timestamp = str(int(time.time() * 1000))
     headers = {
         'X-BAPI-API-KEY': api_key,
@@ -283,9 +277,7 @@ async def get_order_by_id(telegram_id, category, orderLinkId, demo=None):
     headers['X-BAPI-SIGN'] = gen_signature_get(params, timestamp, api_key, secret_key)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers, params=params) as response:
-                data = await response.json()
+        data = await get_client().get_json(url, params=params, headers=headers)
         row_data = data.get('result').get('list')[0]
         return [data.get('result').get('list')[0].get('orderStatus'), row_data]
 
@@ -295,8 +287,7 @@ async def get_order_by_id(telegram_id, category, orderLinkId, demo=None):
 
 
 async def cancel_order_by_id(telegram_id, category, symbol, orderId, demo=None):
-    user_op = UsersOperations(DATABASE_URL)
-    settings = await user_op.get_user_data(telegram_id)
+    settings = await get_users_cache(DATABASE_URL).get_user_data(telegram_id)
     if demo:
         api_key = settings.get('demo_api_key')
         secret_key = settings.get('demo_secret_key')
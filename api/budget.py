@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import code.settings as st
+from code.api.account import find_usdt_budget
+
+
+class BudgetService:
+    """
+    Keeps the USDT wallet balance of every user ready for order sizing.
+
+    A background loop refreshes all balances in one batch every refresh_interval
+    seconds, so a signal reads them from memory instead of asking the exchange.
+    Balances older than max_age are fetched again before use. invalidate() drops a
+    balance after a fill, set_balance() takes fresh values pushed by a stream.
+    """
+
+    def __init__(self, users_cache, refresh_interval=None, max_age=None, concurrency=None):
+        settings = st.BUDGET
+        self.users_cache = users_cache
+        self.refresh_interval = refresh_interval or settings['refresh_interval']
+        self.max_age = max_age or settings['max_age']
+        self.concurrency = concurrency or settings['concurrency']
+        # (telegram_id, demo) -> (balance, time.monotonic() of the fetch)
+        self._balances = {}
+        self._task = None
+        self._pending = set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    @staticmethod
+    def _accounts(users):
+        return [(row.telegram_id, row.trade_type == 'demo') for row in users[['telegram_id', 'trade_type']].itertuples()]
+
+    async def _fetch(self, accounts):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch_one(account):
+            telegram_id, demo = account
+            async with semaphore:
+                balance = await find_usdt_budget(telegram_id, demo=demo)
+            self._balances[account] = (balance, time.monotonic())
+
+        await asyncio.gather(*[fetch_one(account) for account in accounts])
+
+    async def refresh(self):
+        users = await self.users_cache.get_all_users_data()
+        if users is not None:
+            await self._fetch(self._accounts(users))
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print('Ошибка обновления бюджетов', e)
+            await asyncio.sleep(self.refresh_interval)
+
+    def set_balance(self, telegram_id, demo, balance):
+        self._balances[(telegram_id, bool(demo))] = (balance, time.monotonic())
+
+    def invalidate(self, telegram_id):
+        """
+        Drops the cached balance of a user (e.g. after a fill) and fetches it again in background.
+        """
+        for account in [key for key in self._balances if key[0] == telegram_id]:
+            self._balances.pop(account, None)
+            if account not in self._pending:
+                self._pending.add(account)
+                task = asyncio.create_task(self._fetch([account]))
+                task.add_done_callback(lambda _, account=account: self._pending.discard(account))
+
+    async def budget_map(self, users) -> dict:
+        """
+        Returns {telegram_id: balance} for the users frame. Missing and stale
+        balances are fetched right away, the rest come from memory.
+        """
+        self.start()
+        now = time.monotonic()
+        accounts = self._accounts(users)
+        stale = [account for account in accounts
+                 if account not in self._balances or now - self._balances[account][1] > self.max_age]
+        if stale:
+            await self._fetch(stale)
+        return {account[0]: self._balances[account][0] for account in accounts}
@@ -0,0 +1,123 @@
+import asyncio
+import os
+
+import aiohttp
+
+import code.settings as st
+from code.api.ratelimit import RateLimiter
+from code.db.engine import dispose_engines
+
+
+class ExchangeClient:
+    """
+    Long-lived aiohttp session shared by every exchange call of the process.
+
+    Keeps TCP+TLS connections alive between requests instead of opening a new
+    session per call. Signed calls wait on the rate limiter before signing and
+    feed the limit headers of the response back into it.
+    The session and limiter are bound to the running event loop, so they are
+    recreated when a process restarts its loop with a new asyncio.run().
+    """
+
+    def __init__(self, timeout=None, connect_timeout=None, limit=None,
+                 limit_per_host=None, dns_ttl=None, keepalive_timeout=None):
+        settings = st.HTTP_CLIENT
+        self.timeout = timeout or settings['timeout']
+        self.connect_timeout = connect_timeout or settings['connect_timeout']
+        self.limit = limit or settings['limit']
+        self.limit_per_host = limit_per_host or settings['limit_per_host']
+        self.dns_ttl = dns_ttl or settings['dns_ttl']
+        self.keepalive_timeout = keepalive_timeout or settings['keepalive_timeout']
+        self._session = None
+        self._limiter = None
+        self._loop = None
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # новый event loop (перезапуск asyncio.run) - старые сессия и лимитер к нему не привязаны
+            self._session = None
+            self._limiter = RateLimiter()
+            self._loop = loop
+
+    @property
+    def limiter(self) -> RateLimiter:
+        self._bind_loop()
+        return self._limiter
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        self._bind_loop()
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout, sock_connect=self.connect_timeout),
+            )
+        return self._session
+
+    async def acquire(self, api_key, url):
+        """
+        Waits for rate limit budget, call right before signing a request.
+        """
+        await self.limiter.acquire(api_key, url)
+
+    def _track_limits(self, url, headers, response):
+        api_key = (headers or {}).get('X-BAPI-API-KEY')
+        if api_key:
+            self.limiter.update(api_key, url, response.headers)
+
+    async def get_json(self, url, params=None, headers=None):
+        async with self.session.get(url, params=params, headers=headers) as response:
+            self._track_limits(url, headers, response)
+            return await response.json()
+
+    async def post_json(self, url, data=None, headers=None):
+        async with self.session.post(url, data=data, headers=headers) as response:
+            self._track_limits(url, headers, response)
+            return await response.json()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._limiter = None
+        self._loop = None
+
+
+_client = None
+_client_pid = None
+
+
+def get_client() -> ExchangeClient:
+    """
+    Returns the exchange client of the current process.
+    """
+    global _client, _client_pid
+    # после fork клиент родителя не используем
+    if _client is None or _client_pid != os.getpid():
+        _client = ExchangeClient()
+        _client_pid = os.getpid()
+    return _client
+
+
+async def close_client():
+    if _client is not None and _client_pid == os.getpid():
+        await _client.close()
+
+
+async def run_with_client(coro):
+    """
+    Runs a process coroutine and closes the exchange client and the
+    database pool of the process when it stops.
+    """
+    try:
+        return await coro
+    finally:
+        await close_client()
+        await dispose_engines()
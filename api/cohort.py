@@ -0,0 +1,90 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class CohortSelector:
+    """
+    Picks the users that can trade a signal with column masks instead of a per-user loop.
+
+    Everything that depends only on the users frame (spot/linear split, stop_trading,
+    trading_pairs modes) is computed once in __init__, so a selector is built once per
+    signal batch and select() is called for every signal of the batch.
+    """
+
+    def __init__(self, users: pd.DataFrame, new_pairs):
+        self.users = users.reset_index(drop=True)
+        self.new_pairs = set(new_pairs or [])
+
+        users = self.users
+        self.telegram_ids = users['telegram_id'].to_numpy()
+        self.spot = (users['spot'] == True).to_numpy()
+        self.stop_trading = users['stop_trading'].fillna(False).astype(bool).to_numpy()
+        self.subscription = pd.to_numeric(users['subscription'], errors='coerce').to_numpy(dtype=float)
+
+        pairs = users['trading_pairs'].map(lambda value: value if isinstance(value, (list, tuple)) else [])
+        self.has_pairs = (pairs.map(len) > 0).to_numpy()
+        self.new_mode = pairs.map(lambda value: '-1' in value).to_numpy()
+
+        # symbol -> позиции юзеров, у которых символ явно в списке
+        exploded = pairs.explode().dropna()
+        self.pair_rows = {symbol: rows.to_numpy()
+                          for symbol, rows in pd.Series(exploded.index, index=exploded.values).groupby(level=0)}
+
+        demo = (users['trade_type'] == 'demo').to_numpy()
+        self.api_key = np.where(demo, users['demo_api_key'], users['main_api_key'])
+        self.secret_key = np.where(demo, users['demo_secret_key'], users['main_secret_key'])
+        self.trade_pair_if = pd.to_numeric(users['trade_pair_if'], errors='coerce').to_numpy(dtype=float)
+        self.min_trade = pd.to_numeric(users['min_trade'], errors='coerce').to_numpy(dtype=float)
+
+    def pairs_mask(self, symbol):
+        """
+        Pair allowed: no list, or symbol listed (without new-pair mode),
+        or new-pair mode ('-1' in list) and symbol is a new pair.
+        """
+        listed = np.zeros(len(self.users), dtype=bool)
+        rows = self.pair_rows.get(symbol)
+        if rows is not None:
+            listed[rows] = True
+        is_new = symbol in self.new_pairs
+        return ~self.has_pairs | (listed & ~self.new_mode) | (self.new_mode & is_new)
+
+    def open_mask(self, open_owners):
+        """
+        True for users that already have an unfinished position in the symbol.
+        open_owners - their telegram ids (OpenPositionsIndex.owners(symbol)).
+        """
+        if not open_owners:
+            return np.zeros(len(self.users), dtype=bool)
+        return np.isin(self.telegram_ids, list(open_owners))
+
+    def select(self, symbol, market, open_owners, budget_map, now=None) -> pd.DataFrame:
+        """
+        Returns the cohort for symbol on market ('spot' or 'linear') with sizing inputs:
+        telegram_id, trade_type, api_key, secret_key, trade_pair_if, min_trade, budget and
+        sum_amount = min(min_trade, budget).
+        """
+        now = int(time.time()) if now is None else now
+        mask = self.spot if market == 'spot' else ~self.spot
+        # подписка истекла - пропускаем (NaN не отсекаем, как и раньше)
+        mask = mask & ~(now > self.subscription)
+        mask &= ~self.stop_trading
+        mask &= self.pairs_mask(symbol)
+        mask &= ~self.open_mask(open_owners)
+
+        budget = pd.to_numeric(pd.Series(self.telegram_ids).map(budget_map), errors='coerce').to_numpy(dtype=float)
+        # без известного бюджета ордер не рассчитать
+        mask &= ~np.isnan(budget)
+
+        cohort = pd.DataFrame({
+            'telegram_id': self.telegram_ids[mask],
+            'trade_type': self.users['trade_type'].to_numpy()[mask],
+            'api_key': self.api_key[mask],
+            'secret_key': self.secret_key[mask],
+            'trade_pair_if': self.trade_pair_if[mask],
+            'min_trade': self.min_trade[mask],
+            'budget': budget[mask],
+        })
+        cohort['sum_amount'] = np.minimum(cohort['min_trade'].to_numpy(), cohort['budget'].to_numpy())
+        return cohort
@@ -1,72 +1,96 @@
 import asyncio
+import json
+from multiprocessing import shared_memory
+
 import aiohttp
+import numpy as np
 
 import code.settings as st
+from code.api.client import get_client
 # export PYTHONPATH="${PYTHONPATH}:$(pwd)"
 
 
-async def get_settings(category):
+async def get_settings(category, cursor=None, limit=None):
     """
-    Returns all trading pairs and their settings.
+    Returns one page of trading pairs and their settings.
     """
     url = st.mainnet_url + st.ENDPOINTS.get('get_instruments_info')
 
     params = {
         'category': category,
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
-            return await response.json()
+    if cursor:
+        params['cursor'] = cursor
+    if limit:
+        params['limit'] = limit
+    return await get_client().get_json(url, params=params)
 
 
-async def process_spot_linear_settings():
+def normalize_spot(element):
+    return {
+        'name': element.get('symbol'),
+        'short_name': element.get('symbol')[:-4],
+        'base_precision': element.get('lotSizeFilter').get('basePrecision'),
+        'quote_precision': element.get('lotSizeFilter').get('quotePrecision'),
+        'min_order_qty': element.get('lotSizeFilter').get('minOrderQty'),
+        'max_order_qty': element.get('lotSizeFilter').get('maxOrderQty'),
+        'tick_size': element.get('priceFilter').get('tickSize')
+    }
 
-    # returns tuple of two spot + linear
 
-    tasks = [
-        asyncio.create_task(get_settings('spot')),
-        asyncio.create_task(get_settings('linear'))
-    ]
+def normalize_linear(element):
+    return {
+        'name': element.get('symbol'),
+        'short_name': element.get('symbol')[:-4],
+        'min_leverage': element.get('leverageFilter').get('minLeverage'),
+        'max_leverage': element.get('leverageFilter').get('maxLeverage'),
+        'leverage_step': element.get('leverageFilter').get('leverageStep'),
+        'unified_margin_trade': element.get('unifiedMarginTrade'),
+        'min_price': element.get('priceFilter').get('minPrice'),
+        'max_price': element.get('priceFilter').get('maxPrice'),
+        'price_tick_size': element.get('priceFilter').get('tickSize'),
+        'max_order_qty': element.get('lotSizeFilter').get('maxOrderQty'),
+        'min_order_qty': element.get('lotSizeFilter').get('minOrderQty'),
+        'qty_step': element.get('lotSizeFilter').get('qtyStep')
+    }
 
-    results = await asyncio.gather(*tasks)
-   # print(results[0].get('result').get('list')[0])
-
-    # Process spot symbols
-    spot_symbols = [
-        {
-            'name': element.get('symbol'),
-            'short_name': element.get('symbol')[:-4],
-            'base_precision': element.get('lotSizeFilter').get('basePrecision'),
-            'quote_precision': element.get('lotSizeFilter').get('quotePrecision'),
-            'min_order_qty': element.get('lotSizeFilter').get('minOrderQty'),
-            'max_order_qty': element.get('lotSizeFilter').get('maxOrderQty'),
-            'tick_size': element.get('priceFilter').get('tickSize')
-        }
-        for element in results[0].get('result').get('list')
-        if element.get('status') == 'Trading' and element.get('quoteCoin') == 'USDT'
-    ]
 
-    # Process linear symbols
-    linear_symbols = [
-        {
-            'name': element.get('symbol'),
-            'short_name': element.get('symbol')[:-4],
-            'min_leverage': element.get('leverageFilter').get('minLeverage'),
-            'max_leverage': element.get('leverageFilter').get('maxLeverage'),
-            'leverage_step': element.get('leverageFilter').get('leverageStep'),
-            'unified_margin_trade': element.get('unifiedMarginTrade'),
-            'min_price': element.get('priceFilter').get('minPrice'),
-            'max_price': element.get('priceFilter').get('maxPrice'),
-            'price_tick_size': element.get('priceFilter').get('tickSize'),
-            'max_order_qty': element.get('lotSizeFilter').get('maxOrderQty'),
-            'min_order_qty': element.get('lotSizeFilter').get('minOrderQty'),
-            'qty_step': element.get('lotSizeFilter').get('qtyStep')
-        }
-        for element in results[1].get('result').get('list')
-        if element.get('contractType') == 'LinearPerpetual' and element.get('status') == 'Trading' and element.get('quoteCoin') == 'USDT'
-    ]
+def is_traded(category, element) -> bool:
+    # торгуем только USDT пары, на фьючах только бессрочные
+    if element.get('status') != 'Trading' or element.get('quoteCoin') != 'USDT':
+        return False
+    return category == 'spot' or element.get('contractType') == 'LinearPerpetual'
+
+
+async def iter_settings(category, limit=1000):
+    """
+    Yields the traded pairs of category page by page, normalized like the
+    spot_pairs/linear_pairs rows, following nextPageCursor.
+    """
+    normalize = normalize_spot if category == 'spot' else normalize_linear
+    cursor = None
+    while True:
+        response = await get_settings(category, cursor, limit)
+        if not isinstance(response, dict) or response.get('retCode') != 0:
+            message = response.get('retMsg') if isinstance(response, dict) else response
+            raise RuntimeError(f'instruments-info {category}: {message}')
+        result = response.get('result')
+        if not isinstance(result, dict) or not isinstance(result.get('list'), list):
+            raise RuntimeError(f'instruments-info {category}: malformed response')
+        yield [normalize(element) for element in result['list'] if is_traded(category, element)]
+        cursor = result.get('nextPageCursor')
+        if not cursor:
+            return
+
+
+async def process_spot_linear_settings():
+
+    # returns tuple of two spot + linear
 
-    return spot_symbols, linear_symbols
+    async def collect(category):
+        return [pair async for page in iter_settings(category) for pair in page]
+
+    return tuple(await asyncio.gather(collect('spot'), collect('linear')))
 
 
 async def get_tickers(category):
@@ -79,9 +103,7 @@ async def get_tickers(category):
     params = {
         'category': category,
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
-            return await response.json()
+    return await get_client().get_json(url, params=params)
 
 
 async def get_prices():
@@ -100,6 +122,269 @@ async def get_prices():
 
     return spot, linear
 
+
+# ####### TICKER STREAM ########
+#          ############
+#             #####
+
+class PriceView:
+    """
+    Dict-like read access to one category of a SharedPriceBook.
+    """
+
+    def __init__(self, book, category):
+        self.book = book
+        self.category = category
+
+    def get(self, symbol, default=None):
+        price = self.book.get(self.category, symbol)
+        return default if price is None else price
+
+
+class SharedPriceBook:
+    """
+    Price book in shared memory, readable from every process without locks or copies.
+
+    Layout of the segment:
+        header  int64[4]              seq counter, spot count, linear count, reserved
+        names   S20[2, capacity]      symbol of every slot, per category
+        prices  float64[2, capacity]  last price of every slot, per category
+        stamps  int64[2, capacity]    seq of the last update of every slot, per category
+
+    There must be a single writer (the update_prices process). Slots are only
+    appended, the symbol is written before the count is raised, so readers can
+    refresh their local symbol -> slot index from the counts at any moment.
+    """
+
+    categories = {'spot': 0, 'linear': 1}
+    name_size = 20
+    header_size = 4
+
+    def __init__(self, name=None, capacity=4096):
+        self.capacity = capacity
+        names_bytes = 2 * capacity * self.name_size
+        names_bytes += -names_bytes % 8  # float64 prices must stay aligned
+        size = self.header_size * 8 + names_bytes + 2 * 2 * capacity * 8
+
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+
+        buf = self._shm.buf
+        self._header = np.ndarray((self.header_size,), dtype=np.int64, buffer=buf)
+        self._names = np.ndarray((2, capacity), dtype=f'S{self.name_size}', buffer=buf,
+                                 offset=self.header_size * 8)
+        self._prices = np.ndarray((2, capacity), dtype=np.float64, buffer=buf,
+                                  offset=self.header_size * 8 + names_bytes)
+        self._stamps = np.ndarray((2, capacity), dtype=np.int64, buffer=buf,
+                                  offset=self.header_size * 8 + names_bytes + 2 * capacity * 8)
+        if self._owner:
+            self._header[:] = 0
+            self._prices[:] = 0.0
+            self._stamps[:] = 0
+
+        self._index = ({}, {})  # local symbol -> slot cache, per category
+
+    def __reduce__(self):
+        # в дочерние процессы передаем только имя сегмента
+        return self.__class__, (self.name, self.capacity)
+
+    @property
+    def seq(self):
+        """
+        Grows by one on every price update.
+        """
+        return int(self._header[0])
+
+    def _refresh_index(self, c):
+        index = self._index[c]
+        count = int(self._header[1 + c])
+        for slot in range(len(index), count):
+            index[self._names[c, slot].decode()] = slot
+
+    def _slot(self, c, symbol):
+        slot = self._index[c].get(symbol)
+        if slot is None and self._header[1 + c] > len(self._index[c]):
+            self._refresh_index(c)
+            slot = self._index[c].get(symbol)
+        return slot
+
+    def update(self, category, symbol, price):
+        c = self.categories[category]
+        slot = self._slot(c, symbol)
+        if slot is None:
+            slot = int(self._header[1 + c])
+            if slot >= self.capacity:
+                return
+            self._names[c, slot] = symbol.encode()
+            self._prices[c, slot] = float(price)
+            self._header[1 + c] = slot + 1
+            self._index[c][symbol] = slot
+        else:
+            self._prices[c, slot] = float(price)
+        seq = self._header[0] + 1
+        self._stamps[c, slot] = seq
+        self._header[0] = seq
+
+    def get(self, category, symbol):
+        c = self.categories[category]
+        slot = self._slot(c, symbol)
+        if slot is None:
+            return None
+        price = float(self._prices[c, slot])
+        return price if price > 0 else None
+
+    def updates(self, category, since):
+        """
+        Returns (seq, {symbol: price}) of the slots updated after seq since.
+        Pass the returned seq as since of the next call.
+        """
+        c = self.categories[category]
+        seq = self.seq
+        count = int(self._header[1 + c])
+        slots = np.flatnonzero(self._stamps[c, :count] > since)
+        prices = self._prices[c, slots]
+        return seq, {self._names[c, slot].decode(): float(price)
+                     for slot, price in zip(slots, prices) if price > 0}
+
+    def symbols(self, category):
+        c = self.categories[category]
+        self._refresh_index(c)
+        return list(self._index[c])
+
+    def views(self):
+        """
+        Returns live views in the get_prices() structure ({spot}, {linear})
+        """
+        return PriceView(self, 'spot'), PriceView(self, 'linear')
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class TickerStream:
+    """
+    Keeps a price book current from the public tickers WebSocket.
+
+    One connection per category. On start and after every reconnect the book is
+    re-seeded from REST tickers, so prices missed while disconnected are not lost.
+    The same resync runs every resync_interval seconds to pick up new listings.
+    """
+
+    # bybit accepts up to 10 args per subscribe request on spot
+    subscribe_chunk = 10
+    ping_interval = 20
+
+    def __init__(self, price_book, stale_timeout=30, resync_interval=600, max_backoff=30):
+        self.price_book = price_book
+        self.stale_timeout = stale_timeout
+        self.resync_interval = resync_interval
+        self.max_backoff = max_backoff
+        self._subscribed = {'spot': set(), 'linear': set()}
+        self._ws = {}
+
+    async def run(self):
+        await self.resync()
+        await asyncio.gather(
+            self._run_category('spot'),
+            self._run_category('linear'),
+            self._resync_loop(),
+        )
+
+    async def resync(self, category=None):
+        """
+        Seeds the book from REST and subscribes to symbols not streamed yet.
+        """
+        spot, linear = await get_prices()
+        fresh = {'spot': spot, 'linear': linear}
+        for cat in ([category] if category else ['spot', 'linear']):
+            for symbol, price in fresh[cat].items():
+                if symbol.endswith('USDT'):
+                    self.price_book.update(cat, symbol, price)
+
+            ws = self._ws.get(cat)
+            if ws is not None and not ws.closed:
+                await self._subscribe(ws, cat)
+
+    async def _resync_loop(self):
+        while True:
+            await asyncio.sleep(self.resync_interval)
+            try:
+                await self.resync()
+            except Exception as e:
+                print('Ошибка периодической синхронизации цен', e)
+
+    async def _subscribe(self, ws, category):
+        new_symbols = [symbol for symbol in self.price_book.symbols(category)
+                       if symbol not in self._subscribed[category]]
+        for i in range(0, len(new_symbols), self.subscribe_chunk):
+            chunk = new_symbols[i:i + self.subscribe_chunk]
+            await ws.send_json({'op': 'subscribe', 'args': [f'tickers.{symbol}' for symbol in chunk]})
+            self._subscribed[category].update(chunk)
+
+    async def _ping(self, ws):
+        while not ws.closed:
+            await asyncio.sleep(self.ping_interval)
+            await ws.send_json({'op': 'ping'})
+
+    async def _run_category(self, category):
+        backoff = 1
+        while True:
+            try:
+                # отдельная сессия: соединение и так живет долго, а общий таймаут
+                # клиента на запрос не должен обрывать поток
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(st.public_ws_urls[category]) as ws:
+                        self._ws[category] = ws
+                        # новое соединение - подписки нужно отправить заново
+                        self._subscribed[category] = set()
+                        await self._subscribe(ws, category)
+                        backoff = 1
+                        ping_task = asyncio.create_task(self._ping(ws))
+                        try:
+                            await self._listen(ws, category)
+                        finally:
+                            ping_task.cancel()
+            except Exception as e:
+                print(f'Ticker stream {category} disconnected:', e)
+
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+            # закрываем разрыв в данных снапшотом из REST
+            try:
+                await self.resync(category)
+            except Exception as e:
+                print('Ошибка синхронизации цен после переподключения', e)
+
+    async def _listen(self, ws, category):
+        while True:
+            # если биржа молчит дольше stale_timeout - считаем соединение мертвым
+            msg = await ws.receive(timeout=self.stale_timeout)
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                return
+
+            message = json.loads(msg.data)
+            data = message.get('data')
+            if not data:
+                if message.get('op') == 'subscribe' and not message.get('success'):
+                    print(f'Ticker stream {category} subscribe failed:', message.get('ret_msg'))
+                continue
+
+            # linear присылает delta без lastPrice, если цена не менялась
+            price = data.get('lastPrice')
+            if price:
+                self.price_book.update(category, data['symbol'], price)
+
+#               #####
+#            ############
+# ####### STOP TICKER STREAM ########
+
+
 async def get_announcements():
 
     url = st.mainnet_url + st.ENDPOINTS.get('announcements')
@@ -107,18 +392,16 @@ async def get_announcements():
         'locale': "en-US",
         'type': 'new_crypto',
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
-            res = (await response.json()).get('result').get('list')
-
-        new_coins = []
-        for element in res:
-            an = element['title'].split()
-            usdt_word = next((word for word in an if word.endswith('USDT')), None)
-            if usdt_word is not None:
-                new_coins.append(usdt_word)
-
-        return new_coins
+    res = (await get_client().get_json(url, params=params)).get('result').get('list')
+
+    new_coins = []
+    for element in res:
+        an = element['title'].split()
+        usdt_word = next((word for word in an if word.endswith('USDT')), None)
+        if usdt_word is not None:
+            new_coins.append(usdt_word)
+
+    return new_coins
 
 
 if __name__ == '__main__':
@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+
+import aiohttp
+
+import code.settings as st
+
+
+def auth_message(api_key, secret_key, expires_in=10):
+    """
+    Returns the auth request of a private stream, signed over 'GET/realtime{expires}'.
+    """
+    expires = int((time.time() + expires_in) * 1000)
+    signature = hmac.new(secret_key.encode('utf-8'), f'GET/realtime{expires}'.encode('utf-8'),
+                         hashlib.sha256).hexdigest()
+    return {'op': 'auth', 'args': [api_key, expires, signature]}
+
+
+class PrivateStream:
+    """
+    One authenticated private WebSocket of one API key.
+
+    Filled orders are written into positions as they arrive, wallet updates go to
+    the budget service. live is True only while the connection is authenticated
+    and subscribed.
+    """
+
+    topics = ['order', 'execution', 'position', 'wallet']
+    ping_interval = 20
+    retry_interval = 1
+    # исполнение без строки позиции ждет ее столько секунд, потом сверку подхватывает REST
+    unmatched_ttl = 120
+
+    def __init__(self, telegram_id, demo, api_key, secret_key, positions_op, budgets=None,
+                 stale_timeout=60, max_backoff=60):
+        self.telegram_id = telegram_id
+        self.demo = demo
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.positions_op = positions_op
+        self.budgets = budgets
+        self.stale_timeout = stale_timeout
+        self.max_backoff = max_backoff
+        self.url = st.private_ws_urls['demo' if demo else 'main']
+        self.live = False
+        # после каждого подключения сверяемся через REST, пока сверка не пройдет успешно:
+        # за разрыв могли пропустить исполнения
+        self.catch_up = True
+        self.connected_at = 0.0  # time.monotonic() последнего подключения
+        # исполнения, пришедшие раньше записи позиции: orderLinkId -> (fill, time.monotonic())
+        self._unmatched = {}
+
+    async def run(self):
+        retry_task = asyncio.create_task(self._retry_unmatched())
+        try:
+            await self._connect_loop()
+        finally:
+            retry_task.cancel()
+
+    async def _connect_loop(self):
+        backoff = 1
+        while True:
+            try:
+                # отдельная сессия, как и у публичного потока тикеров
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(self.url) as ws:
+                        await self._start(ws)
+                        backoff = 1
+                        ping_task = asyncio.create_task(self._ping(ws))
+                        try:
+                            await self._listen(ws)
+                        finally:
+                            ping_task.cancel()
+            except asyncio.CancelledError:
+                self.live = False
+                raise
+            except Exception as e:
+                print(f'Private stream {self.telegram_id} disconnected:', e)
+
+            self.live = False
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def _request(self, ws, message):
+        await ws.send_json(message)
+        while True:
+            msg = await ws.receive(timeout=self.stale_timeout)
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                raise ConnectionError(f'stream closed during {message["op"]}')
+            response = json.loads(msg.data)
+            if response.get('op') == message['op']:
+                if not response.get('success'):
+                    raise ConnectionError(f'{message["op"]} failed: {response.get("ret_msg")}')
+                return
+
+    async def _start(self, ws):
+        await self._request(ws, auth_message(self.api_key, self.secret_key))
+        await self._request(ws, {'op': 'subscribe', 'args': self.topics})
+        self.catch_up = True
+        self.connected_at = time.monotonic()
+        self.live = True
+
+    async def _ping(self, ws):
+        while not ws.closed:
+            await asyncio.sleep(self.ping_interval)
+            await ws.send_json({'op': 'ping'})
+
+    async def _listen(self, ws):
+        while True:
+            msg = await ws.receive(timeout=self.stale_timeout)
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                return
+
+            message = json.loads(msg.data)
+            topic = message.get('topic')
+            if topic == 'order':
+                await self._on_orders(message.get('data') or [])
+            elif topic == 'wallet':
+                self._on_wallet(message.get('data') or [])
+
+    async def _on_orders(self, orders):
+        for order in orders:
+            order_link_id = order.get('orderLinkId')
+            if order.get('orderStatus') != 'Filled' or not order_link_id:
+                continue
+            fill = {
+                'avgPrice': order.get('avgPrice'),
+                'cumExecValue': order.get('cumExecValue'),
+                'cumExecQty': order.get('cumExecQty'),
+                'cumExecFee': order.get('cumExecFee'),
+            }
+            try:
+                if await self.positions_op.mark_filled(order_link_id, fill):
+                    print('Исполнен ордер', order_link_id, fill)
+                else:
+                    # рыночный ордер исполняется раньше, чем его позиция записана после ответа REST
+                    self._unmatched[order_link_id] = (fill, time.monotonic())
+            except Exception as e:
+                print('Ошибка записи исполнения ордера', order_link_id, e)
+                self._unmatched[order_link_id] = (fill, time.monotonic())
+
+    async def _retry_unmatched(self):
+        """
+        Applies buffered fills once their positions are written. A fill still
+        unmatched after unmatched_ttl seconds is dropped and a REST catch-up is
+        requested, so it is reconciled by polling instead of being lost.
+        """
+        while True:
+            await asyncio.sleep(self.retry_interval)
+            for order_link_id, (fill, received) in list(self._unmatched.items()):
+                try:
+                    if await self.positions_op.mark_filled(order_link_id, fill):
+                        print('Исполнен ордер', order_link_id, fill)
+                        del self._unmatched[order_link_id]
+                        continue
+                except Exception as e:
+                    print('Ошибка записи исполнения ордера', order_link_id, e)
+                if time.monotonic() - received > self.unmatched_ttl:
+                    del self._unmatched[order_link_id]
+                    self.catch_up = True
+
+    def _on_wallet(self, wallets):
+        if self.budgets is None:
+            return
+        for wallet in wallets:
+            for coin in wallet.get('coin', []):
+                if coin.get('coin') == 'USDT':
+                    self.budgets.set_balance(self.telegram_id, self.demo, coin.get('walletBalance'))
+
+
+class PrivateStreamManager:
+    """
+    Keeps one private stream per API key of every user, following the users table.
+
+    Streams are started for new keys and stopped for removed ones on every sync().
+    should_poll() tells the REST reconciliation which accounts still need polling.
+    """
+
+    def __init__(self, users_cache, positions_op, budgets=None, sync_interval=60):
+        self.users_cache = users_cache
+        self.positions_op = positions_op
+        self.budgets = budgets
+        self.sync_interval = sync_interval
+        self._streams = {}  # api_key -> PrivateStream
+        self._tasks = {}  # api_key -> task
+        self._accounts = {}  # (telegram_id, demo) -> api_key
+
+    async def run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                print('Ошибка синхронизации приватных потоков', e)
+            await asyncio.sleep(self.sync_interval)
+
+    async def sync(self):
+        users = await self.users_cache.get_all_users_data()
+        wanted = {}
+        if users is not None:
+            for user in users.itertuples(index=False):
+                demo = user.trade_type == 'demo'
+                api_key = user.demo_api_key if demo else user.main_api_key
+                secret_key = user.demo_secret_key if demo else user.main_secret_key
+                if api_key and secret_key:
+                    wanted[api_key] = (user.telegram_id, demo, secret_key)
+
+        for api_key in list(self._streams):
+            stream = self._streams[api_key]
+            if api_key not in wanted or wanted[api_key] != (stream.telegram_id, stream.demo, stream.secret_key):
+                self._tasks.pop(api_key).cancel()
+                del self._streams[api_key]
+
+        for api_key, (telegram_id, demo, secret_key) in wanted.items():
+            if api_key not in self._streams:
+                stream = PrivateStream(telegram_id, demo, api_key, secret_key, self.positions_op, self.budgets)
+                self._streams[api_key] = stream
+                self._tasks[api_key] = asyncio.create_task(stream.run())
+
+        self._accounts = {(stream.telegram_id, stream.demo): api_key for api_key, stream in self._streams.items()}
+
+    def should_poll(self, telegram_id, demo) -> bool:
+        """
+        False while the account's stream is live and has been reconciled after
+        connecting, True otherwise (no stream, reconnecting, or catch-up due).
+        """
+        stream = self._streams.get(self._accounts.get((telegram_id, bool(demo))))
+        return stream is None or not stream.live or stream.catch_up
+
+    def mark_caught_up(self, telegram_id, demo, polled_at):
+        """
+        Records a successful catch-up poll of an account, started at
+        time.monotonic() polled_at. A stream that reconnected after that still
+        needs its own catch-up, the poll may have missed its gap.
+        """
+        stream = self._streams.get(self._accounts.get((telegram_id, bool(demo))))
+        if stream is not None and stream.live and stream.connected_at <= polled_at:
+            stream.catch_up = False
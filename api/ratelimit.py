@@ -0,0 +1,125 @@
+import asyncio
+import heapq
+import itertools
+import time
+from urllib.parse import urlsplit
+
+import code.settings as st
+
+
+# размещение/изменение ордеров обслуживаем раньше служебных запросов
+ORDER_PATHS = {
+    st.ENDPOINTS.get('place_order'),
+    st.ENDPOINTS.get('cancel_order'),
+    st.ENDPOINTS.get('amend_order'),
+    st.ENDPOINTS.get('linear_tp'),
+}
+PRIORITY_ORDER = 0
+PRIORITY_HOUSEKEEPING = 1
+
+
+def endpoint_priority(path):
+    return PRIORITY_ORDER if path in ORDER_PATHS else PRIORITY_HOUSEKEEPING
+
+
+class _Bucket:
+    """
+    Request budget of one window: limit requests per window seconds.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        self.reset_at = time.time() + window
+        self.waiters = []  # heap of (priority, ticket)
+        self.changed = asyncio.Event()
+
+    def refill(self, now):
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.window
+
+    def notify(self):
+        # будим всех ожидающих, новые будут ждать уже следующее событие
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class RateLimiter:
+    """
+    Schedules signed requests against bybit rate limits.
+
+    Budgets are tracked per (api key, endpoint) and for the whole IP. Unknown
+    buckets start from default_limit per second and are corrected from the
+    X-Bapi-Limit-* headers of every response. Queued requests are released as
+    soon as the budget allows, order placement ahead of housekeeping calls.
+    """
+
+    def __init__(self, default_limit=10, window=1.0, ip_limit=600, ip_window=5.0):
+        self.default_limit = default_limit
+        self.window = window
+        self._buckets = {}
+        self._ip_bucket = _Bucket(ip_limit, ip_window)
+        self._tickets = itertools.count()
+
+    def _bucket(self, api_key, path):
+        bucket = self._buckets.get((api_key, path))
+        if bucket is None:
+            bucket = self._buckets[(api_key, path)] = _Bucket(self.default_limit, self.window)
+        return bucket
+
+    async def acquire(self, api_key, url, priority=None):
+        """
+        Waits until a request with api_key to url fits into the budget.
+        """
+        path = urlsplit(url).path
+        if priority is None:
+            priority = endpoint_priority(path)
+        await self._take(self._bucket(api_key, path), priority)
+        await self._take(self._ip_bucket, priority)
+
+    async def _take(self, bucket, priority):
+        ticket = (priority, next(self._tickets))
+        heapq.heappush(bucket.waiters, ticket)
+        try:
+            while True:
+                now = time.time()
+                bucket.refill(now)
+                if bucket.waiters[0] == ticket and bucket.remaining > 0:
+                    heapq.heappop(bucket.waiters)
+                    bucket.remaining -= 1
+                    bucket.notify()
+                    return
+                try:
+                    await asyncio.wait_for(bucket.changed.wait(), timeout=max(bucket.reset_at - now, 0.001))
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if ticket in bucket.waiters:
+                bucket.waiters.remove(ticket)
+                heapq.heapify(bucket.waiters)
+                bucket.notify()
+            raise
+
+    def update(self, api_key, url, headers):
+        """
+        Applies X-Bapi-Limit-* response headers to the bucket of the request.
+        """
+        try:
+            limit = int(headers['X-Bapi-Limit'])
+            remaining = int(headers['X-Bapi-Limit-Status'])
+            reset_at = int(headers['X-Bapi-Limit-Reset-Timestamp']) / 1000
+        except (KeyError, ValueError):
+            return
+
+        bucket = self._bucket(api_key, urlsplit(url).path)
+        bucket.limit = limit
+        if reset_at > bucket.reset_at:
+            # биржа уже открыла новое окно
+            bucket.remaining = remaining
+            bucket.reset_at = reset_at
+        else:
+            # ответы на запросы в полете могут прийти с устаревшим остатком
+            bucket.remaining = min(bucket.remaining, remaining)
+        bucket.notify()
@@ -0,0 +1,76 @@
+import asyncio
+
+import code.settings as st
+from code.api.account import get_user_orders
+
+
+async def gather_limited(coros, concurrency=None, return_exceptions=False):
+    """
+    asyncio.gather with at most concurrency coroutines running at once.
+    Signed calls inside still wait on the per-key rate limiter of the client.
+    """
+    semaphore = asyncio.Semaphore(concurrency or st.RECONCILE['concurrency'])
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*[run(coro) for coro in coros], return_exceptions=return_exceptions)
+
+
+async def collect_filled_orders(accounts, concurrency=None):
+    """
+    Fetches spot and linear orders of every account concurrently.
+
+    accounts - list of (telegram_id, url, openOnly, demo), the arguments of get_user_orders.
+    Returns (fills, polled): one map orderLinkId -> fill fields for every Filled
+    order, and the set of (telegram_id, demo) whose orders were all fetched.
+    """
+    keys = [(telegram_id, bool(demo)) for telegram_id, url, open_only, demo in accounts
+            for category in ('spot', 'linear')]
+    coros = [get_user_orders(telegram_id, url, category, open_only, demo=demo)
+             for telegram_id, url, open_only, demo in accounts
+             for category in ('spot', 'linear')]
+    results = await gather_limited(coros, concurrency, return_exceptions=True)
+
+    fills = {}
+    failed = set()
+    for key, orders in zip(keys, results):
+        if not isinstance(orders, list):
+            failed.add(key)
+            if isinstance(orders, Exception):
+                print('Ошибка получения ордеров при сверке', orders)
+            continue
+        for order in orders:
+            if order.get('orderStatus') == 'Filled':
+                fills[order['orderLinkId']] = {
+                    'avgPrice': order['avgPrice'],
+                    'cumExecValue': order['cumExecValue'],
+                    'cumExecQty': order['cumExecQty'],
+                    'cumExecFee': order['cumExecFee'],
+                }
+    return fills, set(keys) - failed
+
+
+async def gather_keyed(items, key, process, concurrency=None):
+    """
+    Runs process(item) for every item: items with the same key(item) one after
+    another in their order, different keys concurrently, at most concurrency
+    keys at a time. Returns results in the order of items, a raised exception
+    is returned in place of its result.
+    """
+    groups = {}
+    for i, item in enumerate(items):
+        groups.setdefault(key(item), []).append(i)
+
+    results = [None] * len(items)
+
+    async def run_group(indexes):
+        for i in indexes:
+            try:
+                results[i] = await process(items[i])
+            except Exception as e:
+                results[i] = e
+
+    await gather_limited([run_group(indexes) for indexes in groups.values()], concurrency)
+    return results
@@ -6,18 +6,18 @@ import math
 import os
 import time
 
-import aiohttp
 from dotenv import load_dotenv
 from decimal import Decimal, ROUND_DOWN
 
 
 from code.api.utils import round_price
 
-from code.db.users import UsersOperations
+from code.db.users import get_users_cache
 from code.db.pairs import LinearPairsOperations, SpotPairsOperations
 from code.db.positions import PositionsOperations
 
 import code.settings as st
+from code.api.client import get_client
 from code.api.market import get_prices
 from decimal import Decimal
 
@@ -57,15 +57,15 @@ async def post_data(url, data, headers):
     """
     Makes asincio post request (used in post_bybit_signed)
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, data=data, headers=headers) as response:
-            return await response.json()
+    return await get_client().post_json(url, data=data, headers=headers)
 
 
 async def post_bybit_signed(url, API_KEY, SECRET_KEY, **kwargs):
     """
     Sends signed post requests with aiohttp
     """
+    # ждем бюджет лимита до подписи, чтобы не выйти за recv_window
+    await get_client().acquire(API_KEY, url)
     timestamp = int(time.time() * 1000)
     recv_wind = 5000
     data = json.dumps({key: str(value) for key, value in kwargs.items()})
@@ -188,8 +188,7 @@ async def close_market_order(url, api_key, secret_key, category, symbol, side, q
 #          ############
 #             #####
 async def set_tp_linears(telegram_id, symbol, trailingStop, demo=False):
-    user_op = UsersOperations(DATABASE_URL)
-    settings = await user_op.get_user_data(telegram_id)
+    settings = await get_users_cache(DATABASE_URL).get_user_data(telegram_id)
     if demo:
         api_key = settings.get('demo_api_key')
         secret_key = settings.get('demo_secret_key')
@@ -219,9 +218,11 @@ async def set_tp_linears(telegram_id, symbol, trailingStop, demo=False):
 #          ############
 #             #####
 async def set_lev_linears(telegram_id, symbol, leverage, demo=False):
-    user_op = UsersOperations(DATABASE_URL)
-    settings = await user_op.get_user_data(telegram_id)
+    settings = await get_users_cache(DATABASE_URL).get_user_data(telegram_id)
+    return await set_lev_linears_by_settings(settings, symbol, leverage, demo)
 
+
+async def set_lev_linears_by_settings(settings, symbol, leverage, demo=False):
     if demo:
         api_key = settings.get('demo_api_key')
         secret_key = settings.get('demo_secret_key')
@@ -253,38 +254,37 @@ async def set_lev_linears(telegram_id, symbol, leverage, demo=False):
         return -1
 
 
-async def set_lev_for_all_linears(telegram_id, leverage, demo=True, batch_size=8, delay=1.1):
+async def set_lev_for_all_linears(telegram_id, leverage, demo=True):
     db_linear_pairs = LinearPairsOperations(DATABASE_URL)
     data = await db_linear_pairs.get_all_linear_pairs_data()
     symbols = [entry['name'] for entry in data.values()]
 
-    failed_symbols = []  # Список для символов с ошибками
+    settings = await get_users_cache(DATABASE_URL).get_user_data(telegram_id)
 
-    # Проверяем первый символ перед выполнением батчей
+    # Проверяем первый символ перед отправкой остальных
     first_symbol = symbols[0]
-    first_result = await set_lev_linears(telegram_id, first_symbol, leverage, demo)
+    first_result = await set_lev_linears_by_settings(settings, first_symbol, leverage, demo)
 
     if first_result == -2:
         raise Exception(f"Ошибка - отсутсвуют API ключи. Прерывание выполнения.")
-    for i in range(0, len(symbols), batch_size):
-        batch = symbols[i:i + batch_size]
-        tasks = [set_lev_linears(telegram_id, symbol, leverage, demo) for symbol in batch]
-        results = await asyncio.gather(*tasks)
-
-        # Проверка результатов и добавление символов с ошибками
-        for symbol, result in zip(batch, results):
-            if result == -1:
-                failed_symbols.append(symbol)
-        print('Обновлены 8 символов, failed =', failed_symbols)
-        await asyncio.sleep(delay)
+
+    # темп запросов задает лимитер клиента по заголовкам биржи, а не фиксированные паузы
+    tasks = [set_lev_linears_by_settings(settings, symbol, leverage, demo) for symbol in symbols[1:]]
+    results = await asyncio.gather(*tasks)
+
+    # Список для символов с ошибками
+    failed_symbols = [symbol for symbol, result in zip(symbols[1:], results) if result == -1]
+    if first_result == -1:
+        failed_symbols.insert(0, first_symbol)
+    print('Обновлены плечи, failed =', failed_symbols)
 
     return failed_symbols
 
 async def set_lev_for_all_linears_demo_plus_main(telegram_id, leverage):
     # changes leverage both on demo and main
     try:
-        await set_lev_for_all_linears(telegram_id, leverage, demo=False, batch_size=8, delay=1)
-        await set_lev_for_all_linears(telegram_id, leverage, demo=True, batch_size=8, delay=1)
+        await set_lev_for_all_linears(telegram_id, leverage, demo=False)
+        await set_lev_for_all_linears(telegram_id, leverage, demo=True)
         return True
     except:
         return False
@@ -359,8 +359,7 @@ async def cancel_all_orders_positions(telegram_id):
     })
 
     result = {}
-    user_op = UsersOperations(DATABASE_URL)
-    settings = await user_op.get_user_data(telegram_id)
+    settings = await get_users_cache(DATABASE_URL).get_user_data(telegram_id)
 
 
     demo_api_key = settings.get('demo_api_key')
@@ -377,8 +376,7 @@ async def cancel_all_orders_positions(telegram_id):
         if res_lin == 'OK':
             result['orders_linear_demo'] = 1
             if not open_orders_demo.empty:
-                for index, row in open_orders_demo[open_orders_demo['order_type'] == 'linear'].iterrows():
-                    await position_op.upsert_position({'bybit_id': row['bybit_id'], 'finished': True})
+                await position_op.bulk_mark(open_orders_demo[open_orders_demo['order_type'] == 'linear']['bybit_id'], finished=True)
                 print('1 Закрыли демо фьючи ордера')
         else:
             result['orders_linear_demo'] = 0
@@ -390,8 +388,7 @@ async def cancel_all_orders_positions(telegram_id):
         if res_spot == 'OK':
             result['orders_spot_demo'] = 1
             if not open_orders_demo.empty:
-                for index, row in open_orders_demo[open_orders_demo['order_type'] == 'spot'].iterrows():
-                    await position_op.upsert_position({'bybit_id': row['bybit_id'], 'finished': True})
+                await position_op.bulk_mark(open_orders_demo[open_orders_demo['order_type'] == 'spot']['bybit_id'], finished=True)
                 print('2 Закрыли демо спот ордера')
         else:
             result['orders_spot_demo'] = 0
@@ -440,8 +437,7 @@ async def cancel_all_orders_positions(telegram_id):
         if res_lin == 'OK':
             result['orders_linear_real'] = 1
             if not open_orders_real.empty:
-                for index, row in open_orders_real[open_orders_demo['order_type'] == 'linear'].iterrows():
-                    await position_op.upsert_position({'bybit_id': row['bybit_id'], 'finished': True})
+                await position_op.bulk_mark(open_orders_real[open_orders_real['order_type'] == 'linear']['bybit_id'], finished=True)
         else:
             result['orders_linear_real'] = 0
 
@@ -452,8 +448,7 @@ async def cancel_all_orders_positions(telegram_id):
         if res_spot == 'OK':
             result['orders_spot_real'] = 1
             if not open_orders_real.empty:
-                for index, row in open_orders_real[open_orders_demo['order_type'] == 'spot'].iterrows():
-                    await position_op.upsert_position({'bybit_id': row['bybit_id'], 'finished': True})
+                await position_op.bulk_mark(open_orders_real[open_orders_real['order_type'] == 'spot']['bybit_id'], finished=True)
         else:
             result['orders_spot_real'] = 0
 
@@ -0,0 +1,195 @@
+import math
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict, deque
+
+import code.settings as st
+
+
+class TpTriggerEngine:
+    """
+    Activation thresholds of the first TP, bucketed by (market, symbol).
+
+    A long (side Buy) fires when the price reaches avgPrice * (1 + tp_min/100),
+    a short (side Sell) when it falls to avgPrice * (1 - tp_min/100). Every bucket
+    keeps longs and shorts in sorted lists, so a price update pops only the crossed
+    positions with a bisect instead of checking every open position.
+
+    market is the order_type of the position ('spot' or 'linear'), the price category.
+    """
+
+    def __init__(self):
+        # (market, symbol) -> {'Buy': [(threshold, bybit_id)], 'Sell': [...]}, по возрастанию порога
+        self._buckets = {}
+        self._armed = {}  # bybit_id -> (key, side, threshold, position)
+
+    def __len__(self):
+        return len(self._armed)
+
+    @staticmethod
+    def threshold(side, avg_price, tp_min):
+        if side == 'Buy':
+            return avg_price * (1 + tp_min / 100)
+        return avg_price * (1 - tp_min / 100)
+
+    def arm(self, position, tp_min):
+        """
+        Arms the first TP of a position (record with bybit_id, order_type, symbol, side, avgPrice).
+        Returns the (market, symbol) key, or None if the position can not be armed.
+        """
+        if position.avgPrice is None or tp_min is None:
+            return None
+        self.disarm(position.bybit_id)
+        threshold = self.threshold(position.side, float(position.avgPrice), float(tp_min))
+        if math.isnan(threshold):
+            return None
+        key = (position.order_type, position.symbol)
+        sides = self._buckets.setdefault(key, {'Buy': [], 'Sell': []})
+        insort(sides['Buy' if position.side == 'Buy' else 'Sell'], (threshold, position.bybit_id))
+        self._armed[position.bybit_id] = (key, position.side, threshold, position)
+        return key
+
+    def disarm(self, bybit_id):
+        armed = self._armed.pop(bybit_id, None)
+        if armed is None:
+            return
+        key, side, threshold, _ = armed
+        entries = self._buckets[key]['Buy' if side == 'Buy' else 'Sell']
+        i = bisect_left(entries, (threshold, bybit_id))
+        if i < len(entries) and entries[i] == (threshold, bybit_id):
+            del entries[i]
+        if not self._buckets[key]['Buy'] and not self._buckets[key]['Sell']:
+            del self._buckets[key]
+
+    def sync(self, positions, tp_min_map, can_arm=None) -> set:
+        """
+        Makes the armed set equal to positions (records waiting for the first TP).
+        Positions whose avgPrice, side or tp_min changed are re-armed.
+        Returns the keys of newly armed positions, their current price should be
+        checked right away: it may already be past the threshold.
+        """
+        wanted = {}
+        for position in positions:
+            tp_min = tp_min_map.get(position.owner_id)
+            if tp_min is None or (can_arm is not None and not can_arm(position)):
+                continue
+            wanted[position.bybit_id] = (position, tp_min)
+
+        for bybit_id in [bybit_id for bybit_id in self._armed if bybit_id not in wanted]:
+            self.disarm(bybit_id)
+
+        fresh = set()
+        for bybit_id, (position, tp_min) in wanted.items():
+            armed = self._armed.get(bybit_id)
+            if armed is not None:
+                _, side, threshold, current = armed
+                if (side == position.side and current.avgPrice == position.avgPrice
+                        and threshold == self.threshold(side, float(position.avgPrice), float(tp_min))):
+                    continue
+            key = self.arm(position, tp_min)
+            if key is not None:
+                fresh.add(key)
+        return fresh
+
+    def symbols(self, market):
+        return [symbol for key_market, symbol in self._buckets if key_market == market]
+
+    def on_price(self, market, symbol, price) -> list:
+        """
+        Pops and returns the positions of symbol whose threshold price has crossed.
+        """
+        sides = self._buckets.get((market, symbol))
+        if sides is None:
+            return []
+        longs, shorts = sides['Buy'], sides['Sell']
+        # лонги по возрастанию порога: сработали все с порогом <= цены
+        k = bisect_right(longs, (price, chr(0x10FFFF)))
+        crossed = longs[:k]
+        del longs[:k]
+        # шорты: сработали все с порогом >= цены
+        k = bisect_left(shorts, (price, ''))
+        crossed += shorts[k:]
+        del shorts[k:]
+        if not longs and not shorts:
+            del self._buckets[(market, symbol)]
+        return [self._armed.pop(bybit_id)[3] for _, bybit_id in crossed]
+
+
+class AmendScheduler:
+    """
+    Coalesces trailing trigger updates of spot TP orders.
+
+    propose() keeps only the latest target of every order. due() hands out the
+    orders whose target beats the last sent trigger by at least min_ticks ticks
+    and min_percent percent, not more often than once per min_interval seconds
+    per order and per_key_rate amends per second per key. Targets that are not
+    due stay pending and are replaced by newer proposals, so a rally costs one
+    amend per interval with the latest trigger instead of one per price move.
+    """
+
+    def __init__(self, min_ticks=None, min_percent=None, min_interval=None, per_key_rate=None):
+        settings = st.AMEND
+        self.min_ticks = min_ticks or settings['min_ticks']
+        self.min_percent = min_percent if min_percent is not None else settings['min_percent']
+        self.min_interval = min_interval if min_interval is not None else settings['min_interval']
+        self.per_key_rate = per_key_rate or settings['per_key_rate']
+        self._pending = {}  # order_id -> (key, trigger, tick, context)
+        self._sent = {}  # order_id -> (trigger, time.monotonic() последней отправки)
+        self._key_times = defaultdict(deque)  # key -> время отправок за последнюю секунду
+
+    def __len__(self):
+        return len(self._pending)
+
+    def propose(self, order_id, key, trigger, current, tick, context=None):
+        """
+        Sets the wanted trigger of an order. current is the trigger the order has
+        now (stored in positions), tick the price tick of the symbol.
+        """
+        last = self._sent.get(order_id)
+        if last is None or last[0] < current:
+            self._sent[order_id] = (current, last[1] if last else 0)
+        if trigger > self._sent[order_id][0]:
+            self._pending[order_id] = (key, trigger, tick, context)
+        else:
+            self._pending.pop(order_id, None)
+
+    def due(self, now=None) -> list:
+        """
+        Pops the amends to send now: list of (order_id, trigger, context).
+        """
+        now = time.monotonic() if now is None else now
+        ready = []
+        for order_id, (key, trigger, tick, context) in list(self._pending.items()):
+            last_trigger, last_time = self._sent[order_id]
+            step = max(self.min_ticks * tick, last_trigger * self.min_percent / 100)
+            # мелкое улучшение ждет, пока цена уйдет дальше
+            if trigger - last_trigger < step * (1 - 1e-9):
+                continue
+            if now - last_time < self.min_interval:
+                continue
+            times = self._key_times[key]
+            while times and now - times[0] >= 1:
+                times.popleft()
+            if len(times) >= self.per_key_rate:
+                continue
+            times.append(now)
+            self._sent[order_id] = (last_trigger, now)
+            del self._pending[order_id]
+            ready.append((order_id, trigger, context))
+        return ready
+
+    def confirm(self, order_id, trigger):
+        """
+        Records an accepted amend, later targets are measured from trigger.
+        """
+        last_time = self._sent.get(order_id, (trigger, time.monotonic()))[1]
+        self._sent[order_id] = (trigger, last_time)
+
+    def retain(self, order_ids):
+        """
+        Forgets orders that are not open any more.
+        """
+        order_ids = set(order_ids)
+        for store in (self._pending, self._sent):
+            for order_id in [order_id for order_id in store if order_id not in order_ids]:
+                del store[order_id]
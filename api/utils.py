@@ -1,4 +1,8 @@
+import math
 from decimal import Decimal, ROUND_DOWN
+from typing import NamedTuple
+
+import numpy as np
 
 
 def calculate_purchase_volume(sum_amount, price, min_volume, tick):
@@ -16,6 +20,10 @@ def calculate_purchase_volume(sum_amount, price, min_volume, tick):
     return float(rounded_volume.quantize(tick, rounding=ROUND_DOWN))
 
 def adjust_quantity(quantity, min_volume, tick):
+    if isinstance(tick, TickScale):
+        adjusted = floor_tick(quantity, tick)
+        return -1 if adjusted < float(min_volume) else adjusted
+
     quantity = Decimal(str(quantity))
     min_volume = Decimal(str(min_volume))
     tick = Decimal(str(tick))
@@ -30,6 +38,80 @@ def adjust_quantity(quantity, min_volume, tick):
     return float(adjusted_quantity)
 
 def round_price(price, tick_size):
+    if isinstance(tick_size, TickScale):
+        return floor_tick(price, tick_size)
+
     price = Decimal(str(price))
     tick_size = Decimal(str(tick_size))
-    return float((price // tick_size) * tick_size)
\ No newline at end of file
+    return float((price // tick_size) * tick_size)
+
+# ####### VECTOR VERSIONS ########
+# Same rounding as the functions above, for a whole cohort of users at once.
+# Values are counted in integer ticks: tick = tick_int / scale exactly, so the
+# result is tick_count * tick_int / scale, the float nearest to the decimal value.
+
+# float division can land a few ulps below a tick boundary (0.3 / 0.1 = 2.9999999999999996)
+TICK_TOLERANCE = 4 * np.finfo(float).eps
+
+
+class TickScale(NamedTuple):
+    """
+    A price tick or quantity step as tick_int / scale, both integers.
+    """
+    tick_int: int
+    scale: int
+
+    @property
+    def size(self) -> float:
+        return self.tick_int / self.scale
+
+
+def tick_scale(tick) -> TickScale:
+    """
+    Returns (tick_int, scale) with tick == tick_int / scale exactly.
+    A TickScale (pre-parsed, see db.pairs.InstrumentSpec) is returned as is.
+    """
+    if isinstance(tick, TickScale):
+        return tick
+    tick = Decimal(str(tick)).normalize()
+    exponent = tick.as_tuple().exponent
+    scale = 10 ** max(-exponent, 0)
+    return TickScale(int(tick * scale), scale)
+
+
+def floor_tick(value, tick) -> float:
+    """
+    Scalar floor_ticks: value floored to a multiple of tick.
+    """
+    tick_int, scale = tick_scale(tick)
+    count = float(value) * scale / tick_int
+    count = math.floor(count + abs(count) * TICK_TOLERANCE)
+    return count * tick_int / scale
+
+
+def floor_ticks(values, tick):
+    """
+    Returns values floored to a multiple of tick, as integer tick counts and the tick scale.
+    """
+    tick_int, scale = tick_scale(tick)
+    counts = np.asarray(values, dtype=float) * scale / tick_int
+    counts = np.floor(counts + np.abs(counts) * TICK_TOLERANCE)
+    # NaN (нет настройки/бюджета) - считаем как недостаточный объем
+    counts = np.where(np.isfinite(counts), counts, -1)
+    return counts.astype(np.int64), tick_int, scale
+
+
+def round_prices(prices, tick_size):
+    counts, tick_int, scale = floor_ticks(prices, tick_size)
+    return counts * tick_int / scale
+
+
+def adjust_quantities(quantities, min_volume, tick):
+    counts, tick_int, scale = floor_ticks(quantities, tick)
+    adjusted = counts * tick_int / scale
+    return np.where(adjusted < float(min_volume), -1.0, adjusted)
+
+
+def calculate_purchase_volumes(sum_amounts, prices, min_volume, tick):
+    volumes = np.asarray(sum_amounts, dtype=float) / np.asarray(prices, dtype=float)
+    return adjust_quantities(volumes, min_volume, tick)
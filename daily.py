@@ -64,6 +64,11 @@ amend_order_demo_url = demo_url + st.ENDPOINTS.get('amend_order')
 
 
 async def daily_task():
+    # один раз на процесс: все обертки делят пул соединений
+    positions_op = PositionsOperations(DATABASE_URL)
+    user_op = UsersOperations(DATABASE_URL)
+    pnl_op = PNLManager(DATABASE_URL)
+    users_op = UsersOperations(DATABASE_URL)
 
     while True:
 
@@ -93,8 +98,6 @@ async def daily_task():
                     print('Выполняется каждую 1 минут или меньше')
                     print('Poluchaem otritie posizii')
 
-                    positions_op = PositionsOperations(DATABASE_URL)
-                    user_op = UsersOperations(DATABASE_URL)
 
                     try:
                         # по всем юзерам
@@ -280,8 +283,6 @@ async def daily_task():
             # Выполняем основную задачу в полночь
             print('Выполняется основная задача по обновлению PNL в 00:00:00')
 
-            pnl_op = PNLManager(DATABASE_URL)
-            users_op = UsersOperations(DATABASE_URL)
             users = await users_op.get_all_users_data()
 
             valid_users = []
@@ -4,12 +4,13 @@ import asyncio
 from dotenv import load_dotenv
 from typing import List
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import Column, String, DateTime, func, delete, select, BigInteger, Boolean, text
 from datetime import datetime, timedelta, timezone
 
 
 import logging
+from code.db.engine import get_engine
 
 
 logging.getLogger('sqlalchemy').setLevel(logging.WARNING)
@@ -36,7 +37,7 @@ class Alerts(Base):
 
 class AlertsOperations:
     def __init__(self, database_url: str):
-        self.engine = create_async_engine(database_url, echo=False)
+        self.engine = get_engine(database_url)
         self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
 
     async def table_exists(self, table_name: str) -> bool:
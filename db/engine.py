@@ -0,0 +1,88 @@
+import os
+import time
+
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import code.settings as st
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Queue pool that records how long checkouts wait for a connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.monotonic() - start
+            self.waits += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def recreate(self):
+        # engine.dispose() пересоздает пул - метрики переносим
+        pool = super().recreate()
+        pool.waits, pool.wait_total, pool.wait_max = self.waits, self.wait_total, self.wait_max
+        return pool
+
+
+_engines = {}
+
+
+def get_engine(database_url: str) -> AsyncEngine:
+    """
+    Returns the engine of the current process for database_url.
+
+    Every *Operations class takes its engine from here, so all table wrappers
+    of a process share one bounded pool, however many instances are created.
+    """
+    key = (os.getpid(), database_url)
+    engine = _engines.get(key)
+    if engine is None:
+        engine = create_async_engine(database_url, echo=False, poolclass=TimedQueuePool, **st.DB_POOL)
+        _engines[key] = engine
+    return engine
+
+
+def pool_status() -> dict:
+    """
+    Returns pool metrics of the current process, per database url (password hidden).
+    """
+    pid = os.getpid()
+    status = {}
+    for (engine_pid, _), engine in _engines.items():
+        if engine_pid != pid:
+            continue
+        pool = engine.pool
+        status[engine.url.render_as_string(hide_password=True)] = {
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'waits': pool.waits,
+            'wait_avg': pool.wait_total / pool.waits if pool.waits else 0.0,
+            'wait_max': pool.wait_max,
+        }
+    return status
+
+
+async def dispose_engines():
+    """
+    Closes pooled connections of the current process.
+
+    Engines stay registered and open new connections on next use, which is
+    needed when a process runs several event loops one after another.
+    """
+    pid = os.getpid()
+    for (engine_pid, _), engine in list(_engines.items()):
+        if engine_pid == pid:
+            await engine.dispose()
@@ -6,13 +6,14 @@ from typing import List, Dict, Optional
 
 
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import Column, String, DateTime, func, text, delete, select
 from sqlalchemy.dialects.postgresql import insert
 from datetime import datetime, timedelta, timezone
 
 
 from code.api.market import get_announcements
+from code.db.engine import get_engine
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
@@ -35,7 +36,7 @@ class NewPairs(Base):
 
 class NewPairsOperations:
     def __init__(self, database_url: str):
-        self.engine = create_async_engine(database_url, echo=False)
+        self.engine = get_engine(database_url)
         self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
 
     async def table_exists(self, table_name: str) -> bool:
@@ -0,0 +1,76 @@
+import asyncio
+
+import asyncpg
+from sqlalchemy import text
+
+
+def asyncpg_dsn(database_url: str) -> str:
+    """
+    Turns the sqlalchemy url (postgresql+asyncpg://...) into a plain asyncpg dsn.
+    """
+    return database_url.replace('+asyncpg', '', 1)
+
+
+async def notify(session, channel: str, payload: str):
+    """
+    Queues a NOTIFY inside the session transaction, it is delivered on commit.
+    """
+    await session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                          {"channel": channel, "payload": payload})
+
+
+class PgListener:
+    """
+    Dedicated connection that LISTENs to postgres channels.
+
+    channels maps a channel name to a callback taking the payload string.
+    The connection is health-checked and reopened on failure; on_reconnect is
+    awaited after every reconnect, so caches can resync what was missed.
+    """
+
+    def __init__(self, database_url: str, channels: dict, on_reconnect=None,
+                 retry_delay=5, check_interval=30):
+        self.dsn = asyncpg_dsn(database_url)
+        self.channels = channels
+        self.on_reconnect = on_reconnect
+        self.retry_delay = retry_delay
+        self.check_interval = check_interval
+        self.connected = False
+
+    def _callback(self, callback):
+        def listener(connection, pid, channel, payload):
+            try:
+                callback(payload)
+            except Exception as e:
+                print(f'Ошибка обработки уведомления {channel}:', e)
+        return listener
+
+    async def run(self):
+        first = True
+        while True:
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                try:
+                    closed = asyncio.Event()
+                    conn.add_termination_listener(lambda c: closed.set())
+                    for channel, callback in self.channels.items():
+                        await conn.add_listener(channel, self._callback(callback))
+                    self.connected = True
+                    if not first and self.on_reconnect is not None:
+                        await self.on_reconnect()
+                    first = False
+
+                    while not closed.is_set():
+                        try:
+                            await asyncio.wait_for(closed.wait(), timeout=self.check_interval)
+                        except asyncio.TimeoutError:
+                            # тихо умершее соединение само не закроется
+                            await asyncio.wait_for(conn.fetchval('SELECT 1'), timeout=self.check_interval)
+                finally:
+                    self.connected = False
+                    if not conn.is_closed():
+                        await conn.close()
+            except Exception as e:
+                print('Соединение LISTEN потеряно:', e)
+                first = False
+            await asyncio.sleep(self.retry_delay)
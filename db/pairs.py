@@ -1,11 +1,20 @@
 import os
+import json
+import hashlib
 import asyncio
+from decimal import Decimal, InvalidOperation
+from types import MappingProxyType
 from dotenv import load_dotenv
-from sqlalchemy import Column, String, Boolean, text, DateTime, func
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy import (Column, String, Boolean, text, DateTime, func, select, union_all, case,
+                        literal, literal_column, or_, tuple_, update)
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.dialects.postgresql import insert
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, NamedTuple, Mapping
+from code.db.engine import get_engine
+from code.db.notify import PgListener, notify
+from code.api.utils import TickScale, tick_scale
+from code.api.market import iter_settings
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
@@ -13,6 +22,9 @@ load_dotenv()
 # Получение URL базы данных из переменной окружения
 DATABASE_URL = os.getenv('database_url')
 
+# записи в spot_pairs/linear_pairs шлют сюда {"market": "spot"|"linear", "symbols": [short_name, ...]}
+PAIRS_CHANNEL = 'pairs_changed'
+
 
 BaseSpot = declarative_base()
 BaseLinear = declarative_base()
@@ -31,6 +43,7 @@ class SpotPairs(BaseSpot):
     name = Column(String, primary_key=True, nullable=False)
     short_name = Column(String, primary_key=True, nullable=False)
     if_trading = Column(Boolean, nullable=False, server_default='false')  # true only if bot trades it currently
+    delisted = Column(Boolean, nullable=False, server_default='false')  # not listed for trading any more
 
     margin_trading = Column(String, nullable=True)  # none, both, utaOnly, normalSpotOnly
     base_precision = Column(String, nullable=True)  # precision of base coin
@@ -40,9 +53,83 @@ class SpotPairs(BaseSpot):
     tick_size = Column(String, nullable=True)  # step to change price
 
 
+# настройки пары, которые приходят с биржи (кроме ключа name, short_name)
+SPOT_COLUMNS = ('margin_trading', 'base_precision', 'quote_precision', 'min_order_qty', 'max_order_qty', 'tick_size')
+
+
+async def upsert_pairs(session, model, columns, pairs, delisted=None) -> Dict[str, List[str]]:
+    """
+    Writes the whole instrument list with one INSERT ... ON CONFLICT DO UPDATE.
+
+    Rows are only rewritten when a setting differs. Delisted pairs, in the table
+    but not in pairs, are marked delisted in the same statement and kept, open
+    positions may still need their settings. Only newly marked pairs are
+    reported, so every delisting is reported once; a relisted pair is unmarked.
+    A caller that sends only changed pairs passes the short names to mark as
+    delisted instead. Returns the short names of added, changed and delisted pairs.
+    """
+    # повтор одной пары в списке сломал бы ON CONFLICT, оставляем последнюю
+    rows = {}
+    for pair in pairs:
+        rows[(pair['name'], pair['short_name'])] = {
+            'name': pair['name'], 'short_name': pair['short_name'],
+            **{column: pair.get(column) for column in columns},
+        }
+
+    if not rows and delisted is None:
+        # пустой список с биржи - это сбой, а не делистинг всех пар
+        raise ValueError(f'empty instrument list for {model.__tablename__}')
+
+    table = model.__table__
+    queries = []
+    if rows:
+        stmt = insert(table).values(list(rows.values()))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['name', 'short_name'],
+            set_={**{column: stmt.excluded[column] for column in columns}, 'delisted': False},
+            where=or_(table.c.delisted, *[table.c[column].is_distinct_from(stmt.excluded[column])
+                                          for column in columns]),
+        ).returning(table.c.short_name, literal_column('xmax = 0').label('added'))
+        upserted = stmt.cte('upserted')
+        queries.append(select(upserted.c.short_name,
+                              case((upserted.c.added, 'added'), else_='changed').label('change')))
+
+    if delisted is None:
+        removed = update(table).where(tuple_(table.c.name, table.c.short_name).not_in(list(rows)))
+    elif delisted:
+        removed = update(table).where(table.c.short_name.in_(list(delisted)))
+    else:
+        removed = None
+    if removed is not None:
+        removed = (removed.where(table.c.delisted == False).values(delisted=True)
+                   .returning(table.c.short_name).cte('removed'))
+        queries.append(select(removed.c.short_name, literal('delisted').label('change')))
+
+    report = {'added': [], 'changed': [], 'delisted': []}
+    if queries:
+        query = union_all(*queries) if len(queries) > 1 else queries[0]
+        for short_name, change in (await session.execute(query)).all():
+            report[change].append(short_name)
+    return report
+
+
+async def notify_pairs_changed(session, market, report):
+    """
+    Tells the instrument registries which pairs of market changed.
+    A list too long for a NOTIFY payload is replaced by a full reload of the market.
+    """
+    symbols = report['added'] + report['changed'] + report['delisted']
+    if not symbols:
+        return
+    payload = json.dumps({'market': market, 'symbols': symbols})
+    if len(payload) > 7000:
+        payload = json.dumps({'market': market})
+    await notify(session, PAIRS_CHANNEL, payload)
+
+
 class SpotPairsOperations:
     def __init__(self, database_url: str):
-        self.engine = create_async_engine(database_url, echo=False)
+        self.engine = get_engine(database_url)
         self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
 
     async def table_exists(self, table_name: str) -> bool:
@@ -60,33 +147,28 @@ class SpotPairsOperations:
             print(f"Table '{SpotPairs.__tablename__}' created successfully.")
         else:
             print(f"Table '{SpotPairs.__tablename__}' already exists, skipping creation.")
+            await self.migrate()
 
-    async def insert_spot_pairs(self, pairs: List[Dict[str, Optional[str]]]):
+    async def migrate(self, conn=None):
+        if conn is None:
+            async with self.engine.begin() as conn:
+                return await self.migrate(conn)
+        # пары с делистингом помечаются, а не удаляются: по ним могут быть открытые позиции
+        await conn.execute(text(
+            "ALTER TABLE spot_pairs ADD COLUMN IF NOT EXISTS delisted BOOLEAN NOT NULL DEFAULT false"
+        ))
+
+    async def insert_spot_pairs(self, pairs: List[Dict[str, Optional[str]]],
+                          delisted: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        """
+        Upserts pairs with one statement, see upsert_pairs.
+        """
         async with self.async_session() as session:
             async with session.begin():
-                for pair in pairs:
-                    stmt = insert(SpotPairs).values(
-                        name=pair['name'],
-                        short_name=pair['short_name'],
-                        margin_trading=pair.get('margin_trading'),
-                        base_precision=pair.get('base_precision'),
-                        quote_precision=pair.get('quote_precision'),
-                        min_order_qty=pair.get('min_order_qty'),
-                        max_order_qty=pair.get('max_order_qty'),
-                        tick_size=pair.get('tick_size')
-                    ).on_conflict_do_update(
-                        index_elements=['name', 'short_name'],
-                        set_={
-                            'margin_trading': pair.get('margin_trading'),
-                            'base_precision': pair.get('base_precision'),
-                            'quote_precision': pair.get('quote_precision'),
-                            'min_order_qty': pair.get('min_order_qty'),
-                            'max_order_qty': pair.get('max_order_qty'),
-                            'tick_size': pair.get('tick_size')
-                        }
-                    )
-                    await session.execute(stmt)
+                report = await upsert_pairs(session, SpotPairs, SPOT_COLUMNS, pairs, delisted)
+                await notify_pairs_changed(session, 'spot', report)
             await session.commit()
+        return report
 
     async def update_if_trading(self, short_names: List[str], if_trading: bool):
         async with self.async_session() as session:
@@ -116,6 +198,7 @@ class SpotPairsOperations:
                     'name': row['name'],
                     'short_name': row['short_name'],
                     'if_trading': row['if_trading'],
+                    'delisted': row.get('delisted', False),
                     'margin_trading': row['margin_trading'],
                     'base_precision': row['base_precision'],
                     'quote_precision': row['quote_precision'],
@@ -141,6 +224,7 @@ class SpotPairsOperations:
                     'name': row['name'],
                     'short_name': row['short_name'],
                     'if_trading': row['if_trading'],
+                    'delisted': row.get('delisted', False),
                     'margin_trading': row['margin_trading'],
                     'base_precision': row['base_precision'],
                     'quote_precision': row['quote_precision'],
@@ -163,6 +247,7 @@ class LinearPairs(BaseLinear):
     name = Column(String, primary_key=True, nullable=False)
     short_name = Column(String, primary_key=True, nullable=False)
     if_trading = Column(Boolean, nullable=False, server_default='false')  # true only if bot trades it currently
+    delisted = Column(Boolean, nullable=False, server_default='false')  # not listed for trading any more
 
     min_leverage = Column(String, nullable=True)
     max_leverage = Column(String, nullable=True)
@@ -176,9 +261,13 @@ class LinearPairs(BaseLinear):
     qty_step = Column(String, nullable=True)
 
 
+LINEAR_COLUMNS = ('min_leverage', 'max_leverage', 'leverage_step', 'unified_margin_trade', 'min_price',
+                  'max_price', 'price_tick_size', 'max_order_qty', 'min_order_qty', 'qty_step')
+
+
 class LinearPairsOperations:
     def __init__(self, database_url: str):
-        self.engine = create_async_engine(database_url, echo=False)
+        self.engine = get_engine(database_url)
         self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
 
     async def table_exists(self, table_name: str) -> bool:
@@ -196,41 +285,28 @@ class LinearPairsOperations:
             print(f"Table '{LinearPairs.__tablename__}' created successfully.")
         else:
             print(f"Table '{LinearPairs.__tablename__}' already exists, skipping creation.")
+            await self.migrate()
 
-    async def insert_linear_pairs(self, pairs: List[Dict[str, Optional[str]]]):
+    async def migrate(self, conn=None):
+        if conn is None:
+            async with self.engine.begin() as conn:
+                return await self.migrate(conn)
+        # пары с делистингом помечаются, а не удаляются: по ним могут быть открытые позиции
+        await conn.execute(text(
+            "ALTER TABLE linear_pairs ADD COLUMN IF NOT EXISTS delisted BOOLEAN NOT NULL DEFAULT false"
+        ))
+
+    async def insert_linear_pairs(self, pairs: List[Dict[str, Optional[str]]],
+                          delisted: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        """
+        Upserts pairs with one statement, see upsert_pairs.
+        """
         async with self.async_session() as session:
             async with session.begin():
-                for pair in pairs:
-                    stmt = insert(LinearPairs).values(
-                        name=pair['name'],
-                        short_name=pair['short_name'],
-                        min_leverage=pair.get('min_leverage'),
-                        max_leverage=pair.get('max_leverage'),
-                        leverage_step=pair.get('leverage_step'),
-                        unified_margin_trade=pair.get('unified_margin_trade'),
-                        min_price=pair.get('min_price'),
-                        max_price=pair.get('max_price'),
-                        price_tick_size=pair.get('price_tick_size'),
-                        max_order_qty=pair.get('max_order_qty'),
-                        min_order_qty=pair.get('min_order_qty'),
-                        qty_step=pair.get('qty_step')
-                    ).on_conflict_do_update(
-                        index_elements=['name', 'short_name'],
-                        set_={
-                            'min_leverage': pair.get('min_leverage'),
-                            'max_leverage': pair.get('max_leverage'),
-                            'leverage_step': pair.get('leverage_step'),
-                            'unified_margin_trade': pair.get('unified_margin_trade'),
-                            'min_price': pair.get('min_price'),
-                            'max_price': pair.get('max_price'),
-                            'price_tick_size': pair.get('price_tick_size'),
-                            'max_order_qty': pair.get('max_order_qty'),
-                            'min_order_qty': pair.get('min_order_qty'),
-                            'qty_step': pair.get('qty_step')
-                        }
-                    )
-                    await session.execute(stmt)
+                report = await upsert_pairs(session, LinearPairs, LINEAR_COLUMNS, pairs, delisted)
+                await notify_pairs_changed(session, 'linear', report)
             await session.commit()
+        return report
 
     async def update_if_trading(self, short_names: List[str], if_trading: bool):
         async with self.async_session() as session:
@@ -260,6 +336,7 @@ class LinearPairsOperations:
                     'name': row['name'],
                     'short_name': row['short_name'],
                     'if_trading': row['if_trading'],
+                    'delisted': row.get('delisted', False),
                     'min_leverage': row['min_leverage'],
                     'max_leverage': row['max_leverage'],
                     'leverage_step': row['leverage_step'],
@@ -287,6 +364,7 @@ class LinearPairsOperations:
                     'name': row['name'],
                     'short_name': row['short_name'],
                     'if_trading': row['if_trading'],
+                    'delisted': row.get('delisted', False),
                     'min_leverage': row['min_leverage'],
                     'max_leverage': row['max_leverage'],
                     'leverage_step': row['leverage_step'],
@@ -310,6 +388,247 @@ class LinearPairsOperations:
             return names
 
 
+MARKET_COLUMNS = {'spot': SPOT_COLUMNS, 'linear': LINEAR_COLUMNS}
+
+
+def spec_hash(market: str, pair) -> str:
+    """
+    Hash of the normalized settings of one pair, the same for an exchange
+    record of iter_settings and a row of the table.
+    """
+    values = [pair.get('name'), pair.get('short_name')] + [pair.get(column) for column in MARKET_COLUMNS[market]]
+    return hashlib.blake2b(json.dumps(values).encode(), digest_size=16).hexdigest()
+
+
+class PairsRefresher:
+    """
+    Differential refresh of spot_pairs/linear_pairs from instruments-info.
+
+    Pages are streamed and every pair is hashed on the fly; only pairs whose hash
+    differs from the last known one are written, and only they (plus delisted
+    pairs) are broadcast to the instrument registries. Known hashes are read from
+    the table on the first refresh and kept in memory after that.
+    """
+
+    def __init__(self, spot_op, linear_op):
+        self.ops = {'spot': spot_op, 'linear': linear_op}
+        self._hashes = {}  # market -> {(name, short_name): hash}
+
+    async def _known(self, market):
+        if market not in self._hashes:
+            if market == 'spot':
+                rows = await self.ops[market].get_all_spot_pairs_data()
+            else:
+                rows = await self.ops[market].get_all_linear_pairs_data()
+            # уже помеченные пары не считаются известными, чтобы не сообщать о делистинге снова
+            self._hashes[market] = {(row['name'], row['short_name']): spec_hash(market, row)
+                                    for row in rows.values() if not row.get('delisted')}
+        return self._hashes[market]
+
+    async def refresh(self, market) -> Dict[str, List[str]]:
+        """
+        Brings one market up to date, returns the report of insert_*_pairs.
+        Nothing is written if a page fails or the exchange lists no pairs at all,
+        so pairs are never delisted by mistake.
+        """
+        known = await self._known(market)
+        listed = {}
+        changed = []
+        async for page in iter_settings(market):
+            for pair in page:
+                key = (pair['name'], pair['short_name'])
+                listed[key] = spec_hash(market, pair)
+                if known.get(key) != listed[key]:
+                    changed.append(pair)
+        if not listed:
+            raise ValueError(f'instruments-info {market}: no traded pairs')
+        delisted = [short_name for name, short_name in known if (name, short_name) not in listed]
+
+        report = {'added': [], 'changed': [], 'delisted': []}
+        if changed or delisted:
+            if market == 'spot':
+                report = await self.ops[market].insert_spot_pairs(changed, delisted)
+            else:
+                report = await self.ops[market].insert_linear_pairs(changed, delisted)
+        self._hashes[market] = listed
+        return report
+
+    async def refresh_all(self):
+        """
+        Returns (spot report, linear report).
+        """
+        return tuple(await asyncio.gather(self.refresh('spot'), self.refresh('linear')))
+
+
+# ####### INSTRUMENT SPECS ########
+#     ############
+#        #####
+
+class InstrumentSpec(NamedTuple):
+    """
+    Trading rules of one symbol with every number parsed once.
+
+    price_tick and qty_step are TickScale, ready for api.utils rounding without
+    string parsing. qty_step_size is the exact step for Decimal quantities.
+    settings keeps the original row of spot_pairs/linear_pairs.
+    """
+    market: str
+    name: str
+    short_name: str
+    price_tick: Optional[TickScale]
+    qty_step: Optional[TickScale]
+    qty_step_size: Optional[Decimal]
+    min_qty: Optional[float]
+    max_qty: Optional[float]
+    settings: Mapping
+
+    @property
+    def tick_size(self) -> Optional[float]:
+        return self.price_tick.size if self.price_tick else None
+
+
+# колонки шага цены и шага количества по рынкам
+SPEC_COLUMNS = {
+    'spot': ('tick_size', 'base_precision'),
+    'linear': ('price_tick_size', 'qty_step'),
+}
+
+
+def _parse_decimal(value) -> Optional[Decimal]:
+    try:
+        value = Decimal(str(value))
+    except (InvalidOperation, ValueError, TypeError):
+        return None
+    return value if value.is_finite() else None
+
+
+def instrument_spec(market: str, row: dict) -> InstrumentSpec:
+    """
+    Builds the spec of one row of get_all_spot_pairs_data/get_all_linear_pairs_data.
+    Missing or invalid numbers become None.
+    """
+    price_column, qty_column = SPEC_COLUMNS[market]
+    price_tick = _parse_decimal(row.get(price_column))
+    qty_step = _parse_decimal(row.get(qty_column))
+    min_qty = _parse_decimal(row.get('min_order_qty'))
+    max_qty = _parse_decimal(row.get('max_order_qty'))
+    return InstrumentSpec(
+        market=market,
+        name=row.get('name'),
+        short_name=row.get('short_name'),
+        price_tick=tick_scale(price_tick) if price_tick else None,
+        qty_step=tick_scale(qty_step) if qty_step else None,
+        qty_step_size=qty_step if qty_step else None,
+        min_qty=float(min_qty) if min_qty is not None else None,
+        max_qty=float(max_qty) if max_qty is not None else None,
+        settings=MappingProxyType(dict(row)),
+    )
+
+
+class InstrumentRegistry:
+    """
+    Process-local, read-only specs of every spot and linear pair keyed by short_name.
+
+    Loaded once and swapped as a whole on reload, so readers never see a half
+    updated table. insert_spot_pairs/insert_linear_pairs send NOTIFY pairs_changed
+    in their transaction and only the listed pairs are reloaded; as a fallback both are
+    reloaded every refresh_interval seconds and after a listener reconnect.
+    """
+
+    def __init__(self, database_url: str, refresh_interval=3600):
+        self.database_url = database_url
+        self.spot_op = SpotPairsOperations(database_url)
+        self.linear_op = LinearPairsOperations(database_url)
+        self.refresh_interval = refresh_interval
+        self.version = 0  # grows on every reload
+        self._specs = {'spot': MappingProxyType({}), 'linear': MappingProxyType({})}
+        self._started = None
+        self._tasks = []
+        self.loop = None
+
+    async def start(self):
+        if self._started is None:
+            self._started = asyncio.create_task(self._start())
+        await asyncio.shield(self._started)
+
+    async def _start(self):
+        await self.reload()
+        listener = PgListener(self.database_url, {PAIRS_CHANNEL: self._on_notify},
+                              on_reconnect=self.reload)
+        self._tasks = [
+            asyncio.create_task(listener.run()),
+            asyncio.create_task(self._refresh_loop()),
+        ]
+
+    async def reload(self, market=None, symbols=None):
+        """
+        Reloads market (both by default). With symbols only those pairs are read
+        and replaced, pairs missing from the table are dropped.
+        """
+        for market in ([market] if market else ['spot', 'linear']):
+            if symbols is not None:
+                if market == 'spot':
+                    rows = await self.spot_op.get_spot_pairs_data(symbols)
+                else:
+                    rows = await self.linear_op.get_linear_pairs_data(symbols)
+                specs = dict(self._specs[market])
+                for short_name in symbols:
+                    specs.pop(short_name, None)
+            else:
+                if market == 'spot':
+                    rows = await self.spot_op.get_all_spot_pairs_data()
+                else:
+                    rows = await self.linear_op.get_all_linear_pairs_data()
+                specs = {}
+            specs.update({short_name: instrument_spec(market, row) for short_name, row in rows.items()})
+            self._specs[market] = MappingProxyType(specs)
+        self.version += 1
+
+    def _on_notify(self, payload: str):
+        # старый формат - просто рынок
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            message = {'market': payload}
+        if not isinstance(message, dict):
+            message = {'market': payload}
+        market = message.get('market')
+        if market in self._specs:
+            self._tasks.append(asyncio.create_task(self.reload(market, message.get('symbols'))))
+            self._tasks = [task for task in self._tasks if not task.done()]
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                print('Ошибка обновления настроек пар', e)
+
+    @property
+    def spot(self) -> Mapping[str, InstrumentSpec]:
+        return self._specs['spot']
+
+    @property
+    def linear(self) -> Mapping[str, InstrumentSpec]:
+        return self._specs['linear']
+
+
+_instruments = None
+
+
+def get_instruments(database_url: str) -> InstrumentRegistry:
+    """
+    Returns the instrument registry of the current process and event loop.
+    """
+    global _instruments
+    loop = asyncio.get_running_loop()
+    if _instruments is None or _instruments.loop is not loop:
+        _instruments = InstrumentRegistry(database_url)
+        _instruments.loop = loop
+    return _instruments
+
+
 if __name__ == '__main__':
     async def main():
         db_spot_pairs = SpotPairsOperations(DATABASE_URL)
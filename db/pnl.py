@@ -1,7 +1,7 @@
 import asyncio
 import os
 from sqlalchemy import Column, String, DateTime, BigInteger, func, text
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.future import select
 from sqlalchemy.sql import insert, delete
@@ -15,6 +15,7 @@ BasePNL = declarative_base()
 
 from datetime import datetime, timedelta
 from datetime import datetime, timezone
+from code.db.engine import get_engine
 
 
 def get_start_of_day_utc():
@@ -36,7 +37,7 @@ class PNL(BasePNL):
 
 class PNLManager:
     def __init__(self, database_url: str):
-        self.engine = create_async_engine(database_url, echo=False)
+        self.engine = get_engine(database_url)
         self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
 
     async def table_exists(self, table_name: str) -> bool:
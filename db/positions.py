@@ -1,19 +1,27 @@
 import os
+import json
+import uuid
 import asyncio
+import numpy as np
 import pandas as pd
+from collections import namedtuple, defaultdict
+from decimal import Decimal
+from functools import lru_cache
 
 from typing import Dict, Optional, List
 
 from dotenv import load_dotenv
-from sqlalchemy import (Column, String, BigInteger, Boolean, DateTime,
+from sqlalchemy import (Column, String, BigInteger, Boolean, DateTime, Numeric, Index,
                         func, text, delete, select)
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy import and_
-from sqlalchemy import update
+from sqlalchemy import update, bindparam
 
 from datetime import datetime, timedelta
+from code.db.engine import get_engine
+from code.db.notify import PgListener, notify
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
@@ -21,6 +29,9 @@ load_dotenv()
 # Получение URL базы данных из переменной окружения
 DATABASE_URL = os.getenv('database_url')
 
+# триггер на таблице шлет сюда каждую измененную строку: {"op": "INSERT|UPDATE|DELETE", "row": {...}}
+POSITIONS_CHANNEL = 'positions_changed'
+
 BasePositions = declarative_base()
 
 
@@ -41,22 +52,73 @@ class Positions(BasePositions):
     created = Column(DateTime, server_default=func.now())
     side = Column(String, nullable=False) # Buy / Sell
 
-    # performance fileds
+    # performance fileds, NUMERIC keeps the exact exchange decimals (read as Decimal)
     orderStatus = Column(Boolean, default=False) # if Filled = true
-    avgPrice = Column(String, nullable=True)   #  execution price
-    cumExecValue = Column(String, nullable=True) # in USDT
-    cumExecQty = Column(String, nullable=True) # '0.683'  QUANTITY in BASECOIN
-    cumExecFee = Column(String, nullable=True) # fee in basecoin
-    triggerPrice = Column(String, nullable=True)  # adding to TP to trail
+    avgPrice = Column(Numeric, nullable=True)   #  execution price
+    cumExecValue = Column(Numeric, nullable=True) # in USDT
+    cumExecQty = Column(Numeric, nullable=True) # 0.683  QUANTITY in BASECOIN
+    cumExecFee = Column(Numeric, nullable=True) # fee in basecoin
+    triggerPrice = Column(Numeric, nullable=True)  # adding to TP to trail
     finished = Column(Boolean, default=False)
 
     #
     user_notified = Column(Boolean, default=False) # upon final performance
 
+    # частичные индексы под горячие выборки циклов торговли и ТП
+    __table_args__ = (
+        # открытые позиции юзера по символу (сигналы, закрытие всех позиций)
+        Index('ix_positions_active_owner_symbol', 'owner_id', 'symbol',
+              postgresql_where=text('finished = false')),
+        # неисполненные ордера (сверка исполнений, трейлинг спот ТП, старые ордера)
+        Index('ix_positions_unfilled_type', 'type', 'order_type',
+              postgresql_where=text('"orderStatus" = false')),
+        # исполненные основные позиции без ТП (первый ТП, усреднение)
+        Index('ix_positions_no_tp_symbol', 'symbol',
+              postgresql_where=text('finished = false AND "orderStatus" = true AND tp_opened = false'
+                                    " AND depends_on = '-1'")),
+        # исполненные незавершенные позиции (ежедневные проверки позиций)
+        Index('ix_positions_filled_open', 'order_type', 'type',
+              postgresql_where=text('finished = false AND "orderStatus" = true')),
+        # зависимые ордера (усреднения, ТП) по материнскому ордеру
+        Index('ix_positions_depends_on', 'depends_on',
+              postgresql_where=text("depends_on <> '-1'")),
+    )
+
+
+NUMERIC_COLUMNS = ('avgPrice', 'cumExecValue', 'cumExecQty', 'cumExecFee', 'triggerPrice')
+
+
+def to_numeric(value):
+    """
+    Converts an exchange value ('0.683', 0.683, '' ...) to Decimal, empty values to None.
+    """
+    if value is None or isinstance(value, Decimal):
+        return value
+    value = str(value).strip()
+    if not value or value == 'None':
+        return None
+    return Decimal(value)
+
+
+def coerce_numeric(data: dict) -> dict:
+    return {key: to_numeric(value) if key in NUMERIC_COLUMNS else value for key, value in data.items()}
+
+
+@lru_cache(maxsize=None)
+def position_record(columns: tuple):
+    """
+    Returns the record type for a set of position columns: a namedtuple
+    (tuple storage, no per-row __dict__) read as row.symbol or row[0].
+    """
+    return namedtuple('PositionRecord', columns)
+
 
 class PositionsOperations:
+    # NOT NULL columns without default, a row needs them to be inserted
+    required_on_insert = ('bybit_id', 'owner_id', 'side')
+
     def __init__(self, database_url: str):
-        self.engine = create_async_engine(database_url, echo=False)
+        self.engine = get_engine(database_url)
         self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
 
     async def table_exists(self, table_name: str) -> bool:
@@ -71,11 +133,64 @@ class PositionsOperations:
         if not await self.table_exists(Positions.__tablename__):
             async with self.engine.begin() as conn:
                 await conn.run_sync(BasePositions.metadata.create_all)
+                await self._install_notify_trigger(conn)
             print(f"Table '{Positions.__tablename__}' created successfully.")
         else:
             print(f"Table '{Positions.__tablename__}' already exists, skipping creation.")
+            await self.migrate()
+
+    async def migrate(self, conn=None):
+        """
+        Brings an existing table to the current schema: NUMERIC price/quantity
+        columns (values that are not numbers become NULL), the partial indexes
+        and the change notification trigger. Runs in conn if given.
+        """
+        if conn is None:
+            async with self.engine.begin() as conn:
+                return await self.migrate(conn)
+
+        result = await conn.execute(text(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = 'positions' AND data_type IN ('character varying', 'text')"
+        ))
+        text_columns = {row[0] for row in result}
+        for column in NUMERIC_COLUMNS:
+            if column in text_columns:
+                await conn.execute(text(
+                    f'ALTER TABLE positions ALTER COLUMN "{column}" TYPE NUMERIC '
+                    f'USING CASE WHEN trim("{column}") ~ \'^[-+]?([0-9]+\\.?[0-9]*|\\.[0-9]+)([eE][-+]?[0-9]+)?$\' '
+                    f'THEN trim("{column}")::numeric END'
+                ))
+                print(f"Column positions.{column} converted to NUMERIC.")
+
+        await conn.run_sync(
+            lambda sync_conn: [index.create(sync_conn, checkfirst=True) for index in Positions.__table__.indexes]
+        )
+        await self._install_notify_trigger(conn)
+
+    @staticmethod
+    async def _install_notify_trigger(conn):
+        # уведомление уходит при коммите любой записи, в том числе пакетной и из чужого процесса
+        await conn.execute(text(f"""
+            CREATE OR REPLACE FUNCTION positions_notify() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    PERFORM pg_notify('{POSITIONS_CHANNEL}', json_build_object('op', TG_OP, 'row', row_to_json(OLD))::text);
+                    RETURN OLD;
+                END IF;
+                PERFORM pg_notify('{POSITIONS_CHANNEL}', json_build_object('op', TG_OP, 'row', row_to_json(NEW))::text);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        """))
+        await conn.execute(text("DROP TRIGGER IF EXISTS positions_notify ON positions"))
+        await conn.execute(text(
+            "CREATE TRIGGER positions_notify AFTER INSERT OR UPDATE OR DELETE ON positions "
+            "FOR EACH ROW EXECUTE FUNCTION positions_notify()"
+        ))
 
     async def upsert_position(self, position_data: dict):
+        position_data = coerce_numeric(position_data)
         async with self.async_session() as session:
             async with session.begin():
                 # Попытка найти существующую запись по bybit_id
@@ -111,6 +226,42 @@ class PositionsOperations:
 
             await session.commit()
 
+    async def merge_averaging(self, bybit_id: str) -> bool:
+        """
+        Adds a filled averaging position to its parent and deletes it, in one
+        transaction. Only the call whose DELETE removed the row merges, so a
+        repeated call for the same fill (e.g. from a stale index) changes nothing.
+        Returns True if merged.
+        """
+        async with self.async_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    delete(Positions)
+                    .where(Positions.bybit_id == bybit_id, Positions.type == 'averaging',
+                           Positions.orderStatus == True)
+                    .returning(Positions.depends_on, Positions.cumExecValue, Positions.cumExecQty,
+                               Positions.cumExecFee)
+                )
+                averaging = result.first()
+                if averaging is None:
+                    return False
+                # зависимые записи удаляются вместе с усредняющей, как в delete_position_by_bybit_id
+                await session.execute(delete(Positions).where(Positions.depends_on == bybit_id))
+
+                parent = (await session.execute(
+                    select(Positions).where(Positions.bybit_id == averaging.depends_on).with_for_update()
+                )).scalar_one_or_none()
+                if parent is None:
+                    return False
+                cum_exec_value = (parent.cumExecValue or 0) + (averaging.cumExecValue or 0)
+                cum_exec_qty = (parent.cumExecQty or 0) + (averaging.cumExecQty or 0)
+                if cum_exec_qty:
+                    parent.avgPrice = cum_exec_value / cum_exec_qty
+                parent.cumExecValue = cum_exec_value
+                parent.cumExecQty = cum_exec_qty
+                parent.cumExecFee = (parent.cumExecFee or 0) + (averaging.cumExecFee or 0)
+            return True
+
     async def get_position_by_bybit_id(self, bybit_id: str) -> Optional[Dict]:
         async with self.async_session() as session:
             result = await session.execute(
@@ -203,6 +354,44 @@ class PositionsOperations:
             return pd.DataFrame(positions_dicts)
 
 
+    def _projection(self, filters: dict, columns):
+        table = Positions.__table__
+        conditions = [table.c[field] == value for field, value in filters.items()]
+        return select(*[table.c[column] for column in columns]).where(and_(*conditions))
+
+    async def select_positions(self, filters: dict, columns, as_tuples: bool = False) -> list:
+        """
+        Lightweight get_positions_by_fields for hot loops: selects only columns,
+        without ORM objects and DataFrame. Returns PositionRecord rows
+        (see position_record) or plain tuples in the order of columns.
+        """
+        columns = tuple(columns)
+        async with self.engine.connect() as conn:
+            result = await conn.execute(self._projection(filters, columns))
+            rows = result.all()
+        if as_tuples:
+            return [tuple(row) for row in rows]
+        make = position_record(columns)._make
+        return [make(row) for row in rows]
+
+    async def select_position_columns(self, filters: dict, columns) -> Dict[str, np.ndarray]:
+        """
+        Columnar variant of select_positions for vectorized consumers:
+        {column: numpy array}. NUMERIC columns come as float64 with NaN for NULL,
+        the rest as object arrays.
+        """
+        columns = tuple(columns)
+        rows = await self.select_positions(filters, columns, as_tuples=True)
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        arrays = {}
+        for column, data in zip(columns, values):
+            if column in NUMERIC_COLUMNS:
+                arrays[column] = np.array([np.nan if value is None else float(value) for value in data],
+                                          dtype=np.float64)
+            else:
+                arrays[column] = np.array(data, dtype=object)
+        return arrays
+
     async def get_old_unfilled_positions(self) -> List[str]:
         async with self.async_session() as session:
             time_threshold = datetime.now() - timedelta(minutes=300)
@@ -218,7 +407,95 @@ class PositionsOperations:
             bybit_ids = result.scalars().all()
             return bybit_ids
 
+    async def mark_filled(self, bybit_id: str, fill: dict) -> bool:
+        """
+        Writes execution fields of a filled order, only while the position is still unfilled.
+        Returns False if there is no such unfilled position, so repeated reports are harmless.
+        """
+        async with self.async_session() as session:
+            async with session.begin():
+                stmt = (update(Positions)
+                        .where(Positions.bybit_id == bybit_id, Positions.orderStatus == False)
+                        .values(orderStatus=True, **coerce_numeric(fill))
+                        .returning(Positions.bybit_id))
+                result = await session.execute(stmt)
+                return result.first() is not None
+
+    async def bulk_upsert_positions(self, positions: list):
+        """
+        Inserts or updates many positions in one transaction. As in upsert_position,
+        only the given columns change on existing rows.
+
+        Rows with every NOT NULL column go through INSERT ... ON CONFLICT (bybit_id)
+        DO UPDATE, rows without them can only update and go through an executemany
+        UPDATE. Either way there is one statement per set of columns.
+        """
+        # несколько записей одной позиции сливаем, иначе ON CONFLICT обновит строку дважды
+        merged = {}
+        for position in positions:
+            merged.setdefault(position['bybit_id'], {}).update(coerce_numeric(position))
+
+        inserts, updates = {}, {}
+        for position in merged.values():
+            keys = tuple(sorted(position))
+            target = inserts if all(column in position for column in self.required_on_insert) else updates
+            target.setdefault(keys, []).append(position)
+
+        async with self.async_session() as session:
+            async with session.begin():
+                for keys, rows in inserts.items():
+                    stmt = insert(Positions).values(rows)
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=['bybit_id'],
+                        set_={key: stmt.excluded[key] for key in keys if key != 'bybit_id'}
+                    )
+                    await session.execute(stmt)
+
+                for keys, rows in updates.items():
+                    columns = [key for key in keys if key != 'bybit_id']
+                    if not columns:
+                        continue
+                    stmt = (update(Positions.__table__)
+                            .where(Positions.bybit_id == bindparam('b_id'))
+                            .values(**{key: bindparam(f'v_{key}') for key in columns}))
+                    params = [{'b_id': row['bybit_id'], **{f'v_{key}': row[key] for key in columns}}
+                              for row in rows]
+                    await session.execute(stmt, params)
+
+    async def mark_filled_many(self, fills: dict):
+        """
+        Batched mark_filled: fills maps bybit_id -> execution fields.
+        All rows go in one transaction, one executemany per set of fields.
+        """
+        groups = {}
+        for bybit_id, fill in fills.items():
+            fill = coerce_numeric(fill)
+            params = {'b_id': bybit_id, **{f'v_{key}': value for key, value in fill.items()}}
+            groups.setdefault(tuple(sorted(fill)), []).append(params)
+
+        async with self.async_session() as session:
+            async with session.begin():
+                for keys, params in groups.items():
+                    stmt = (update(Positions.__table__)
+                            .where(Positions.bybit_id == bindparam('b_id'), Positions.orderStatus == False)
+                            .values(orderStatus=True, **{key: bindparam(f'v_{key}') for key in keys}))
+                    await session.execute(stmt, params)
+
+    async def bulk_mark(self, ids, **fields):
+        """
+        Sets the same fields on every position in ids with one UPDATE.
+        """
+        ids = list(ids)
+        if not ids:
+            return
+        async with self.async_session() as session:
+            async with session.begin():
+                await session.execute(
+                    update(Positions.__table__).where(Positions.bybit_id.in_(ids)).values(**coerce_numeric(fields))
+                )
+
     async def update_position(self, position_data: dict):
+        position_data = coerce_numeric(position_data)
         async with self.async_session() as session:
             async with session.begin():
                 print("Starting upsert operation...")
@@ -247,6 +524,209 @@ class PositionsOperations:
             await session.commit()
             print("Upsert operation committed.")
 
+# состояния открытой позиции, по которым циклы выбирают позиции из OpenPositionsIndex
+OPEN_POSITION_STATES = {
+    # ордер еще не исполнен (сверка исполнений)
+    'unfilled': lambda p: not p.orderStatus,
+    # исполненная основная позиция без ТП (первый ТП, усреднение)
+    'no_tp': lambda p: bool(p.orderStatus) and not p.tp_opened and p.depends_on == '-1',
+    # исполненные усредняющие ордера, ждущие пересчета материнской позиции
+    'averaging': lambda p: p.type == 'averaging' and bool(p.orderStatus),
+    # выставленные, но не исполненные ТП (трейлинг)
+    'open_tp': lambda p: p.type == 'tp' and not p.orderStatus,
+}
+
+POSITION_COLUMNS = tuple(column.name for column in Positions.__table__.columns)
+
+
+class OpenPositionsIndex:
+    """
+    Process-local copy of the unfinished positions, indexed by owner, symbol and state.
+
+    Loaded once, then kept current by the positions_notify trigger: every committed
+    insert, update or delete arrives as a full row on POSITIONS_CHANNEL, so lookups
+    like holds() or in_state() never touch the database. The table is reloaded after
+    a listener reconnect and every refresh_interval seconds as a safety net.
+    Records are PositionRecord rows over POSITION_COLUMNS, treat them as read-only.
+    """
+
+    def __init__(self, database_url: str, refresh_interval=60, barrier_timeout=5):
+        self.database_url = database_url
+        self.positions_op = PositionsOperations(database_url)
+        self.refresh_interval = refresh_interval
+        self.barrier_timeout = barrier_timeout
+        self.version = 0  # grows on every change
+        self._record = position_record(POSITION_COLUMNS)
+        self._positions = {}  # bybit_id -> record
+        self._buckets = defaultdict(set)  # ключ индекса -> bybit_id
+        self._loading = False
+        self._reload_lock = asyncio.Lock()
+        self._pending = []  # уведомления, пришедшие во время полной загрузки
+        self._barriers = {}  # token -> future
+        self._listener = None
+        self._started = None
+        self._tasks = []
+        self.loop = None
+
+    async def start(self):
+        if self._started is None:
+            self._started = asyncio.create_task(self._start())
+        await asyncio.shield(self._started)
+
+    async def _start(self):
+        self._listener = PgListener(self.database_url, {POSITIONS_CHANNEL: self._on_notify},
+                                    on_reconnect=self.reload)
+        self._tasks = [asyncio.create_task(self._listener.run())]
+        # грузим после подписки, иначе изменения между загрузкой и LISTEN потеряются
+        for _ in range(50):
+            if self._listener.connected:
+                break
+            await asyncio.sleep(0.1)
+        await self.reload()
+        self._tasks.append(asyncio.create_task(self._refresh_loop()))
+
+    @staticmethod
+    def _keys(record):
+        keys = [('owner', record.owner_id), ('symbol', record.symbol),
+                ('holding', record.owner_id, record.symbol, record.type)]
+        for state, check in OPEN_POSITION_STATES.items():
+            if check(record):
+                keys += [('state', state), ('state', state, record.symbol)]
+        return keys
+
+    def _add(self, record):
+        self._remove(record.bybit_id)
+        if record.finished:
+            return
+        self._positions[record.bybit_id] = record
+        for key in self._keys(record):
+            self._buckets[key].add(record.bybit_id)
+
+    def _remove(self, bybit_id):
+        record = self._positions.pop(bybit_id, None)
+        if record is None:
+            return
+        for key in self._keys(record):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(bybit_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    async def reload(self):
+        async with self._reload_lock:
+            self._loading = True
+            try:
+                rows = await self.positions_op.select_positions({'finished': False}, POSITION_COLUMNS)
+                self._positions = {}
+                self._buckets = defaultdict(set)
+                for record in rows:
+                    self._add(record)
+            finally:
+                # все, что пришло во время запроса, новее снимка
+                pending, self._pending = self._pending, []
+                self._loading = False
+                for message in pending:
+                    self._apply(message)
+            self.version += 1
+
+    def _on_notify(self, payload: str):
+        message = json.loads(payload, parse_float=Decimal)
+        if self._loading:
+            self._pending.append(message)
+        else:
+            self._apply(message)
+
+    def _apply(self, message):
+        if message.get('op') == 'SYNC':
+            future = self._barriers.pop(message.get('token'), None)
+            if future is not None and not future.done():
+                future.set_result(True)
+            return
+        row = message['row']
+        if message['op'] == 'DELETE':
+            self._remove(row['bybit_id'])
+        else:
+            values = coerce_numeric({column: row.get(column) for column in POSITION_COLUMNS})
+            if isinstance(values.get('created'), str):
+                values['created'] = datetime.fromisoformat(values['created'])
+            self._add(self._record(**values))
+        self.version += 1
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                print('Ошибка сверки индекса открытых позиций', e)
+
+    async def barrier(self):
+        """
+        Waits until every position change committed before the call is applied.
+        The marker NOTIFY is delivered after the notifications of earlier commits.
+        """
+        await self.start()
+        if not self._listener.connected:
+            await self.reload()
+            return
+        token = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._barriers[token] = future
+        try:
+            async with self.positions_op.async_session() as session:
+                async with session.begin():
+                    await notify(session, POSITIONS_CHANNEL, json.dumps({'op': 'SYNC', 'token': token}))
+            await asyncio.wait_for(future, self.barrier_timeout)
+        except Exception as e:
+            print('Барьер индекса позиций не пройден, перечитываем', e)
+            await self.reload()
+        finally:
+            self._barriers.pop(token, None)
+
+    def _select(self, key) -> list:
+        return [self._positions[bybit_id] for bybit_id in self._buckets.get(key, ())]
+
+    def get(self, bybit_id):
+        return self._positions.get(bybit_id)
+
+    def by_owner(self, owner_id) -> list:
+        return self._select(('owner', owner_id))
+
+    def by_symbol(self, symbol) -> list:
+        return self._select(('symbol', symbol))
+
+    def in_state(self, state, symbol=None) -> list:
+        """
+        Positions in one of OPEN_POSITION_STATES, optionally of one symbol.
+        """
+        return self._select(('state', state) if symbol is None else ('state', state, symbol))
+
+    def holds(self, owner_id, symbol, type='main') -> bool:
+        return bool(self._buckets.get(('holding', owner_id, symbol, type)))
+
+    def owners(self, symbol, type='main') -> set:
+        """
+        Owners with an unfinished position of the given type in symbol.
+        """
+        return {record.owner_id for record in self.by_symbol(symbol) if record.type == type}
+
+
+_open_positions_index = None
+
+
+def get_open_positions_index(database_url: str) -> OpenPositionsIndex:
+    """
+    Returns the open positions index of the current process and event loop.
+    """
+    global _open_positions_index
+    loop = asyncio.get_running_loop()
+    if _open_positions_index is None or _open_positions_index.loop is not loop:
+        _open_positions_index = OpenPositionsIndex(database_url)
+        _open_positions_index.loop = loop
+    return _open_positions_index
+
+
 if __name__ == "__main__":
     async def main():
         positions_manager = PositionsOperations(DATABASE_URL)
@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from sqlalchemy import MetaData, text
+
+from code.db.engine import get_engine
+from code.db.alerts import Base as BaseAlerts
+from code.db.newcoins import Base as BaseNewPairs
+from code.db.pairs import BaseSpot, BaseLinear, SpotPairsOperations, LinearPairsOperations, get_instruments
+from code.db.pnl import BasePNL
+from code.db.positions import BasePositions, PositionsOperations, get_open_positions_index
+from code.db.signals import Base as BaseSignals
+from code.db.subscriptions import BaseSubscriptions
+from code.db.tg_channels import BaseChannels
+from code.db.users import BaseUsers, UsersOperations, get_users_cache
+
+# все таблицы бота в одной metadata: один create_all вместо create_table каждой обертки
+SCHEMA = MetaData()
+for base in (BaseSpot, BaseLinear, BaseUsers, BaseChannels, BaseSignals, BasePositions,
+             BasePNL, BaseNewPairs, BaseAlerts, BaseSubscriptions):
+    for table in base.metadata.tables.values():
+        table.to_metadata(SCHEMA)
+
+# ключ advisory lock: одновременные старты ждут друг друга, а не гоняются на DDL
+SCHEMA_LOCK = 2024081701
+
+
+async def prepare_schema(database_url: str):
+    """
+    Creates missing tables and migrates existing ones in one connection and
+    one transaction, so nothing can query a table before it exists.
+    """
+    start = time.monotonic()
+    async with get_engine(database_url).begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK})
+        await conn.run_sync(SCHEMA.create_all, checkfirst=True)
+        await PositionsOperations(database_url).migrate(conn)
+        await UsersOperations(database_url).migrate(conn)
+        await SpotPairsOperations(database_url).migrate(conn)
+        await LinearPairsOperations(database_url).migrate(conn)
+    print(f"Schema of {len(SCHEMA.tables)} tables ready in {time.monotonic() - start:.2f}s.")
+
+
+async def warm_caches(database_url: str):
+    """
+    Loads the process-local caches concurrently: instrument specs, users and
+    open positions. Trading loops call it once before their first iteration.
+    """
+    start = time.monotonic()
+    await asyncio.gather(
+        get_instruments(database_url).start(),
+        get_users_cache(database_url).start(),
+        get_open_positions_index(database_url).start(),
+    )
+    print(f"Caches warmed in {time.monotonic() - start:.2f}s.")
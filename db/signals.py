@@ -10,8 +10,10 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.future import select
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import func
+from code.db.engine import get_engine
+from code.db.notify import PgListener, notify
 
 
 # Загрузка переменных окружения из .env файла
@@ -22,6 +24,9 @@ Base = declarative_base()
 
 DATABASE_URL = os.getenv('database_url')
 
+# NOTIFY channel, fired in the same transaction as a new signal
+SIGNALS_CHANNEL = 'signals_new'
+
 class Signals(Base):
     """
     Represents signals with its settings.
@@ -38,7 +43,7 @@ class Signals(Base):
 
 class SignalsOperations:
     def __init__(self, database_url: str):
-        self.engine = create_async_engine(database_url, echo=False)
+        self.engine = get_engine(database_url)
         self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
 
     async def table_exists(self, table_name: str) -> bool:
@@ -65,6 +70,7 @@ class SignalsOperations:
                     set_=signal_data
                 )
                 await session.execute(stmt)
+                await notify(session, SIGNALS_CHANNEL, signal_data.get('coin', ''))
             await session.commit()
 
     async def get_and_clear_all_signals(self) -> dict:
@@ -83,6 +89,64 @@ class SignalsOperations:
 
                 return signal_data
 
+    async def dequeue_signals(self, limit: int = 50) -> list:
+        """
+        Removes up to limit oldest signals from the queue and returns them in arrival order.
+        Rows locked by another consumer are skipped, so consumers never get the same signal.
+        """
+        async with self.async_session() as session:
+            async with session.begin():
+                queued = (select(Signals.signal_id)
+                          .order_by(Signals.created)
+                          .limit(limit)
+                          .with_for_update(skip_locked=True))
+                stmt = (delete(Signals)
+                        .where(Signals.signal_id.in_(queued.scalar_subquery()))
+                        .returning(Signals.signal_id, Signals.direction, Signals.channel_id,
+                                   Signals.coin, Signals.created))
+                result = await session.execute(stmt)
+                signals = [dict(row._mapping) for row in result]
+
+        return sorted(signals, key=lambda signal: signal['created'])
+
+
+class SignalListener:
+    """
+    Wakes the trading loop as soon as a signal is committed.
+
+    The wait is bounded by timeout, so the caller keeps polling the table at
+    that rate when notifications are lost (e.g. while the listener reconnects).
+    """
+
+    def __init__(self, database_url: str):
+        self.database_url = database_url
+        self._event = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            listener = PgListener(self.database_url, {SIGNALS_CHANNEL: self._on_notify},
+                                  on_reconnect=self._on_reconnect)
+            self._task = asyncio.create_task(listener.run())
+
+    def _on_notify(self, payload: str):
+        self._event.set()
+
+    async def _on_reconnect(self):
+        # пока слушатель был отключен, сигналы могли прийти без уведомления
+        self._event.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Returns True if a signal arrived since the last call, False on timeout.
+        """
+        self.start()
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._event.clear()
+        return True
 
 
 async def main():
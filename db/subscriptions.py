@@ -3,11 +3,12 @@ import os
 import asyncio
 from dotenv import load_dotenv
 from sqlalchemy import Column, String, DateTime, func, insert, text
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.future import select
 
 from sqlalchemy.dialects.postgresql import insert
+from code.db.engine import get_engine
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
@@ -30,7 +31,7 @@ class Subscriptions(BaseSubscriptions):
 
 class SubscriptionsOperations:
     def __init__(self, database_url: str):
-        self.engine = create_async_engine(database_url, echo=False)
+        self.engine = get_engine(database_url)
         self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
 
     async def table_exists(self, table_name: str) -> bool:
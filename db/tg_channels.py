@@ -2,11 +2,12 @@ import os
 import asyncio
 from dotenv import load_dotenv
 from sqlalchemy import Column, String
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.future import select
 from sqlalchemy import Column, String, DateTime, func, text
+from code.db.engine import get_engine
 
 
 # Загрузка переменных окружения из .env файла
@@ -27,7 +28,7 @@ class TgChannels(BaseChannels):
 
 class TgChannelsOperations:
     def __init__(self, database_url: str):
-        self.engine = create_async_engine(database_url, echo=False)
+        self.engine = get_engine(database_url)
         self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
 
     async def table_exists(self, table_name: str) -> bool:
@@ -2,7 +2,7 @@ import os
 import asyncio
 from dotenv import load_dotenv
 from sqlalchemy import Column, String, Boolean, BigInteger, Float, Integer, text, DateTime, func
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.dialects.postgresql import insert
 from typing import List, Dict, Optional
@@ -14,6 +14,9 @@ from typing import Optional
 
 from datetime import datetime, timedelta, timezone
 
+from code.db.notify import PgListener, notify
+from code.db.engine import get_engine
+
 
 
 # Загрузка переменных окружения из .env файла
@@ -23,6 +26,9 @@ load_dotenv()
 # Получение URL базы данных из переменной окружения
 DATABASE_URL = os.getenv('database_url')
 
+# NOTIFY channel for UsersCache, payload is telegram_id
+USERS_CHANNEL = 'users_changed'
+
 
 BaseUsers = declarative_base()
 
@@ -77,11 +83,14 @@ class Users(BaseUsers):
     # Trading pairs
     trading_pairs = Column(JSON, default=list)
 
+    # version stamp for UsersCache
+    updated = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
 
 
 class UsersOperations:
     def __init__(self, database_url: str):
-        self.engine = create_async_engine(database_url, echo=False)
+        self.engine = get_engine(database_url)
         self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
 
     async def table_exists(self, table_name: str) -> bool:
@@ -99,15 +108,14 @@ class UsersOperations:
             print(f"Table '{Users.__tablename__}' created successfully.")
         else:
             print(f"Table '{Users.__tablename__}' already exists, skipping creation.")
+            await self.migrate()
 
-
-    async def create_table(self):
-        if not await self.table_exists(Users.__tablename__):
+    async def migrate(self, conn=None):
+        if conn is None:
             async with self.engine.begin() as conn:
-                await conn.run_sync(BaseUsers.metadata.create_all)
-            print(f"Table '{Users.__tablename__}' created successfully.")
-        else:
-            print(f"Table '{Users.__tablename__}' already exists, skipping creation.")
+                return await self.migrate(conn)
+        # колонка для сверки кэша юзеров, в старых базах ее нет
+        await conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS updated TIMESTAMP DEFAULT now()"))
 
     async def get_user_data(self, telegram_id: int) -> dict:
         async with self.async_session() as session:
@@ -133,15 +141,32 @@ class UsersOperations:
                     return df
                 return None
 
+    async def get_all_users_rows(self) -> List[dict]:
+        async with self.async_session() as session:
+            result = await session.execute(select(Users))
+            return [user.__dict__ for user in result.scalars().all()]
+
+    async def get_users_updated_since(self, stamp) -> List[dict]:
+        async with self.async_session() as session:
+            query = select(Users).where(Users.updated > stamp)
+            result = await session.execute(query)
+            return [user.__dict__ for user in result.scalars().all()]
+
+    async def count_users(self) -> int:
+        async with self.async_session() as session:
+            return await session.scalar(select(func.count()).select_from(Users))
+
     async def upsert_user(self, user_data: dict):
         async with self.async_session() as session:
             async with session.begin():
                 stmt = insert(Users).values(user_data).on_conflict_do_update(
                     index_elements=['telegram_id'],
-                    set_=user_data
+                    set_={**user_data, 'updated': func.now()}
                 )
                 await session.execute(stmt)
+                await notify(session, USERS_CHANNEL, str(user_data['telegram_id']))
             await session.commit()
+        await refresh_local_cache(user_data['telegram_id'])
 
     async def update_user_fields(self, telegram_id: int, fields: dict):
         async with self.async_session() as session:
@@ -153,7 +178,10 @@ class UsersOperations:
                     for key, value in fields.items():
                         setattr(user, key, value)
                     session.add(user)
+                    await session.flush()
+                    await notify(session, USERS_CHANNEL, str(telegram_id))
             await session.commit()
+        await refresh_local_cache(telegram_id)
 
     async def get_active_users(self) -> List[Dict[str, Optional[str]]]:
         async with self.async_session() as session:
@@ -202,7 +230,9 @@ class UsersOperations:
                 # Выполнение удаления
                 query_delete = text("DELETE FROM users WHERE telegram_id = :telegram_id")
                 result_delete = await session.execute(query_delete, {"telegram_id": telegram_id})
+                await notify(session, USERS_CHANNEL, str(telegram_id))
                 await session.commit()
+        await refresh_local_cache(telegram_id)
 
                 # if result_delete.rowcount == 0:
                 #     raise UserNotFoundError(f"User with telegram_id {telegram_id} does not exist.")
@@ -233,6 +263,140 @@ class UsersOperations:
                     'subscription': user.subscription
                 } for user in users]
 
+class UsersCache:
+    """
+    Process-local copy of the users table keyed by telegram_id.
+
+    Changes arrive through NOTIFY users_changed, sent by upsert_user,
+    update_user_fields and delete_user in the same transaction as the write.
+    As a fallback for notifications missed while the listener reconnects,
+    rows with a newer `updated` stamp are reloaded every refresh_interval
+    seconds and a changed row count triggers a full reload.
+    """
+
+    def __init__(self, database_url: str, refresh_interval=30):
+        self.database_url = database_url
+        self.users_op = UsersOperations(database_url)
+        self.refresh_interval = refresh_interval
+        self.version = 0  # grows on every change, consumers rebuild derived data by it
+        self._users = {}
+        self._stamp = None
+        self._frame = None
+        self._frame_version = -1
+        self._started = None
+        self._tasks = []
+        self.loop = None
+
+    async def start(self):
+        if self._started is None:
+            self._started = asyncio.create_task(self._start())
+        await asyncio.shield(self._started)
+
+    async def _start(self):
+        await self.reload()
+        listener = PgListener(self.database_url, {USERS_CHANNEL: self._on_notify},
+                              on_reconnect=self.reload)
+        self._tasks = [
+            asyncio.create_task(listener.run()),
+            asyncio.create_task(self._refresh_loop()),
+        ]
+
+    def _store(self, user: dict):
+        user = {key: value for key, value in user.items() if key != '_sa_instance_state'}
+        self._users[user['telegram_id']] = user
+        if user.get('updated') and (self._stamp is None or user['updated'] > self._stamp):
+            self._stamp = user['updated']
+
+    async def reload(self):
+        users = await self.users_op.get_all_users_rows()
+        self._users = {}
+        for user in users:
+            self._store(user)
+        self.version += 1
+
+    async def reload_user(self, telegram_id: int):
+        user = await self.users_op.get_user_data(telegram_id)
+        if user:
+            self._store(user)
+        else:
+            self._users.pop(telegram_id, None)
+        self.version += 1
+
+    def _on_notify(self, payload: str):
+        self._tasks.append(asyncio.create_task(self.reload_user(int(payload))))
+        self._tasks = [task for task in self._tasks if not task.done()]
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                if await self.users_op.count_users() != len(self._users):
+                    await self.reload()
+                    continue
+                if self._stamp is not None:
+                    changed = await self.users_op.get_users_updated_since(self._stamp)
+                    for user in changed:
+                        self._store(user)
+                    if changed:
+                        self.version += 1
+            except Exception as e:
+                print('Ошибка сверки кэша юзеров', e)
+
+    async def get_user_data(self, telegram_id: int) -> dict:
+        await self.start()
+        user = self._users.get(telegram_id)
+        if user is None:
+            # юзер мог появиться до того, как пришло уведомление
+            await self.reload_user(telegram_id)
+            user = self._users.get(telegram_id)
+        return dict(user) if user else {}
+
+    async def get_all_users_data(self) -> Optional[pd.DataFrame]:
+        """
+        Same result as UsersOperations.get_all_users_data, rebuilt only after changes.
+        Treat the frame as read-only, it is shared between calls.
+        """
+        await self.start()
+        if self._frame_version != self.version:
+            self._frame = pd.DataFrame(list(self._users.values())) if self._users else None
+            self._frame_version = self.version
+        return self._frame
+
+
+_users_cache = None
+
+
+async def refresh_local_cache(telegram_id: int):
+    """
+    Write-through for the users cache of this process: a write is visible to the
+    next read right away, without waiting for its NOTIFY. Other processes still
+    get it by the notification.
+    """
+    # синглтон берем из code.db.users: модуль может быть импортирован и как db.users
+    from code.db import users
+    cache = users._users_cache
+    if cache is None or cache._started is None:
+        return
+    try:
+        if cache.loop is not asyncio.get_running_loop():
+            return
+        await cache.reload_user(telegram_id)
+    except Exception as e:
+        print('Ошибка обновления кэша юзеров', e)
+
+
+def get_users_cache(database_url: str) -> UsersCache:
+    """
+    Returns the users cache of the current process and event loop.
+    """
+    global _users_cache
+    loop = asyncio.get_running_loop()
+    if _users_cache is None or _users_cache.loop is not loop:
+        _users_cache = UsersCache(database_url)
+        _users_cache.loop = loop
+    return _users_cache
+
+
 if __name__ == '__main__':
     async def main():
         db_users = UsersOperations(DATABASE_URL)
@@ -11,32 +11,45 @@ filterwarnings("ignore")
 
 from datetime import datetime, timedelta, timezone
 
-from multiprocessing import Process, Queue
 from dotenv import load_dotenv
 
 import traceback
 import uuid
+from collections import defaultdict
+
+import numpy as np
 
 from logger_config import setup_logger, log_error
 
 
 
-from db.pairs import SpotPairsOperations, LinearPairsOperations
+from db.pairs import SpotPairsOperations, LinearPairsOperations, PairsRefresher
+from code.db.pairs import get_instruments
 from db.users import UsersOperations
+from code.db.users import get_users_cache
 from db.tg_channels import TgChannelsOperations
-from db.signals import SignalsOperations
+from db.signals import SignalsOperations, SignalListener
 from db.pnl import PNLManager
 from db.positions import PositionsOperations
+from code.db.positions import get_open_positions_index
+from code.db.schema import prepare_schema, warm_caches
 from db.newcoins import NewPairsOperations
 from db.alerts import AlertsOperations
 
-from api.market import process_spot_linear_settings, get_prices
-
-from api.account import get_wallet_balance, find_usdt_budget, get_user_orders, get_user_positions, cancel_order_by_id, get_order_by_id
-from api.utils import calculate_purchase_volume, round_price, adjust_quantity
+from code.api.client import run_with_client
+from supervisor import Supervisor, beating
+from api.market import SharedPriceBook, TickerStream
+from api.cohort import CohortSelector
+from api.budget import BudgetService
+from api.private_stream import PrivateStreamManager
+from api.reconcile import gather_limited, gather_keyed, collect_filled_orders
+from api.triggers import TpTriggerEngine, AmendScheduler
+
+from api.account import get_wallet_balance, get_user_positions, cancel_order_by_id, get_order_by_id
+from api.utils import round_price, adjust_quantity, calculate_purchase_volumes, round_prices
 from api.trade import (universal_spot_conditional_limit_order, unuversal_linear_conditional_market_order,
                        amend_spot_conditional_market_order, universal_market_order, set_tp_linears,
-                       universal_spot_conditional_market_order, set_lev_linears)
+                       universal_spot_conditional_market_order, set_lev_linears_by_settings)
 
 from tg.main_func import start_bot
 import code.settings as st
@@ -63,651 +76,592 @@ user_orders_demo_url = demo_url + st.ENDPOINTS.get('get_orders')
 amend_order_trade_url = trade_url + st.ENDPOINTS.get('amend_order')
 amend_order_demo_url = demo_url + st.ENDPOINTS.get('amend_order')
 
-# Create a global queue to store the price data
-price_queue = Queue()
-
-
-async def on_start(db_spot_pairs, db_linear_pairs, db_users, db_tg_channels, db_signals, db_positions):
-    # Асинхронно создаем таблицы и получаем все торгуемые пары спот и фьюч с их настройками
-    tasks = [
-        asyncio.create_task(process_spot_linear_settings()),
-        asyncio.create_task(db_spot_pairs.create_table()),
-        asyncio.create_task(db_linear_pairs.create_table()),
-        asyncio.create_task(db_users.create_table()),
-        asyncio.create_task(db_tg_channels.create_table()),
-        asyncio.create_task(db_signals.create_table()),
-        asyncio.create_task(db_positions.create_table()),
-    ]
-
-    tasks_res = await asyncio.gather(*tasks)
-
-    # Вносим в базу данных все настройки
-    # Периодически обновлять
-    tasks = [
-        asyncio.create_task(db_spot_pairs.insert_spot_pairs(tasks_res[0][0])),
-        asyncio.create_task(db_linear_pairs.insert_linear_pairs(tasks_res[0][1])),
-    ]
-    await asyncio.gather(*tasks)
-    await start_bot()
-
-async def trade_performance(database_url, price_queue):
-    signals_op = SignalsOperations(database_url)
-    db_tg_channels = TgChannelsOperations(database_url)
-    users_op = UsersOperations(database_url)
-    spot_set_op = SpotPairsOperations(database_url)
-    lin_set_op = LinearPairsOperations(database_url)
-    positions_op = PositionsOperations(database_url)
-    new_pairs_op = NewPairsOperations(database_url)
 
+async def startup(database_url, price_book):
+    """
+    Cold start before the trading loops: schema, pair settings and first prices.
+    """
+    start = time.monotonic()
+    # все таблицы и миграции одним соединением, до старта любого цикла
+    await prepare_schema(database_url)
 
-    while True:
+    async def refresh_pairs():
+        # пишутся только изменившиеся пары, ежедневно обновляются в daily_task
         try:
-            # ####### SIGNAL LOGIC STARTS HERE ########
-            #               ############
-            #                   #####
-
-            signal = await signals_op.get_and_clear_all_signals()
-            users = await users_op.get_all_users_data()
-            # users = await users_op.get_all_users_data()
-
-            # get users settings coin settings etc
-
-
-
-            if signal:
-                coin = signal[next(iter(signal))]['coin']
-                signal_details = (signal[next(iter(signal))]['direction'],
-                                  coin,
-                                  signal[next(iter(signal))]['channel_id'])
-
-                print('New signal received', signal_details)
-                # print(signal)
-
-                #################### GATHER REQUESTS #######################
-                averaging_channels = await db_tg_channels.get_all_channels()
-                spot_data = await spot_set_op.get_all_spot_pairs_data()
-                linear_data = await lin_set_op.get_all_linear_pairs_data()
-                new_pairs = await new_pairs_op.get_all_names()
-                #print(new_pairs)
-                open_positions_all_us = await positions_op.get_positions_by_fields(
-                    {'finished': False,
-                     'type': 'main'},
-                )
-
-                # get USERS SETTINGS
-
-
-
-                # print(averaging_channels)
-                if signal_details[2] in averaging_channels:
-                    averaging = True  # averaging trade logic
-                    print('Signal type - averaging')
-                else:
-                    averaging = False  # main trade logic
-                    print('Signal type - ordinary')
-
-                if signal_details[2] == "-1002216581782":
-                    print('unknown channel', signal_details[2])
-                    continue
-
-                spot_prices, linear_prices = price_queue.get()
-
-
-                # Получаем доступные бюджеты для всех пользователей (real и demo)
-                tasks_budget = []
-                user_task_map = {}
-
-                for index, row in users.iterrows():
-                    user_id = row['telegram_id']
-
-                    if row['trade_type'] == 'demo':
-                        # url = demo_url + st.ENDPOINTS.get('wallet-balance')
-                        task = asyncio.create_task(find_usdt_budget(user_id, demo=True))
-                    else:
-                        # url = trade_url + st.ENDPOINTS.get('wallet-balance')
-                        task = asyncio.create_task(find_usdt_budget(user_id, demo=False))
-
-                    tasks_budget.append(task)
-                    user_task_map[task] = user_id
-
-                budget_results = await asyncio.gather(*tasks_budget)
-                budget_map = {user_task_map[task]: result for task, result in zip(tasks_budget, budget_results)}
-                symbol = coin.upper() + 'USDT'
-                # print('coin.upper() - на уровне сигнала', coin.upper())
-                # print('symbol - на уровне сигнала', symbol)
-                # print('budget_map - на уровне сигнала', budget_map)
-
-            #               #####
-            #           ############
-            # ####### SIGNAL LOGIC ENDS HERE ########
-
-                # ####### START MAIN TRADE LOGIC ########
-                #              ############
-                #                 #####
+            print_pairs_reports(await PairsRefresher(SpotPairsOperations(database_url),
+                                                     LinearPairsOperations(database_url)).refresh_all())
+        except Exception as e:
+            # остаются настройки прошлого запуска
+            log_error(logger, "startup", e)
+
+    async def wait_prices():
+        # книгу цен наполняет процесс update_prices, запущенный раньше
+        deadline = time.monotonic() + st.STARTUP['price_timeout']
+        while not (price_book.symbols('spot') and price_book.symbols('linear')):
+            if time.monotonic() > deadline:
+                print('Цены не получены, торговля стартует без них')
+                return
+            await asyncio.sleep(0.1)
+
+    await asyncio.gather(refresh_pairs(), wait_prices())
+    print(f'Старт готов за {time.monotonic() - start:.2f} c')
+
+
+def print_pairs_reports(reports):
+    # reports - результаты insert_spot_pairs и insert_linear_pairs
+    for market, report in zip(('spot', 'linear'), reports):
+        print(f'Настройки пар {market}: добавлено {len(report["added"])}, изменено {len(report["changed"])}, '
+              f'делистинг {len(report["delisted"])}')
+        if report['delisted']:
+            print(f'Делистинг {market}:', ', '.join(report['delisted']))
+
+async def run_limited(semaphore, coro):
+    async with semaphore:
+        return await coro
+
+
+async def save_positions(positions_op, positions, what):
+    """
+    Writes positions with one bulk upsert, retried once on failure.
+    """
+    if not positions:
+        return True
+    try:
+        await positions_op.bulk_upsert_positions(positions)
+        return True
+    except Exception as e:
+        print(f"Ошибка при вставке позиций {[pos['bybit_id'] for pos in positions]}: {e}")
+        try:
+            # Повторная попытка вставки
+            await positions_op.bulk_upsert_positions(positions)
+            return True
+        except Exception as e:
+            print(f"Повторная попытка не удалась для позиций {[pos['bybit_id'] for pos in positions]}: {e}")
+            log_error(logger, f"Не удалось записать позиции: {what}", e)
+            return False
 
-                # проверять список монет, проверять подписку
 
-                if not averaging:
-                    print('Start main trade logic')
+async def dispatch_signals(signals, process, max_coins):
+    """
+    Runs signals of one coin one after another in arrival order,
+    signals of different coins concurrently, at most max_coins at a time.
+    """
+    groups = {}
+    for signal in signals:
+        groups.setdefault(signal['coin'].upper(), []).append(signal)
 
-                    # Разделяем пользователей на спотовых и линейных
-                    users_spot = users[users['spot'] == True]
-                    users_linear = users[users['spot'] != True]
+    coins_limit = asyncio.Semaphore(max_coins)
 
-                    tasks = []
+    async def run_group(group):
+        async with coins_limit:
+            for signal in group:
+                try:
+                    await process(signal)
+                except Exception as e:
+                    print(f"Ошибка при обработке сигнала {signal}: {e}")
+                    log_error(logger, "Ошибка при обработке сигнала", e)
+                    if "too many clients already" in str(e):
+                        log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
+                        sys.exit()
 
-                    # по торговой стратегии у спота могут быть только лонги
-                    spot_price = spot_prices.get(symbol)
+    await asyncio.gather(*[run_group(group) for group in groups.values()])
 
-                    if signal_details[0] == 'buy' and spot_price:
-                        print('Start spot long', symbol, spot_price)
 
-                        # Получаем спотовые торговые настройки для символа
-                        spot_settings = spot_data.get(coin.upper())
-                        spot_min_volume = spot_settings.get('min_order_qty')
-                        spot_qty_tick = spot_settings.get('base_precision')
-                        spot_price_tick = spot_settings.get('tick_size')
+async def process_signal(signal, batch, positions_op, price_book, user_limits, budgets):
+    """
+    Places main or averaging orders of all eligible users for one signal.
+    batch holds the data shared by one dequeued batch: users, averaging_channels,
+    spot_data, linear_data, new_pairs and the CohortSelector of the users.
+    Orders of one user are bounded by the user's semaphore in user_limits,
+    balances come from the BudgetService budgets.
+    """
+    users = batch['users']
+    spot_data = batch['spot_data']
+    linear_data = batch['linear_data']
+    new_pairs = batch['new_pairs']
 
-                        for_spot_orders = {}
-                        # Создаем заказы для пользователей
-                        for user_id in users_spot['telegram_id']:
-                            user = users[users['telegram_id'] == user_id]
-                            #print('user in spot buy', user)
-                            # На уровне канала и спот бай проверяем настройки и подписку юзера
-                            if int(time.time()) > user['subscription'].iloc[0]:
-                                print('Подписка истекла - алерт юзеру')
-                                continue
-                            if user['stop_trading'].iloc[0]:
-                                continue
-                            try:
-                                users_positions = open_positions_all_us[
-                                    open_positions_all_us['owner_id'] == user_id]['symbol'].to_list()
-                                users_positions = list(set(users_positions))
-                            except:
-                                users_positions = []
-                            #print('users_positions', users_positions)
-                            if symbol in users_positions:
-                                print('Спот этот символ уже открыт у юзера', symbol)
-                                continue
-                            # если у юзера подключены  new pairs  проверяем
+    coin = signal['coin']
+    signal_details = (signal['direction'],
+                      coin,
+                      signal['channel_id'])
 
-                            print(user['trading_pairs'].iloc[0])
-                            if user['trading_pairs'].iloc[0] and symbol not in user['trading_pairs'].iloc[
-                                0] and '-1' not in user['trading_pairs'].iloc[0]:
-                                print('not in trading pairs')
-                                continue
-                            if "-1" in user['trading_pairs'].iloc[0]:
-                                # print('new_pairs', new_pairs)
-                                if symbol not in new_pairs:
-                                    continue
+    print('New signal received', signal_details)
 
+    # открытые позиции берем из индекса в памяти; барьер дожидается записей
+    # предыдущего сигнала по этой монете, иначе откроем позицию повторно
+    open_index = batch['open_positions']
+    await open_index.barrier()
 
-                            # считаем на какой процент (1.001/1.01) и т.п. нужно увеличить цену чтобы лонговать, настройка trade_pair_if
-                            trade_pair_if_buy = float(users[users['telegram_id'] == user_id]['trade_pair_if']) / 100 + 1
-                            # допускаемое проскальзывание
-                            trade_pair_if_slip_buy = float(
-                                users[users['telegram_id'] == user_id]['trade_pair_if']) / 100 + 1.002
+    if signal_details[2] in batch['averaging_channels']:
+        averaging = True  # averaging trade logic
+        print('Signal type - averaging')
+    else:
+        averaging = False  # main trade logic
+        print('Signal type - ordinary')
 
-                            # рассчитываем сумму позиции как наименьшее доступный бюджет USDT и настройка min_trade
-                            sum_amount = min(float(users[users['telegram_id'] == user_id]['min_trade']),
-                                             float(budget_map[user_id]))
-                            # рассчитываем кастомной функцией тригерную цену для conditional spot order и цену с учетом проскальзывания
-                            trigger_price = round_price(float(spot_price) * trade_pair_if_buy, float(spot_price_tick))
-                            price = round_price(float(spot_price) * trade_pair_if_slip_buy, float(spot_price_tick))
+    if signal_details[2] == "-1002216581782":
+        print('unknown channel', signal_details[2])
+        return
 
-                            # Рассчитываем количнство монеты к покупке с учетом сеттингов монеты
-                            qty_info_spot = calculate_purchase_volume(sum_amount, spot_price, spot_min_volume,
-                                                                      spot_qty_tick)
+    spot_prices, linear_prices = price_book.views()
 
-                            #print('Покупка для спот лонга', users[users['telegram_id'] == user_id]['username'], sum_amount, trigger_price, qty_info_spot)
-                            # если функция возвращает отриц значение значит сумма недостаточ - пропуск для этого юзера
-                            if qty_info_spot < 0:
-                                continue
 
-                            # Сохраняем данные для ордеров
-                            for_spot_orders[user_id] = {
-                                'sum_amount': sum_amount,
-                                'qty_info': qty_info_spot,
-                                'price': price,
-                                'triggerPrice': trigger_price,
+    # доступные бюджеты всех пользователей (real и demo) из фонового BudgetService,
+    # с биржи запрашиваются только отсутствующие или устаревшие
+    budget_map = await budgets.budget_map(users)
+    symbol = coin.upper() + 'USDT'
 
-                            }
+    #               #####
+    #           ############
+    # ####### SIGNAL LOGIC ENDS HERE ########
 
-                        # Формируем и отправляем ордера
-                        #tasks = []
-                        #print('for_spot_orders', for_spot_orders)
-                        for user_id, order_data in for_spot_orders.items():
-                            user_info = users_spot[users_spot['telegram_id'] == user_id].iloc[0]
-
-                            # Определяем URL и ключи в зависимости от типа аккаунта
-                            api_url = order_demo_url if user_info['trade_type'] == 'demo' else order_trade_url
-                            api_key = user_info['demo_api_key'] if user_info['trade_type'] == 'demo' else \
-                                user_info['main_api_key']
-                            secret_key = user_info['demo_secret_key'] if user_info['trade_type'] == 'demo' else \
-                                user_info['main_secret_key']
-                            orderLinkId = f'{user_id}_demo_spot_{uuid.uuid4().hex[:12]}' if user_info[
-                                                                                                'trade_type'] == 'demo' else \
-                                f'{user_id}_real_spot_{uuid.uuid4().hex[:12]}'
-                            # print('Задача на ордер', api_url, api_key, secret_key, symbol, 'Buy', order_data['qty_info'],
-                            #       order_data['price'], order_data['triggerPrice'], orderLinkId)
-                            # Создаем задачу для выполнения ордера
-                            task = asyncio.create_task(
-                                universal_spot_conditional_limit_order(
-                                    api_url, api_key, secret_key, symbol, 'Buy',
-                                    order_data['qty_info'], order_data['price'], order_data['triggerPrice'],
-                                    orderLinkId
-                                )
-                            )
-                            tasks.append(task)
-                            #print('tasks', tasks)
+    # ####### START MAIN TRADE LOGIC ########
+    #              ############
+    #                 #####
 
+    # проверять список монет, проверять подписку
 
-                    ###### linears
-                    # по торговой стратегии у фьючей могут быть и лонги и шорты
-                    linear_price = linear_prices.get(coin.upper() + 'USDT', None)
-                    try:
-                        linear_settings = linear_data.get(coin.upper())
-                        linear_min_volume = linear_settings.get('min_order_qty')
-                        linear_qty_tick = linear_settings.get('qty_step')
-                        linear_price_tick = linear_settings.get('price_tick_size')
-                    except Exception as e:
-                        linear_min_volume = None
-                        print('Ошибка в получении linear_settings', e)
+    if not averaging:
+        print('Start main trade logic')
 
+        tasks = []
 
-                    if linear_price and linear_min_volume:
-                        print('Start linear long', linear_price)
+        # по торговой стратегии у спота могут быть только лонги
+        spot_price = spot_prices.get(symbol)
+
+        if signal_details[0] == 'buy' and spot_price:
+            print('Start spot long', symbol, spot_price)
+
+            # Получаем спотовые торговые настройки для символа
+            spot_settings = spot_data.get(coin.upper())
+            spot_min_volume = spot_settings.min_qty
+            spot_qty_tick = spot_settings.qty_step
+            spot_price_tick = spot_settings.price_tick
+
+            # юзеры, которым можно торговать этот сигнал, с исходными данными для расчета ордера
+            cohort = batch['cohorts'].select(symbol, 'spot', open_index.owners(symbol), budget_map)
+            print('Spot cohort', symbol, len(cohort))
+
+            # считаем для всей когорты сразу: на какой процент (1.001/1.01) и т.п. нужно увеличить цену
+            # чтобы лонговать (настройка trade_pair_if) и цену с допускаемым проскальзыванием
+            trade_pair_if = cohort['trade_pair_if'].to_numpy() / 100
+            trigger_prices = round_prices(float(spot_price) * (trade_pair_if + 1), spot_price_tick)
+            prices = round_prices(float(spot_price) * (trade_pair_if + 1.002), spot_price_tick)
+
+            # количество монеты к покупке с учетом сеттингов монеты, -1 - сумма недостаточна
+            qtys = calculate_purchase_volumes(cohort['sum_amount'], float(spot_price), spot_min_volume,
+                                              spot_qty_tick)
+
+            # Создаем заказы для пользователей
+            for user, trigger_price, price, qty_info_spot in zip(cohort.itertuples(index=False),
+                                                                 trigger_prices, prices, qtys):
+                # если объем отрицательный значит сумма недостаточна - пропуск для этого юзера
+                if qty_info_spot < 0:
+                    continue
 
-                        # Получаем фьючерсные торговые настройки для символа
-                        linear_settings = linear_data.get(coin.upper())
+                user_id = user.telegram_id
+                orderLinkId = f'{user_id}_demo_spot_{uuid.uuid4().hex[:12]}' if user.trade_type == 'demo' else \
+                    f'{user_id}_real_spot_{uuid.uuid4().hex[:12]}'
+                api_url = order_demo_url if user.trade_type == 'demo' else order_trade_url
+
+                # Создаем задачу для выполнения ордера
+                task = asyncio.create_task(run_limited(
+                    user_limits[user_id],
+                    universal_spot_conditional_limit_order(
+                        api_url, user.api_key, user.secret_key, symbol, 'Buy',
+                        float(qty_info_spot), float(price), float(trigger_price),
+                        orderLinkId
+                    )
+                ))
+                tasks.append(task)
+
+
+        ###### linears
+        # по торговой стратегии у фьючей могут быть и лонги и шорты
+        linear_price = linear_prices.get(coin.upper() + 'USDT', None)
+        try:
+            linear_settings = linear_data.get(coin.upper())
+            linear_min_volume = linear_settings.min_qty
+            linear_qty_tick = linear_settings.qty_step
+            linear_price_tick = linear_settings.price_tick
+        except Exception as e:
+            linear_min_volume = None
+            print('Ошибка в получении linear_settings', e)
 
-                        #linear_min_volume = linear_settings.get('min_order_qty')
-                        #linear_qty_tick = linear_settings.get('qty_step')
-                        #linear_price_tick = linear_settings.get('price_tick_size')
-                        # print(linear_min_volume, linear_qty_tick, linear_price_tick)
 
-                        for_linear_orders = {}
+        if linear_price and linear_min_volume:
+            print('Start linear long', linear_price)
 
-                        for user_id in users_linear['telegram_id']:
-                            user_set = users[users['telegram_id'] == user_id].iloc[0]
+            # Получаем фьючерсные торговые настройки для символа
+            linear_settings = linear_data.get(coin.upper())
 
-                            # На уровне канала и линеар лонг/шорт проверяем настройки и подписку юзера
-                            if int(time.time()) > user_set['subscription']:
-                                print('Подписка истекла - алерт юзеру')
-                                continue
-                            if user_set['stop_trading']:
-                                continue
-                            try:
-                                users_positions = open_positions_all_us[
-                                    open_positions_all_us['owner_id'] == user_id]['symbol'].to_list()
-                                users_positions = list(set(users_positions))
-                                #print('users_positions', users_positions)
-                            except:
-                                users_positions = []
-                            # print('users_positions', users_positions)
-                            if symbol in users_positions:
-                                print('Фьюч этот символ уже открыт у юзера', symbol)
-                                continue
+            #linear_min_volume = linear_settings.get('min_order_qty')
+            #linear_qty_tick = linear_settings.get('qty_step')
+            #linear_price_tick = linear_settings.get('price_tick_size')
+            # print(linear_min_volume, linear_qty_tick, linear_price_tick)
 
+            if signal_details[0] == 'buy':
+                print('покупаем фьюч')
+                side = 'Buy'
+                triggerDirection = 1
+            else:
+                print('Продаем')
+                side = 'Sell'
+                triggerDirection = 2
+
+            # юзеры, которым можно торговать этот сигнал, с исходными данными для расчета ордера
+            cohort = batch['cohorts'].select(symbol, 'linear', open_index.owners(symbol), budget_map)
+            print('Linear cohort', symbol, len(cohort))
+
+            # тригерная цена для conditional linear order по всей когорте сразу:
+            # на сколько процентов (настройка trade_pair_if) цена должна сдвинуться в сторону сделки
+            trade_pair_if = cohort['trade_pair_if'].to_numpy() / 100
+            if side == 'Buy':
+                tp_min_buy = trade_pair_if + 1
+            else:
+                tp_min_buy = np.abs(trade_pair_if - 1)
+            trigger_prices = round_prices(float(linear_price) * tp_min_buy, linear_price_tick)
 
-                            if (user_set['trading_pairs'] and symbol not in user_set['trading_pairs']
-                                    and '-1' not in user_set['trading_pairs']):
-                                print('not in trading pairs')
-                                continue
-                            if "-1" in user_set['trading_pairs']:
-                                #print('new_pairs', new_pairs)
-                                # print(symbol)
-                                if symbol not in new_pairs:
-                                    continue
+            # сумма позиции - наименьшее из доступного бюджета USDT и настройки min_trade (sum_amount когорты)
+            # ВНИМАНИЕ! Плечо в расчет не берется, оно позволяет только открыть больше позиций
+            qtys = calculate_purchase_volumes(cohort['sum_amount'], trigger_prices, linear_min_volume,
+                                              linear_qty_tick)
 
+            for user, trigger_price_value, qty_info in zip(cohort.itertuples(index=False), trigger_prices, qtys):
+                # если объем отрицательный значит сумма недостаточна - пропуск для этого юзера
+                if qty_info < 0:
+                    continue
 
+                user_id = user.telegram_id
+                api_url = order_demo_url if user.trade_type == 'demo' else order_trade_url
+                orderLinkId = f'{user_id}_demo_linear_{uuid.uuid4().hex[:12]}' if user.trade_type == 'demo' else \
+                    f'{user_id}_real_linear_{uuid.uuid4().hex[:12]}'
+
+                # Создаем задачу для выполнения фьючерсного ордера
+                task = asyncio.create_task(run_limited(
+                    user_limits[user_id],
+                    unuversal_linear_conditional_market_order(
+                        api_url, user.api_key, user.secret_key, symbol, side,
+                        float(qty_info), float(trigger_price_value),
+                        triggerDirection, orderLinkId
+                    )
+                ))
+                tasks.append(task)
+
+        # Выполняем все задачи спот/линеар лонг/шорт параллельно и собираем результаты
+        results = await asyncio.gather(*tasks)
+        # print(results)
+        if signal_details[0] == 'buy':
+            side = 'Buy'
+        else:
+            side = 'Sell'
+
+
+
+        # все размещенные ордера сигнала пишем в БД одним запросом
+        new_positions = []
+
+        for position in results:
+            if isinstance(position, dict) and position.get('retMsg') == 'OK':
+                print(position)
+                res = position.get('result')
+                print(res)
+                orderLinkId = res.get('orderLinkId')
+                details = orderLinkId.split('_')
+
+                new_positions.append({
+                    "bybit_id": orderLinkId,
+                    "owner_id": int(details[0]),
+                    "market": details[1],
+                    "order_type": details[2],
+                    "symbol": symbol,
+                    "side": side,
+                })
+
+        await save_positions(positions_op, new_positions, 'сигнал')
+
+
+    #####################################################
+
+    #                    #####
+    #                ############
+    # ####### STOP MAIN TRADE LOGIC ########
+
+
+    # ####### START AVERAGING TRADE LOGIC ########
+    #               ############
+    #                   #####
+    if averaging:
+        print('Start averaging logic')
+        symbol = coin.upper() + 'USDT'
+        # получаем открытые (выкупленные) позиции, которые не завершены,
+        # у которых еще не тригернулся ТП, исполнен первоначальный ордер на покупку и у которых совпадает символ
+        try:
+            closed_positions_no_tp = open_index.in_state('no_tp', symbol)
 
-                            if signal_details[0] == 'buy':
-                                print('покупаем фьюч')
-                                # считаем на какой процент (1.001/1.01) и т.п. нужно увеличить цену чтобы лонговать, настройка trade_pair_if
-                                tp_min_buy = float(users[users['telegram_id'] == user_id]['trade_pair_if']) / 100 + 1
-                                side = 'Buy'
-                                triggerDirection = 1
-
-                            if signal_details[0] == 'sell':
-                                print('Продаем')
-                                # считаем на какой процент (99.9/99.99) и т.п. нужно уменьшить цену чтобы шортить, настройка trade_pair_if
-                                tp_min_buy = abs(float(user_set['trade_pair_if']) / 100 - 1)
-                                side = 'Sell'
-                                triggerDirection = 2
-
-                            # рассчитываем сумму позиции как наименьшее доступный бюджет USDT и настройка min_trade
-                            # ВНИМАНИЕ! Плечо в расчет не берется, оно позволяет только открыть больше позиций
-                            sum_amount = min(float(user_set['min_trade']), float(budget_map[user_id]))
-
-                            # рассчитываем кастомной функцией тригерную цену для conditional linear order
-                            # tp_min_buy уже учитывает в какую сторону должна двигаться цена
-                            trigger_price_value = round_price(float(linear_price) * tp_min_buy,
-                                                              float(linear_price_tick))
-
-                            # Рассчитываем количество монеты к покупке с учетом сеттингов монеты
-                            qty_info = calculate_purchase_volume(sum_amount, trigger_price_value, linear_min_volume,
-                                                                 linear_qty_tick)
-                            print('qty_info', qty_info)
-                            # если функция возвращает отриц значение значит сумма недостаточ - пропуск для этого юзера
-                            if qty_info < 0:
-                                continue
-                            # Сохраняем данные для ордеров
-                            for_linear_orders[user_id] = {
-                                'sum_amount': sum_amount,
-                                'triggerPrice': trigger_price_value,
-                                # 'price': price_value,
-                                'qty_info': qty_info
-                            }
+            if not closed_positions_no_tp:
+                print('Нет открытых позиций для укрупнения')
+                return
 
-                        # Формируем и отправляем ордера
-                        #tasks = []
+            if signal_details[0] == 'buy':
+                side = 'Buy'
+            else:
+                side = 'Sell'
 
+            spot_price = spot_prices.get(symbol)
+            linear_price = linear_prices.get(symbol)
 
-                        for user_id, order_data in for_linear_orders.items():
-                            user_info = users_linear[users_linear['telegram_id'] == user_id].iloc[0]
+            # чась символов может быть только в споте или только фьючах
+            try:
+                spot_settings = spot_data.get(coin.upper())
+                spot_min_volume = spot_settings.min_qty
+                spot_qty_tick = spot_settings.qty_step
+            except:
+                pass
 
-                            # Определяем URL и ключи в зависимости от типа аккаунта
-                            api_url = order_demo_url if user_info['trade_type'] == 'demo' else order_trade_url
-                            api_key = user_info['demo_api_key'] if user_info['trade_type'] == 'demo' else user_info[
-                                'main_api_key']
-                            secret_key = user_info['demo_secret_key'] if user_info['trade_type'] == 'demo' else \
-                                user_info['main_secret_key']
+            try:
+                linear_settings = linear_data.get(coin.upper())
+                linear_min_volume = linear_settings.min_qty
+                linear_qty_tick = linear_settings.qty_step
+            except:
+                pass
 
-                            orderLinkId = f'{user_id}_demo_linear_{uuid.uuid4().hex[:12]}' if user_info[
-                                                                                                  'trade_type'] == 'demo' else \
-                                f'{user_id}_real_linear_{uuid.uuid4().hex[:12]}'
+            print('Проверяем условия усреднения')
 
-                            # Создаем задачу для выполнения фьючерсного ордера
-                            task = asyncio.create_task(
-                                unuversal_linear_conditional_market_order(
-                                    api_url, api_key, secret_key, symbol, side,
-                                    order_data['qty_info'], order_data['triggerPrice'],
-                                    triggerDirection, orderLinkId
-                                )
-                            )
-                            tasks.append(task)
 
-                    # Выполняем все задачи спот/линеар лонг/шорт параллельно и собираем результаты
-                    results = await asyncio.gather(*tasks)
-                    # print(results)
-                    if signal_details[0] == 'buy':
-                        side = 'Buy'
-                    else:
-                        side = 'Sell'
+            for row in closed_positions_no_tp:
+                try:
+                    user = users[users['telegram_id'] == row.owner_id]
+                    # если включен стоп трейд пропускаем юзера
+                    if user['stop_trading'].iloc[0]:
+                        continue
 
+                    # проверяем на наличие в списке торгуемых монет
+                    if user['trading_pairs'].iloc[0] and symbol not in user['trading_pairs'].iloc[
+                        0] and '-1' not in user['trading_pairs'].iloc[0]:
+                        print('not in trading pairs')
+                        continue
 
+                    # проверяем торговлю новыми монетами
+                    if "-1" in user['trading_pairs'].iloc[0]:
+                        if symbol not in new_pairs:
+                            continue
 
-                    # пробуем ассинхронно отправить в БД
+                    averaging = user['averaging'].iloc[0]
+                    max_trade = float(user['max_trade'].iloc[0])
+                    if averaging:
+                        averaging_step = float(user['averaging_step'].iloc[0])
+                        averaging_size = float(user['averaging_size'].iloc[0])
+                        prev_price = float(row.avgPrice)
+                        prev_volume = float(row.cumExecQty)
 
-                    tasks = []
+                        extra_volume = abs(prev_volume * averaging_size)
+                        #extra_volume = abs((prev_volume * averaging_size) - prev_volume)
 
-                    for position in results:
-                        if isinstance(position, dict) and position.get('retMsg') == 'OK':
-                            print(position)
-                            res = position.get('result')
-                            print(res)
-                            orderLinkId = res.get('orderLinkId')
-                            details = orderLinkId.split('_')
+                        spot_price = spot_prices.get(symbol)
+                        linear_price = linear_prices.get(symbol)
 
-                            pos = {
-                                "bybit_id": orderLinkId,
-                                "owner_id": int(details[0]),
-                                "market": details[1],
-                                "order_type": details[2],
-                                "symbol": symbol,
-                                "side": side,
-                            }
 
-                            # Создаем задачу для вставки позиции с обработкой ошибок
-                            tasks.append(
-                                asyncio.create_task(
-                                    positions_op.upsert_position(pos)
-                                )
-                            )
+                        if row.order_type == 'spot':
+                            category = 'spot'
+                            current_price = float(spot_price)
+                            limit_volume = max_trade / current_price
+                            if extra_volume + prev_volume >= limit_volume:
+                                extra_volume = limit_volume - prev_volume
+                            limit_budget = float(budget_map[row.owner_id]) / current_price
+                            if extra_volume > limit_budget:
+                                extra_volume = limit_budget
 
-                    # Выполняем все задачи параллельно
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
+                            extra_volume = adjust_quantity(extra_volume, spot_min_volume, spot_qty_tick)
+                            print(extra_volume, 'extra_volume')
+                        else:
+                            current_price = float(linear_price)
+                            limit_volume = max_trade / current_price
+                            if extra_volume + prev_volume >= limit_volume:
+                                extra_volume = limit_volume - prev_volume
+                            limit_budget = float(budget_map[row.owner_id]) / current_price
+                            if extra_volume > limit_budget:
+                                extra_volume = limit_budget
 
-                    # Обработка результатов выполнения задач
-                    for i, result in enumerate(results):
-                        if isinstance(result, Exception):
-                            print(f"Ошибка при вставке позиции {tasks[i].get_name()}: {result}")
-                            try:
-                                # Повторная попытка вставки
-                                await positions_op.upsert_position(tasks[i].get_name())
-                            except Exception as e:
-                                print(f"Повторная попытка не удалась для позиции {tasks[i].get_name()}: {e}")
+                            category = 'linear'
+                            extra_volume = adjust_quantity(extra_volume, linear_min_volume, linear_qty_tick)
+                            print(extra_volume, 'extra_volume')
 
+                        if extra_volume == -1:
+                            print('Недостаточно объема для минимальной покупки усреднения')
 
-                #####################################################
 
-                #                    #####
-                #                ############
-                # ####### STOP MAIN TRADE LOGIC ########
+                        if side == 'Buy':
+                            if prev_price < current_price:
+                                print('No averaging for buy')
+                            else:
+                                print('lets check averaging details for buy')
+                                per_cent = abs(current_price - prev_price) / prev_price * 100
+                                if per_cent >= averaging_step:
+                                    print(f'lets buy extra {extra_volume}')
+                                    trade_type = user['trade_type'].iloc[0]
+                                    print(trade_type)
+                                    if trade_type == 'demo':
+                                        api_url = order_demo_url
+                                        api_key = user['demo_api_key'].iloc[0]
+                                        secret_key = user['demo_secret_key'].iloc[0]
+                                        orderLinkId = f"{str(row.owner_id)}_demo_aver_{uuid.uuid4().hex[:8]}"
+                                        # print('orderLinkId', orderLinkId)
+                                    else:
+                                        api_url = order_trade_url
+                                        api_key = user['main_api_key'].iloc[0]
+                                        secret_key = user['main_secret_key'].iloc[0]
+                                        orderLinkId = f"{str(row.owner_id)}_real_aver_{uuid.uuid4().hex[:8]}"
+
+                                    res = await run_limited(user_limits[row.owner_id], universal_market_order(
+                                        api_url, str(api_key), str(secret_key), category, symbol,
+                                        side, extra_volume, orderLinkId))
+                                    print(res)
+
+                                    if isinstance(res, dict) and res.get('retMsg') == 'OK':
+                                        result = res.get('result')
+                                        orderLinkId = result.get('orderLinkId')
+                                        depends = row.bybit_id
+                                        pos = {
+                                            "bybit_id": orderLinkId,
+                                            "owner_id": int(row.owner_id),
+                                            "market": user['trade_type'].iloc[0],
+                                            "order_type": category,
+                                            "symbol": symbol,
+                                            "side": side,
+                                            'type': 'averaging',
+                                            'depends_on': depends,
+                                        }
 
+                                        await positions_op.upsert_position(pos)
+                                        print('Добавлен', orderLinkId)
+                                        # рыночный ордер исполнен - баланс изменился
+                                        budgets.invalidate(row.owner_id)
 
-                # ####### START AVERAGING TRADE LOGIC ########
-                #               ############
-                #                   #####
-                if averaging:
-                    print('Start averaging logic')
-                    symbol = coin.upper() + 'USDT'
-                    # получаем открытые (выкупленные) позиции, которые не завершены,
-                    # у которых еще не тригернулся ТП, исполнен первоначальный ордер на покупку и у которых совпадает символ
-                    try:
-                        closed_positions_no_tp = (await positions_op.get_positions_by_fields(
-                            {'finished': False, 'orderStatus': True, 'tp_opened': False, 'depends_on': '-1', 'symbol': symbol
-                             }))
+                        if side == 'Sell':
+                            print(prev_price, current_price)
+                            if prev_price > current_price:
+                                print('No averaging for sell - linears only')
+                            else:
+                                print('lets check averaging details for short - linears only')
+                                per_cent = abs(current_price - prev_price) / prev_price * 100
+                                if per_cent >= averaging_step:
+                                    print(f'lets sell extra {extra_volume}')
+
+                                    trade_type = user['trade_type'].iloc[0]
+                                    print(trade_type)
+                                    if trade_type == 'demo':
+                                        api_url = order_demo_url
+                                        api_key = user['demo_api_key'].iloc[0]
+                                        secret_key = user['demo_secret_key'].iloc[0]
+                                        orderLinkId = f"{str(row.owner_id)}_demo_linear_aver_{uuid.uuid4().hex[:8]}"
+                                        print('orderLinkId', orderLinkId)
+                                    else:
+                                        api_url = order_trade_url
+                                        api_key = user['main_api_key'].iloc[0]
+                                        print('api_key', api_key)
+                                        secret_key = user['main_secret_key'].iloc[0]
+                                        print('api_key', api_key)
+                                        orderLinkId = f"{str(row.owner_id)}_real_linear_aver_{uuid.uuid4().hex[:8]}"
+                                        print('orderLinkId', orderLinkId)
+
+                                    res = await run_limited(user_limits[row.owner_id], universal_market_order(
+                                        api_url, str(api_key), str(secret_key), category, symbol,
+                                        side, extra_volume, orderLinkId))
+                                    print(res)
+                                    if isinstance(res, dict) and res.get('retMsg') == 'OK':
+                                        result = res.get('result')
+                                        orderLinkId = result.get('orderLinkId')
+                                        depends = row.bybit_id
+                                        pos = {
+                                            "bybit_id": orderLinkId,
+                                            "owner_id": int(row.owner_id),
+                                            "market": user['trade_type'].iloc[0],
+                                            "order_type": category,
+                                            "symbol": symbol,
+                                            "side": side,
+                                            'type': 'averaging',
+                                            'depends_on': depends,
+                                        }
 
-                        if closed_positions_no_tp.empty:
-                            print('Нет открытых позиций для укрупнения')
-                            continue
+                                        await positions_op.upsert_position(pos)
+                                        print('Добавлен', orderLinkId)
+                                        # рыночный ордер исполнен - баланс изменился
+                                        budgets.invalidate(row.owner_id)
+                except Exception as e:
+                    print(f"Ошибка в блоке START AVERAGING TRADE LOGIC по отдельной позиции: {e}")
+                    #traceback.print_exc()
+                    log_error(logger, "Ошибка в блоке START AVERAGING TRADE LOGIC по отдельной позиции", e)
+                    if "too many clients already" in str(e):
+                        log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
+                        sys.exit()
+                    await asyncio.sleep(1)
 
-                        if signal_details[0] == 'buy':
-                            side = 'Buy'
-                        else:
-                            side = 'Sell'
 
-                        spot_price = spot_prices.get(symbol)
-                        linear_price = linear_prices.get(symbol)
+        except Exception as e:
+            print(f"Ошибка в блоке START AVERAGING TRADE LOGIC: {e}")
+            # traceback.print_exc()
+            log_error(logger, "Ошибка в блоке START AVERAGING TRADE LOGIC", e)
+            if "too many clients already" in str(e):
+                log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
+                sys.exit()
+            await asyncio.sleep(1)
 
-                        # чась символов может быть только в споте или только фьючах
-                        try:
-                            spot_settings = spot_data.get(coin.upper())
-                            spot_min_volume = spot_settings.get('min_order_qty')
-                            spot_qty_tick = spot_settings.get('base_precision')
-                        except:
-                            pass
-
-                        try:
-                            linear_settings = linear_data.get(coin.upper())
-                            linear_min_volume = linear_settings.get('min_order_qty')
-                            linear_qty_tick = linear_settings.get('qty_step')
-                        except:
-                            pass
-
-                        closed_positions_no_tp = closed_positions_no_tp[['owner_id', 'symbol', 'side',
-                                                                         'bybit_id', 'avgPrice', 'cumExecValue',
-                                                                         'order_type', 'cumExecQty', 'market']]
-                        print('Проверяем условия усреднения')
-
-
-                        for index, row in closed_positions_no_tp.iterrows():
-                            try:
-                                user = users[users['telegram_id'] == row['owner_id']]
-                                # если включен стоп трейд пропускаем юзера
-                                if user['stop_trading'].iloc[0]:
-                                    continue
+    #                    #####
+    #                ############
+    # ####### STOP AVERAGING TRADE LOGIC ########
 
-                                # проверяем на наличие в списке торгуемых монет
-                                if user['trading_pairs'].iloc[0] and symbol not in user['trading_pairs'].iloc[
-                                    0] and '-1' not in user['trading_pairs'].iloc[0]:
-                                    print('not in trading pairs')
-                                    continue
 
-                                # проверяем торговлю новыми монетами
-                                if "-1" in user['trading_pairs'].iloc[0]:
-                                    if symbol not in new_pairs:
-                                        continue
-
-                                averaging = user['averaging'].iloc[0]
-                                max_trade = float(user['max_trade'].iloc[0])
-                                if averaging:
-                                    averaging_step = float(user['averaging_step'].iloc[0])
-                                    averaging_size = float(user['averaging_size'].iloc[0])
-                                    prev_price = float(row['avgPrice'])
-                                    prev_volume = float(row['cumExecQty'])
-
-                                    extra_volume = abs(prev_volume * averaging_size)
-                                    #extra_volume = abs((prev_volume * averaging_size) - prev_volume)
-
-                                    spot_price = spot_prices.get(symbol)
-                                    linear_price = linear_prices.get(symbol)
-
-
-                                    if row['order_type'] == 'spot':
-                                        category = 'spot'
-                                        current_price = float(spot_price)
-                                        limit_volume = max_trade / current_price
-                                        if extra_volume + prev_volume >= limit_volume:
-                                            extra_volume = limit_volume - prev_volume
-                                        limit_budget = float(budget_map[row['owner_id']]) / current_price
-                                        if extra_volume > limit_budget:
-                                            extra_volume = limit_budget
-
-                                        extra_volume = adjust_quantity(extra_volume, spot_min_volume, spot_qty_tick)
-                                        print(extra_volume, 'extra_volume')
-                                    else:
-                                        current_price = float(linear_price)
-                                        limit_volume = max_trade / current_price
-                                        if extra_volume + prev_volume >= limit_volume:
-                                            extra_volume = limit_volume - prev_volume
-                                        limit_budget = float(budget_map[row['owner_id']]) / current_price
-                                        if extra_volume > limit_budget:
-                                            extra_volume = limit_budget
-
-                                        category = 'linear'
-                                        extra_volume = adjust_quantity(extra_volume, linear_min_volume, linear_qty_tick)
-                                        print(extra_volume, 'extra_volume')
-
-                                    if extra_volume == -1:
-                                        print('Недостаточно объема для минимальной покупки усреднения')
-
-
-                                    if side == 'Buy':
-                                        if prev_price < current_price:
-                                            print('No averaging for buy')
-                                        else:
-                                            print('lets check averaging details for buy')
-                                            per_cent = abs(current_price - prev_price) / prev_price * 100
-                                            if per_cent >= averaging_step:
-                                                print(f'lets buy extra {extra_volume}')
-                                                trade_type = user['trade_type'].iloc[0]
-                                                print(trade_type)
-                                                if trade_type == 'demo':
-                                                    api_url = order_demo_url
-                                                    api_key = user['demo_api_key'].iloc[0]
-                                                    secret_key = user['demo_secret_key'].iloc[0]
-                                                    orderLinkId = f"{str(row['owner_id'])}_demo_aver_{uuid.uuid4().hex[:8]}"
-                                                    # print('orderLinkId', orderLinkId)
-                                                else:
-                                                    api_url = order_trade_url
-                                                    api_key = user['main_api_key'].iloc[0]
-                                                    secret_key = user['main_secret_key'].iloc[0]
-                                                    orderLinkId = f"{str(row['owner_id'])}_real_aver_{uuid.uuid4().hex[:8]}"
-
-                                                res = await universal_market_order(api_url, str(api_key), str(secret_key), category, symbol,
-                                                                              side, extra_volume, orderLinkId)
-                                                print(res)
-
-                                                if isinstance(res, dict) and res.get('retMsg') == 'OK':
-                                                    result = res.get('result')
-                                                    orderLinkId = result.get('orderLinkId')
-                                                    depends = row['bybit_id']
-                                                    pos = {
-                                                        "bybit_id": orderLinkId,
-                                                        "owner_id": int(row['owner_id']),
-                                                        "market": user['trade_type'].iloc[0],
-                                                        "order_type": category,
-                                                        "symbol": symbol,
-                                                        "side": side,
-                                                        'type': 'averaging',
-                                                        'depends_on': depends,
-                                                    }
-
-                                                    await positions_op.upsert_position(pos)
-                                                    print('Добавлен', orderLinkId)
-
-                                    if side == 'Sell':
-                                        print(prev_price, current_price)
-                                        if prev_price > current_price:
-                                            print('No averaging for sell - linears only')
-                                        else:
-                                            print('lets check averaging details for short - linears only')
-                                            per_cent = abs(current_price - prev_price) / prev_price * 100
-                                            if per_cent >= averaging_step:
-                                                print(f'lets sell extra {extra_volume}')
-
-                                                trade_type = user['trade_type'].iloc[0]
-                                                print(trade_type)
-                                                if trade_type == 'demo':
-                                                    api_url = order_demo_url
-                                                    api_key = user['demo_api_key'].iloc[0]
-                                                    secret_key = user['demo_secret_key'].iloc[0]
-                                                    orderLinkId = f"{str(row['owner_id'])}_demo_linear_aver_{uuid.uuid4().hex[:8]}"
-                                                    print('orderLinkId', orderLinkId)
-                                                else:
-                                                    api_url = order_trade_url
-                                                    api_key = user['main_api_key'].iloc[0]
-                                                    print('api_key', api_key)
-                                                    secret_key = user['main_secret_key'].iloc[0]
-                                                    print('api_key', api_key)
-                                                    orderLinkId = f"{str(row['owner_id'])}_real_linear_aver_{uuid.uuid4().hex[:8]}"
-                                                    print('orderLinkId', orderLinkId)
-
-                                                res = await universal_market_order(api_url, str(api_key), str(secret_key), category, symbol,
-                                                                              side, extra_volume, orderLinkId)
-                                                print(res)
-                                                if isinstance(res, dict) and res.get('retMsg') == 'OK':
-                                                    result = res.get('result')
-                                                    orderLinkId = result.get('orderLinkId')
-                                                    depends = row['bybit_id']
-                                                    pos = {
-                                                        "bybit_id": orderLinkId,
-                                                        "owner_id": int(row['owner_id']),
-                                                        "market": user['trade_type'].iloc[0],
-                                                        "order_type": category,
-                                                        "symbol": symbol,
-                                                        "side": side,
-                                                        'type': 'averaging',
-                                                        'depends_on': depends,
-                                                    }
-
-                                                    await positions_op.upsert_position(pos)
-                                                    print('Добавлен', orderLinkId)
-                            except Exception as e:
-                                print(f"Ошибка в блоке START AVERAGING TRADE LOGIC по отдельной позиции: {e}")
-                                #traceback.print_exc()
-                                log_error(logger, "Ошибка в блоке START AVERAGING TRADE LOGIC по отдельной позиции", e)
-                                if "too many clients already" in str(e):
-                                    log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
-                                    sys.exit()
-                                await asyncio.sleep(1)
+async def trade_performance(database_url, price_book):
+    signals_op = SignalsOperations(database_url)
+    db_tg_channels = TgChannelsOperations(database_url)
+    users_cache = get_users_cache(database_url)
+    positions_op = PositionsOperations(database_url)
+    new_pairs_op = NewPairsOperations(database_url)
+    # открытые позиции в памяти, обновляются уведомлениями триггера таблицы positions
+    open_index = get_open_positions_index(database_url)
+    instruments = get_instruments(database_url)
+    await warm_caches(database_url)
+    signal_listener = SignalListener(database_url)
+    # ограничение одновременных ордеров одного юзера из разных сигналов
+    user_limits = defaultdict(lambda: asyncio.Semaphore(st.SIGNALS['per_user']))
+    # балансы обновляются в фоне, к приходу сигнала уже готовы
+    budgets = BudgetService(users_cache)
+    budgets.start()
+    # исполнения ордеров и балансы приходят по приватным потокам, опрос REST - запасной путь
+    private_streams = PrivateStreamManager(users_cache, positions_op, budgets)
+    private_streams_task = asyncio.create_task(private_streams.run())
 
+    while True:
+        try:
+            # ####### SIGNAL LOGIC STARTS HERE ########
+            #               ############
+            #                   #####
 
-                    except Exception as e:
-                        print(f"Ошибка в блоке START AVERAGING TRADE LOGIC: {e}")
-                        # traceback.print_exc()
-                        log_error(logger, "Ошибка в блоке START AVERAGING TRADE LOGIC", e)
-                        if "too many clients already" in str(e):
-                            log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
-                            sys.exit()
-                        await asyncio.sleep(1)
+            # забираем из очереди все накопившиеся сигналы, а не только первый
+            signals = await signals_op.dequeue_signals(st.SIGNALS['batch_size'])
+            users = await users_cache.get_all_users_data()
+
+            if signals:
+                batch = {
+                    'users': users,
+                    'averaging_channels': await db_tg_channels.get_all_channels(),
+                    # спецификации пар из памяти процесса, таблицы не перечитываются
+                    'spot_data': instruments.spot,
+                    'linear_data': instruments.linear,
+                    'new_pairs': await new_pairs_op.get_all_names(),
+                    'open_positions': open_index,
+                }
+                batch['cohorts'] = CohortSelector(users, batch['new_pairs'])
+                await dispatch_signals(
+                    signals,
+                    lambda signal: process_signal(signal, batch, positions_op, price_book, user_limits, budgets),
+                    st.SIGNALS['max_coins'],
+                )
 
-                #                    #####
-                #                ############
-                # ####### STOP AVERAGING TRADE LOGIC ########
+            #               #####
+            #           ############
+            # ####### SIGNAL LOGIC ENDS HERE ########
 
 
             # ####### START CHECK IF ORDER PERFORMED ########
@@ -715,117 +669,41 @@ async def trade_performance(database_url, price_queue):
             #                 #####
 
             # получаем открытые позиции по всем юзерам из БД
-            try:
-                open_positions = (await positions_op.get_positions_by_fields({"orderStatus": False,}))['bybit_id'].to_list()
-                #print(open_positions)
-            except:
-                open_positions = []
-
-            # для открытых ордеров по данным биржи
-            positions_filled = {}
-
-            # получаем все размещенные на бирже ордера для демо
-            users_demo = users[users['trade_type'] == 'demo']['telegram_id'].to_list()
-            for user in users_demo:
-                res_one = await get_user_orders(user, user_orders_demo_url, 'spot', 1, demo=True)
-                if not res_one:
-                    res_one = []
-                try:
-                    res_one.extend(await get_user_orders(user, user_orders_demo_url, 'linear', 1, demo=True))
-                except:
-                    pass
-
-                # print('res_one')
-                # for element in res_one:
-                #     print(element, '\n\n')
-                # print('finished res_one')
-                # собираем данные по всем ордерам у которых статус filled
-
-
-                res_demo = {
-                    order['orderLinkId']: {
-                        'orderStatus': order['orderStatus'],
-                        'avgPrice': order['avgPrice'],
-                        'cumExecValue': order['cumExecValue'],
-                        'cumExecQty': order['cumExecQty'],
-                        'cumExecFee': order['cumExecFee'],
-                    }
-                    for order in res_one if order['orderStatus'] == 'Filled'
-                }
-
-                if res_demo:
-                    positions_filled.update(res_demo)
-
-
-
-            # получаем все размещенные на бирже ордера для реального рынка
-            users_trade = users[users['trade_type'] != 'demo']['telegram_id'].to_list()
-            for user in users_trade:
-                try:
-                    res_two = await get_user_orders(user, user_orders_trade_url, 'spot', 2, demo=None)
-                except:
-                    res_two = []
-                if not res_two:
-                    res_two = []
-                try:
-                    res_two.extend(await get_user_orders(user, user_orders_trade_url, 'linear', 2, demo=None))
-                except:
-                    pass
-                # собираем данные по всем ордерам у которых статус filled
-                res_real = {
-                    order['orderLinkId']: {
-                        'orderStatus': order['orderStatus'],
-                        'avgPrice': order['avgPrice'],
-                        'cumExecValue': order['cumExecValue'],
-                        'cumExecQty': order['cumExecQty'],
-                        'cumExecFee': order['cumExecFee'],
-                    }
-                    for order in res_two if order['orderStatus'] == 'Filled'
-                }
-                if res_real:  # Проверяем, что res_real не пуст
-                    positions_filled.update(res_real)
-
-            if positions_filled:
-
-
-                for open_position in open_positions:
-
-                    if open_position in positions_filled:
-                        position = positions_filled[open_position]
-                        position_data = {
-                            "bybit_id": open_position,
-                            "orderStatus": True,
-                            "avgPrice": position['avgPrice'],
-                            "cumExecValue": position['cumExecValue'],
-                            "cumExecQty": position['cumExecQty'],
-                            "cumExecFee": position['cumExecFee'],
-                        }
-                        print(position_data)
-
-                        await positions_op.upsert_position(position_data)
+            open_positions = [position.bybit_id for position in open_index.in_state('unfilled')]
+
+            # собираем ордера всех юзеров параллельно, юзеров с живым приватным потоком
+            # не опрашиваем - исполнения пишет поток
+            accounts = [(user, user_orders_demo_url, 1, True)
+                        for user in users[users['trade_type'] == 'demo']['telegram_id'].to_list()
+                        if private_streams.should_poll(user, demo=True)]
+            accounts += [(user, user_orders_trade_url, 2, None)
+                         for user in users[users['trade_type'] != 'demo']['telegram_id'].to_list()
+                         if private_streams.should_poll(user, demo=False)]
+            polled_at = time.monotonic()
+            positions_filled, polled = await collect_filled_orders(accounts)
+
+            # одна пакетная запись по всем исполненным открытым позициям
+            filled = {open_position: positions_filled[open_position]
+                      for open_position in open_positions if open_position in positions_filled}
+            if filled:
+                print('Исполнены ордера', filled)
+                await positions_op.mark_filled_many(filled)
+                for open_position in filled:
+                    # ордер исполнен - баланс юзера изменился
+                    budgets.invalidate(int(open_position.split('_')[0]))
+            # сверка после переподключения потока засчитывается, только когда ордера получены и записаны
+            for telegram_id, demo in polled:
+                private_streams.mark_caught_up(telegram_id, demo, polled_at)
 
 
             # проверяем не появились ли среди закрытых позиций усредняющие, если да - пересчитываем основной ордер
             try:
-                avg_positions = await positions_op.get_positions_by_fields({"type": "averaging", })
-                for index, avg_position in avg_positions.iterrows():
-                    moth_position_id = avg_position['depends_on']
-                    avg_exec_value = avg_position['cumExecValue']
-                    avg_exec_qty = avg_position['cumExecQty']
-                    moth_position = await positions_op.get_position_by_bybit_id(moth_position_id)
-                    cum_exec_value = float(moth_position['cumExecValue']) + float(avg_exec_value)
-                    cum_exec_qty = float(moth_position['cumExecQty']) + float(avg_exec_qty)
-                    cum_exec_price = cum_exec_value / cum_exec_qty
-                    cum_exec_fee = str(f"{float(avg_position['cumExecFee']) + float(moth_position['cumExecFee']):.8f}")
-                    position_data = {
-                        "bybit_id": moth_position_id,
-                        "avgPrice": str(cum_exec_price),
-                        "cumExecValue": str(cum_exec_value),
-                        "cumExecQty": str(cum_exec_qty),
-                        "cumExecFee": cum_exec_fee
-                    }
-                    await positions_op.upsert_position(position_data)
-                    await positions_op.delete_position_by_bybit_id(avg_positions["bybit_id"].iloc[0])
+                # индекс должен увидеть удаления прошлых проходов, иначе усредняющая попадет сюда снова
+                await open_index.barrier()
+                for avg_position in open_index.in_state('averaging'):
+                    # слияние и удаление в одной транзакции: повторный вызов ничего не меняет
+                    if await positions_op.merge_averaging(avg_position.bybit_id):
+                        print('Усредняющая позиция добавлена к основной', avg_position.bybit_id)
 
 
             except Exception as e:
@@ -836,9 +714,10 @@ async def trade_performance(database_url, price_queue):
                 #                ############
                 # ####### STOP CHECK IF PRIMARY ORDER PERFORMED ########
 
-            await asyncio.sleep(1)
-
-            await asyncio.sleep(5)
+            # ждем новый сигнал, не дольше прежнего интервала опроса;
+            # если выбрали полную пачку - в очереди еще есть сигналы, не ждем
+            if len(signals) < st.SIGNALS['batch_size']:
+                await signal_listener.wait(6)
             #raise Exception("sorry, too many clients already")
 
         except Exception as e:
@@ -846,199 +725,208 @@ async def trade_performance(database_url, price_queue):
             # traceback.print_exc()
             log_error(logger, "Ошибка в trade_performance", e)
             if "too many clients already" in str(e):
-                log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                 sys.exit()
             await asyncio.sleep(1)
 
 
 
-async def tp_execution(database_url, price_queue):
+async def open_first_tp(row, current_price, user, spot_data, linear_data) -> list:
+    """
+    Places the first TP of a position whose activation threshold has crossed.
+    Returns the position writes to save, empty if the TP was not placed.
+    """
+    symbol = row.symbol
+    demo = user['trade_type'].iloc[0] == 'demo'
+    # пары может не быть в реестре (или без шага цены) - ТП этой позиции не ставим, остальные не страдают
+    settings = (spot_data if row.order_type == 'spot' else linear_data).get(symbol[:-4])
+    if (settings is None or settings.price_tick is None
+            or (row.order_type == 'spot' and settings.qty_step_size is None)):
+        print('Нет настроек пары для ТП', row.order_type, symbol)
+        return []
+
+    if row.side == 'Buy':
+        tp_side = 'Sell'
+        qty_info = Decimal(row.cumExecQty)
+        cumExecFee = Decimal(row.cumExecFee)
+        trade_type = row.market   # demo/real
+        order_type = row.order_type  # spot/linear
+
+        if order_type == 'spot':
+            spot_settings = spot_data.get(symbol[:-4])
+            price_tick = spot_settings.price_tick
+            qty_tick = spot_settings.qty_step_size
+            qty_info = ((qty_info - cumExecFee) // qty_tick) * qty_tick
+            qty_info = qty_info.quantize(qty_tick, rounding=ROUND_DOWN)
+        else:
+            linear_settings = linear_data.get(symbol[:-4])
+            price_tick = linear_settings.price_tick
+
+        triggerPrice = current_price * (1 - (float(user['tp_step'].iloc[0])) / 100)
+        triggerPrice = round_price(triggerPrice, price_tick)
+
+        orderLinkId = f'{user['telegram_id'].iloc[0]}_{trade_type}_{order_type}_tp_{uuid.uuid4().hex[:9]}'
+
+        if order_type == 'linear':
+            trailingStop = abs(current_price - triggerPrice)
+            rest = await set_tp_linears(user['telegram_id'].iloc[0], symbol, trailingStop, demo=demo)
+            if isinstance(rest, dict) and (rest.get('retMsg') == 'OK' or rest.get('retMsg') == 'can not set tp/sl/ts for zero position'):
+                return [{"bybit_id": row.bybit_id, 'tp_opened': True}]
+            return []
+
+        tp_api_url = order_demo_url if demo else order_trade_url
+        tp_api_key = user['demo_api_key'].iloc[0] if demo else user['main_api_key'].iloc[0]
+        tp_secret_key = user['demo_secret_key'].iloc[0] if demo else user['main_secret_key'].iloc[0]
+        position = await universal_spot_conditional_market_order(tp_api_url, tp_api_key, tp_secret_key,
+                                                                 symbol, tp_side, qty_info,
+                                                                 triggerPrice, orderLinkId)
+        if isinstance(position, dict) and position.get('retMsg') == 'OK':
+            print('TP открыт', position, orderLinkId)
+            orderLinkId = position.get('result').get('orderLinkId')
+            details = orderLinkId.split('_')
+            return [
+                {
+                    "bybit_id": orderLinkId,
+                    "owner_id": int(details[0]),
+                    "market": details[1],
+                    "order_type": details[2],
+                    "symbol": symbol,
+                    "side": tp_side,
+                    'type': 'tp',
+                    'depends_on': row.bybit_id,
+                    'triggerPrice': str(triggerPrice),
+                },
+                {"bybit_id": row.bybit_id, 'tp_opened': True},
+            ]
+        return []
+
+    # шорт - только фьючи
+    print('Трейлинг стоп на фьюч открываем')
+    print('Материнский ордер', row)
+    linear_settings = linear_data.get(symbol[:-4])
+    price_tick = linear_settings.price_tick
+    triggerPrice = current_price * (1 - (float(user['tp_step'].iloc[0])) / 100)
+    triggerPrice = round_price(triggerPrice, price_tick)
+    trailingStop = abs(current_price - triggerPrice)
+    rest = await set_tp_linears(user['telegram_id'].iloc[0], symbol, trailingStop, demo=demo)
+    if isinstance(rest, dict) and rest.get('retMsg') == 'OK':
+        print('параметры для изменения в матер ордер')
+        return [{"bybit_id": row.bybit_id, 'tp_opened': True}]
+    return []
+
+
+async def amend_spot_tp(row, user, new_triggerPrice) -> list:
+    """
+    Moves the trigger of a spot TP order up. Returns the position writes, empty on failure.
+    """
+    demo = user['trade_type'].iloc[0] == 'demo'
+    amend_order_url = amend_order_demo_url if demo else amend_order_trade_url
+    tp_api_key = user['demo_api_key'].iloc[0] if demo else user['main_api_key'].iloc[0]
+    tp_secret_key = user['demo_secret_key'].iloc[0] if demo else user['main_secret_key'].iloc[0]
+    res = await amend_spot_conditional_market_order(
+        amend_order_url, tp_api_key, tp_secret_key,
+        row.symbol, new_triggerPrice, row.bybit_id)
+
+    if isinstance(res, dict) and res.get('retMsg') == 'OK':
+        return [{"bybit_id": row.bybit_id, 'triggerPrice': str(new_triggerPrice)}]
+    return []
+
+
+async def tp_execution(database_url, price_book):
     positions_op = PositionsOperations(database_url)
-    users_op = UsersOperations(database_url)
-    spot_set_op = SpotPairsOperations(database_url)
-    lin_set_op = LinearPairsOperations(database_url)
-    while True:
+    users_cache = get_users_cache(database_url)
+    open_index = get_open_positions_index(database_url)
+    # спецификации пар загружаются один раз и обновляются по уведомлению ежедневной задачи
+    instruments = get_instruments(database_url)
+    await warm_caches(database_url)
+
+    # пороги первого ТП по символам, срабатывают от обновлений цен, а не перебором позиций
+    tp_engine = TpTriggerEngine()
+    retry = {}  # bybit_id -> время повторной попытки после неудачной установки ТП
+    # изменения трейлинг ТП на споте, объединяются по ордеру
+    amends = AmendScheduler()
+
+    def can_arm(position):
+        # шорт на споте не торгуем, для него ТП не ставится
+        return (position.side == 'Buy' or position.order_type == 'linear') and position.bybit_id not in retry
+
+    synced = None
+    seqs = {'spot': 0, 'linear': 0}
+    dirty = True
+    last_trail = 0
 
+    while True:
+        users = await users_cache.get_all_users_data()
+        trail_due = time.monotonic() - last_trail >= st.TP['trail_interval']
+        spot_data, linear_data = instruments.spot, instruments.linear
 
         # ####### CHECK FIRST TP CONDITION ########
         #               ############
         #                   #####
-        users = await users_op.get_all_users_data()
-        spot_data = await spot_set_op.get_all_spot_pairs_data()
-        linear_data = await lin_set_op.get_all_linear_pairs_data()
-
-        tasks = []
         try:
-            # находим позиции, в которых куплен актив (монета/фьюч) без тейк профита
-            closed_positions_no_tp = (await positions_op.get_positions_by_fields(
-                {'orderStatus': True, 'tp_opened': False, 'depends_on': '-1', 'finished': False
-                }))
-
-            if closed_positions_no_tp.empty:
-                pass
-            else:
-                spot_prices, linear_prices = price_queue.get()
-                closed_positions_no_tp = closed_positions_no_tp[['owner_id', 'symbol', 'side',
-                                                                 'bybit_id', 'avgPrice', 'cumExecQty',
-                                                                 'order_type', 'cumExecFee', 'market']]
-
-                for index, row in closed_positions_no_tp.iterrows():
-                    user = users[users['telegram_id'] == row['owner_id']]
-                    # print(user['tp_min'].iloc[0])
-
-                    if row['order_type'] == 'linear':
-                        current_price = float(linear_prices.get(row['symbol']))
-                    else:
-                        current_price = float(spot_prices.get(row['symbol']))
-                    # print('row', row)
-                    prev_price = float(row['avgPrice'])
-
-                    x = user['tp_min'].iloc[0]
-
-                    if row['side'] == 'Buy':
-                        tp_side = 'Sell'
-                        # print(3, 'Ищем сигнал на закрытие лонга')
-
-                        if current_price >= (prev_price * (1 + x / 100)):
-                            symbol = row['symbol']
-                            qty_info = Decimal(row['cumExecQty'])
-                            cumExecFee = Decimal(row["cumExecFee"])
-                            trade_type = row['market']   # demo/real
-                            order_type = row['order_type']  # spot/linear
-
-
-                            if order_type == 'spot':
-                                spot_settings = spot_data.get(symbol[:-4])
-                                price_tick = spot_settings.get('tick_size')
-                                spot_settings = spot_data.get(symbol[:-4])
-                                qty_tick = Decimal(spot_settings.get('base_precision'))
-                                qty_info = ((qty_info - cumExecFee) // qty_tick) * qty_tick
-                                qty_info = qty_info.quantize(qty_tick, rounding=ROUND_DOWN)
-
-
-                            else:
-                                linear_settings = linear_data.get(symbol[:-4])
-                                price_tick = linear_settings.get('price_tick_size')
-
-                            triggerPrice = current_price * (1 - (float(user['tp_step'].iloc[0])) / 100)
-                            triggerPrice = round_price(triggerPrice, float(price_tick))
-                            #price = round_price(triggerPrice * 0.998, float(price_tick)) # for market conditional
-
-
-                            #or_type = 'tp'  # tp/main/trailing_lin
-                            orderLinkId = f'{user['telegram_id'].iloc[0]}_{trade_type}_{order_type}_tp_{uuid.uuid4().hex[:9]}' if user['trade_type'].iloc[0] == 'demo' else \
-                                    f'{user['telegram_id'].iloc[0]}_{trade_type}_{order_type}_tp_{uuid.uuid4().hex[:9]}'
-                            # print(row)
-                            # print(qty_info, tp_side, orderLinkId, or_type, order_type, trade_type, triggerPrice)
-
-                            if row['order_type'] == 'linear':
-                                pass
-                                # print('Открыть по фьючам TP на селл, первоначальн ордер был бай, ключи демо или мейн по trade_type == demo')
-                                # print('Материнский ордер', row)
-                                if user['trade_type'].iloc[0] == 'demo':
-                                    demo = True
-                                else:
-                                    demo = False
-                                trailingStop = abs(current_price - triggerPrice)
-                                rest = await set_tp_linears(user['telegram_id'].iloc[0], symbol, trailingStop, demo=demo)
-                                # print(rest, 'дальше изменяем в базе материнский ордер')
-                                if isinstance(rest, dict) and (rest.get('retMsg') == 'OK' or rest.get('retMsg') == 'can not set tp/sl/ts for zero position'):
-                                    pos = {
-                                        "bybit_id": row['bybit_id'],
-                                        'tp_opened': True,
-                                    }
-                                    # print('параметры для изменения в матер ордер')
-                                    await positions_op.upsert_position(pos)
-
-
-                            if row['order_type'] == 'spot':
-                                #print('Торгуем спот - первоначально был бай, теперь сел - определяем демо или нет, ключи демо или мейн по trade_type == demo')
-
-
-                                tp_api_url = order_demo_url if user['trade_type'].iloc[0] == 'demo' else order_trade_url
-                                tp_api_key = user['demo_api_key'].iloc[0] if user['trade_type'].iloc[0] == 'demo' else \
-                                    user['main_api_key'].iloc[0]
-                                tp_secret_key = user['demo_secret_key'].iloc[0] if user['trade_type'].iloc[0] == 'demo' else \
-                                    user['main_secret_key'].iloc[0]
-                                # print('Открываем спот первичный ТП на условиях',
-                                #       tp_api_url, tp_api_key, tp_secret_key,
-                                #       symbol, tp_side, qty_info,
-                                #       triggerPrice, orderLinkId
-                                #       )
-                                position = await universal_spot_conditional_market_order(tp_api_url, tp_api_key, tp_secret_key,
-                                                      symbol, tp_side, qty_info,
-                                                      triggerPrice, orderLinkId)
-
-                                if isinstance(position, dict) and position.get('retMsg') == 'OK':
-                                    print('TP открыт', position, orderLinkId)
-                                    res = position.get('result')
-                                    orderLinkId = res.get('orderLinkId')
-                                    details = orderLinkId.split('_')
-                                    depends = row['bybit_id']
-                                    pos = {
-                                        "bybit_id": orderLinkId,
-                                        "owner_id": int(details[0]),
-                                        "market": details[1],
-                                        "order_type": details[2],
-                                        "symbol": symbol,
-                                        "side": tp_side,
-                                        'type': 'tp',
-                                        'depends_on': depends,
-                                        'triggerPrice': str(triggerPrice),
-                                    }
-                                    # print(row['bybit_id'], 'orderLinkId_toinsert')
-                                    pos_change = {
-                                        "bybit_id": row['bybit_id'],
-                                        'tp_opened': True,
-                                    }
-                                    await positions_op.upsert_position(pos)
-                                    await positions_op.upsert_position(pos_change)
-                            # Обновляем  позицию в базе данных
-
-
-                    else:
-                        tp_side = 'Buy'
-                        # print(3, 'Ищем сигнал на закрытие шорта')
-                        signal = current_price <= (prev_price * (1 - x / 100))
-                        if signal and (row['order_type'] == 'linear'):
-
-                            print('Трейлинг стоп на фьюч открываем')
-                            print('Материнский ордер', row)
-
-                            # проверить что изначальный тип ордера тоже был demo или real
-                            if user['trade_type'].iloc[0] == 'demo':
-                                demo = True
-                            else:
-                                demo = False
-                            symbol = row['symbol']
-                            linear_settings = linear_data.get(symbol[:-4])
-                            price_tick = linear_settings.get('price_tick_size')
-                            # price_tick = linear_settings.get('price_tick_size')
-                            triggerPrice = current_price * (1 - (float(user['tp_step'].iloc[0])) / 100)
-                            triggerPrice = round_price(triggerPrice, float(price_tick))
-                            trailingStop = abs(current_price - triggerPrice)
-                            # print('Пытаемся поставить ТП фьюч')
-                            rest = await set_tp_linears(user['telegram_id'].iloc[0], symbol, trailingStop, demo=demo)
-                            # print(rest, 'дальше изменяем в базе материнский ордер')
-                            #######
-                            ######
-                            #####
-                            ####
-                            if isinstance(rest, dict) and rest.get('retMsg') == 'OK':
-                                pos = {
-                                    "bybit_id": row['bybit_id'],
-                                    'tp_opened': True,
-                                }
-                                print('параметры для изменения в матер ордер')
-                                await positions_op.upsert_position(pos)
+            # барьер - чтобы не открыть ТП повторно, пока не дошло уведомление о своей записи
+            if dirty:
+                await open_index.barrier()
+                dirty = False
+
+            now = time.monotonic()
+            fresh = set()
+            for bybit_id in [bybit_id for bybit_id, due in retry.items() if due <= now]:
+                del retry[bybit_id]
+                synced = None
+
+            # позиции без ТП и tp_min юзеров меняются редко - перевзводим только после изменений
+            state = (open_index.version, users_cache.version)
+            if state != synced and users is not None:
+                tp_min_map = dict(zip(users['telegram_id'], users['tp_min']))
+                fresh = tp_engine.sync(open_index.in_state('no_tp'), tp_min_map, can_arm)
+                synced = state
+
+            triggered = []
+            for market in ('spot', 'linear'):
+                seqs[market], prices = price_book.updates(market, seqs[market])
+                # только что взведенные позиции проверяем по текущей цене сразу
+                for key_market, symbol in fresh:
+                    if key_market == market and symbol not in prices:
+                        price = price_book.get(market, symbol)
+                        if price is not None:
+                            prices[symbol] = price
+                for symbol, price in prices.items():
+                    triggered += [(position, price) for position in tp_engine.on_price(market, symbol, price)]
+
+            users_by_id = {telegram_id: users[users['telegram_id'] == telegram_id]
+                           for telegram_id in {row.owner_id for row, _ in triggered}}
+            triggered = [(row, price) for row, price in triggered if not users_by_id[row.owner_id].empty]
+
+            # ТП ставятся параллельно, ордера одного юзера (одного ключа) - по очереди
+            results = await gather_keyed(
+                triggered, lambda item: item[0].owner_id,
+                lambda item: open_first_tp(item[0], item[1], users_by_id[item[0].owner_id], spot_data, linear_data),
+                st.TP['concurrency'])
+
+            writes = []
+            for (row, _), result in zip(triggered, results):
+                if isinstance(result, Exception):
+                    print(f"Ошибка установки ТП {row.bybit_id}: {result}")
+                if isinstance(result, list) and result:
+                    writes += result
+                else:
+                    # не вышло - повторим не раньше чем через retry_delay
+                    retry[row.bybit_id] = time.monotonic() + st.TP['retry_delay']
+            # все записи круга одной пачкой
+            if writes:
+                await save_positions(positions_op, writes, 'первый ТП')
+                dirty = True
 
         except Exception as e:
             print(f"Ошибка в процессе find initial tp: {e}")
             # traceback.print_exc()
             log_error(logger, "Ошибка в процессе find initial tp", e)
             if "too many clients already" in str(e):
-                log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                 sys.exit()
+            # позиции могли выпасть из движка посреди круга - перевзводим
+            synced = None
             await asyncio.sleep(1)
 
             #                    #####
@@ -1049,70 +937,62 @@ async def tp_execution(database_url, price_queue):
             #               ############
             #                   #####
         try:
-            open_tp_orders = (await positions_op.get_positions_by_fields(
-                {'orderStatus': False, 'type': 'tp', 'order_type': 'spot'
-                 }))
-            #print(open_tp_orders)
-
-            if open_tp_orders.empty:
-                # print('No open TP to check')
-                await asyncio.sleep(1)
-                continue
-            #
-            spot_prices, linear_prices = price_queue.get()
-            open_tp_orders = open_tp_orders[['owner_id', 'symbol', 'side',
-                                             'bybit_id', 'order_type',
-                                             'triggerPrice', 'market', 'bybit_id']]
-
-
-            for index, row in open_tp_orders.iterrows():
-                user = users[users['telegram_id'] == row['owner_id']]
-
-                current_price = float(spot_prices.get(row['symbol']))
-                prev_price = float(row['triggerPrice'])
-                if current_price > prev_price and row['side']:
-                    # print('Поднимаем тейк профит спот на селл вверх')
-                    symbol = row['symbol']
-                    spot_settings = spot_data.get(symbol[:-4])
-                    price_tick = spot_settings.get('tick_size')
-                    new_triggerPrice = current_price * (1 - (float(user['tp_step'].iloc[0])) / 100)
-                    new_triggerPrice = round_price(new_triggerPrice, float(price_tick))
-                    if prev_price >= new_triggerPrice:
+            # цели трейлинга пересчитываем раз в trail_interval, а отправляет их планировщик:
+            # на каждый ордер уходит только последняя цель и не чаще лимитов
+            if trail_due:
+                last_trail = time.monotonic()
+                open_tp_orders = [order for order in open_index.in_state('open_tp') if order.order_type == 'spot']
+                amends.retain(order.bybit_id for order in open_tp_orders)
+                spot_prices, linear_prices = price_book.views()
+
+                for row in open_tp_orders:
+                    user = users[users['telegram_id'] == row.owner_id]
+                    if user.empty:
                         continue
 
-                    new_price = round_price(new_triggerPrice * 0.998, float(price_tick))
-                    #print('Price current', current_price, 'price_prev', prev_price, 'next_trigger', new_triggerPrice)
-                    prev_orderLinkId = row['bybit_id'].iloc[0]
-
-
-                    amend_order_url = amend_order_demo_url if user['trade_type'].iloc[0] == 'demo' else amend_order_trade_url
-
-                    tp_api_key = user['demo_api_key'].iloc[0] if user['trade_type'].iloc[0] == 'demo' else \
-                        user['main_api_key'].iloc[0]
-
-                    tp_secret_key = user['demo_secret_key'].iloc[0] if user['trade_type'].iloc[0] == 'demo' else \
-                        user['main_secret_key'].iloc[0]
-                    # print('Меняем спот ТП на условиях',
-                    #       amend_order_url, tp_api_key, tp_secret_key,
-                    #       symbol, new_triggerPrice, prev_orderLinkId
-                    #       )
-                    res = await amend_spot_conditional_market_order(
-                        amend_order_url, tp_api_key, tp_secret_key,
-                        symbol, new_triggerPrice, prev_orderLinkId)
-
-                    if isinstance(res, dict) and res.get('retMsg') == 'OK':
-                        pos = {
-                            "bybit_id": prev_orderLinkId,
-                            'triggerPrice': str(new_triggerPrice),
-                        }
-                        await positions_op.upsert_position(pos)
+                    current_price = spot_prices.get(row.symbol)
+                    if current_price is None:
+                        continue
+                    prev_price = float(row.triggerPrice)
+                    if current_price > prev_price and row.side:
+                        # print('Поднимаем тейк профит спот на селл вверх')
+                        symbol = row.symbol
+                        spot_settings = spot_data.get(symbol[:-4])
+                        # без настроек пары пропускаем только этот ордер, а не весь проход
+                        if spot_settings is None or spot_settings.price_tick is None:
+                            continue
+                        price_tick = spot_settings.price_tick
+                        new_triggerPrice = current_price * (1 - (float(user['tp_step'].iloc[0])) / 100)
+                        new_triggerPrice = round_price(new_triggerPrice, price_tick)
+                        if prev_price >= new_triggerPrice:
+                            continue
+                        amends.propose(row.bybit_id, row.owner_id, new_triggerPrice, prev_price,
+                                       price_tick.size, (row, user))
+
+            ready = amends.due()
+            if ready:
+                # изменения отправляем параллельно, по одному юзеру - по очереди
+                results = await gather_keyed(
+                    ready, lambda item: item[2][0].owner_id,
+                    lambda item: amend_spot_tp(item[2][0], item[2][1], item[1]),
+                    st.TP['concurrency'])
+                writes = []
+                for (order_id, trigger, _), result in zip(ready, results):
+                    if isinstance(result, Exception):
+                        print(f"Ошибка изменения ТП {order_id}: {result}")
+                    elif result:
+                        amends.confirm(order_id, trigger)
+                        writes += result
+                if writes:
+                    await save_positions(positions_op, writes, 'трейлинг ТП')
+                    dirty = True
 
 
         except Exception as e:
             # traceback.print_exc()
             log_error(logger, "tp_execution", e)
             if "too many clients already" in str(e):
-                log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                 sys.exit()
             await asyncio.sleep(1)
 
@@ -1121,13 +1001,25 @@ async def tp_execution(database_url, price_queue):
             # ####### STOP CHECK TRAIL TP CONDITION ########
 
 
-        await asyncio.sleep(1)
+        await asyncio.sleep(st.TP['tick_interval'])
 
-def run_tp_execution_process(price_queue):
-    asyncio.run(tp_execution(DATABASE_URL,price_queue))
+def run_tp_execution_process(price_book):
+    asyncio.run(run_with_client(beating(tp_execution(DATABASE_URL, price_book))))
 
 
 async def daily_task():
+    # один раз на процесс: все обертки делят пул соединений
+    positions_op = PositionsOperations(DATABASE_URL)
+    user_op = UsersOperations(DATABASE_URL)
+    pnl_op = PNLManager(DATABASE_URL)
+    users_op = UsersOperations(DATABASE_URL)
+    new_pairs_op = NewPairsOperations(DATABASE_URL)
+    alerts_ops = AlertsOperations(DATABASE_URL)
+    lins_op = LinearPairsOperations(DATABASE_URL)
+    spot_pairs_op = SpotPairsOperations(DATABASE_URL)
+    linear_pairs_op = LinearPairsOperations(DATABASE_URL)
+    # хэши настроек пар живут между ежедневными обновлениями
+    pairs_refresher = PairsRefresher(spot_pairs_op, linear_pairs_op)
 
     while True:
 
@@ -1157,8 +1049,6 @@ async def daily_task():
 
                     # print('Выполняется каждую 1 минут или меньше')
 
-                    positions_op = PositionsOperations(DATABASE_URL)
-                    user_op = UsersOperations(DATABASE_URL)
 ###############################
 
                     # отменяем ордера, которые не исполнились в течение 300 минут
@@ -1168,79 +1058,76 @@ async def daily_task():
                                                                                      "type": "main"})
                         if not open_positions.empty:
                             current_time = datetime.now()
-                            for index, position in open_positions.iterrows():
-                                try:
-                                    if position['market'] == 'demo':
-                                        res = await get_order_by_id(position['owner_id'], position['order_type'],
-                                                                    position['bybit_id'], demo=True)
-                                    else:
-                                        res = await get_order_by_id(position['owner_id'], position['order_type'],
-                                                                    position['bybit_id'], demo=None)
-
-                                    # print('res', res)
-                                    if res != -1 and res[0] == 'Deactivated':
-                                        # print('Change', position['bybit_id'], position['symbol'], 'it filled')
-                                        order_data = {
-                                            "bybit_id": position['bybit_id'],
-                                            "orderStatus": True,
-                                            # try
-                                            "finished": True
-                                        }
-                                        await positions_op.upsert_position(order_data)
-
-                                    if res != -1 and res[0] == "Filled":
-                                        print('Change', position['bybit_id'], position['symbol'], 'it filled')
-                                        order_data = {
-                                            "bybit_id": position['bybit_id'],
-                                            "orderStatus": True,
-                                            "avgPrice": res[1].get('avgPrice'),
-                                            "cumExecValue": res[1].get('cumExecValue'),
-                                            "cumExecQty": res[1].get('cumExecQty'),
-                                            "cumExecFee": res[1].get('cumExecFee'),
-                                            # try
-                                            "finished": False
-                                        }
-                                        await positions_op.upsert_position(order_data)
-                                    else:
-                                        created_time = datetime.fromisoformat(position['created'])
-                                        time_difference = current_time - created_time
-                                        difference_in_minutes = time_difference.total_seconds() / 60
-                                        if difference_in_minutes >= 300:
-
-                                            print('S momenta sozdaniya ordera', difference_in_minutes, position['bybit_id'],
-                                                  position['symbol'], "отменяем ордер")
-                                            print('order_id', res[1].get('orderId'))
-                                            if position['market'] == 'demo':
-                                                await cancel_order_by_id(position['owner_id'], position['order_type'],
-                                                                         position['symbol'],
-                                                                         res[1].get('orderId'), demo=True)
-                                            else:
-                                                await cancel_order_by_id(position['owner_id'], position['order_type'],
-                                                                         position['symbol'],
-                                                                         res[1].get('orderId'), demo=None)
-                                            order_data = {
-                                                "bybit_id": position['bybit_id'],
-                                                "finished": True,
-                                                "orderStatus": True,
-                                                "tp_opened": True,
-                                            }
-                                            await positions_op.upsert_position(order_data)
-                                except Exception as e:
-                                    print(f"Ошибка в процессе обработки старых и потерянных в API ордеров, на отдельной позиции: {e}")
-                                    # traceback.print_exc()
-                                    log_error(logger, "Ошибка в процессе обработки старых и потерянных в API ордеров, на отдельной позиции", e)
-                                    if "too many clients already" in str(e):
-                                        log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
-                                        sys.exit()
-                                    await asyncio.sleep(1)
-
-                                    ####
+                            positions = [position for index, position in open_positions.iterrows()]
+
+                            # статусы всех ордеров запрашиваем параллельно
+                            results = await gather_limited(
+                                [get_order_by_id(position['owner_id'], position['order_type'], position['bybit_id'],
+                                                 demo=True if position['market'] == 'demo' else None)
+                                 for position in positions],
+                                return_exceptions=True,
+                            )
+
+                            deactivated = []
+                            filled = {}
+                            to_cancel = []
+                            for position, res in zip(positions, results):
+                                if isinstance(res, Exception):
+                                    print(f"Ошибка в процессе обработки старых и потерянных в API ордеров, на отдельной позиции: {res}")
+                                    log_error(logger, "Ошибка в процессе обработки старых и потерянных в API ордеров, на отдельной позиции", res)
+                                    continue
+                                if res == -1:
+                                    continue
+
+                                # print('res', res)
+                                if res[0] == 'Deactivated':
+                                    deactivated.append(position['bybit_id'])
+
+                                if res[0] == "Filled":
+                                    print('Change', position['bybit_id'], position['symbol'], 'it filled')
+                                    filled[position['bybit_id']] = {
+                                        "avgPrice": res[1].get('avgPrice'),
+                                        "cumExecValue": res[1].get('cumExecValue'),
+                                        "cumExecQty": res[1].get('cumExecQty'),
+                                        "cumExecFee": res[1].get('cumExecFee'),
+                                        # try
+                                        "finished": False
+                                    }
+                                else:
+                                    created_time = datetime.fromisoformat(position['created'])
+                                    time_difference = current_time - created_time
+                                    difference_in_minutes = time_difference.total_seconds() / 60
+                                    if difference_in_minutes >= 300:
+                                        print('S momenta sozdaniya ordera', difference_in_minutes, position['bybit_id'],
+                                              position['symbol'], "отменяем ордер")
+                                        print('order_id', res[1].get('orderId'))
+                                        to_cancel.append((position, res[1].get('orderId')))
+
+                            # отменяем ордера, которые не исполнились в течение 300 минут, тоже параллельно
+                            cancel_results = await gather_limited(
+                                [cancel_order_by_id(position['owner_id'], position['order_type'], position['symbol'],
+                                                    order_id, demo=True if position['market'] == 'demo' else None)
+                                 for position, order_id in to_cancel],
+                                return_exceptions=True,
+                            )
+                            cancelled = []
+                            for (position, order_id), res in zip(to_cancel, cancel_results):
+                                if isinstance(res, Exception):
+                                    print('Ошибка отмены ордера', position['bybit_id'], res)
+                                    log_error(logger, "Ошибка отмены старого ордера", res)
+                                else:
+                                    cancelled.append(position['bybit_id'])
+
+                            # все изменения пишем пакетно
+                            await positions_op.bulk_mark(deactivated, orderStatus=True, finished=True)
+                            await positions_op.mark_filled_many(filled)
+                            await positions_op.bulk_mark(cancelled, finished=True, orderStatus=True, tp_opened=True)
                     except Exception as e:
                         print(f"Ошибка в процессе обработки старых и потерянных в API ордеров: {e}")
                         # traceback.print_exc()
                         log_error(logger, "Ошибка в процессе обработки старых и потерянных в API ордеров", e)
                         if "too many clients already" in str(e):
-                            log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                            log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                             sys.exit()
                         await asyncio.sleep(1)
 
@@ -1370,7 +1257,7 @@ async def daily_task():
                         # traceback.print_exc()
                         log_error(logger, "Ошибка в процессе выявления пропущенных фьючерсных позиций", e)
                         if "too many clients already" in str(e):
-                            log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                            log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                             sys.exit()
                         await asyncio.sleep(1)
                     #                       ########
@@ -1420,7 +1307,7 @@ async def daily_task():
                         # traceback.print_exc()
                         log_error(logger, "Ошибка в процессе обработки полностью исполненных спотовых позиций", e)
                         if "too many clients already" in str(e):
-                            log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                            log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                             sys.exit()
                         await asyncio.sleep(1)
 
@@ -1429,7 +1316,7 @@ async def daily_task():
                     # traceback.print_exc()
                     log_error(logger, "Ошибка в процессе daily_task - short tasks", e)
                     if "too many clients already" in str(e):
-                        log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                        log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                         sys.exit()
                     await asyncio.sleep(1)
 
@@ -1454,11 +1341,6 @@ async def daily_task():
             # Выполняем основную задачу в полночь
             print('Выполняется основная задача по обновлению PNL, получению новых монет, обновление сеттингов, проверка апи ключей в 00:00:00')
 
-            pnl_op = PNLManager(DATABASE_URL)
-            users_op = UsersOperations(DATABASE_URL)
-            new_pairs_op = NewPairsOperations(DATABASE_URL)
-            alerts_ops = AlertsOperations(DATABASE_URL)
-            lins_op = LinearPairsOperations(DATABASE_URL)
 
             users = await users_op.get_all_users_data()
 
@@ -1482,7 +1364,7 @@ async def daily_task():
                     # traceback.print_exc()
                     log_error(logger, "tp_execution", e)
                     if "too many clients already" in str(e):
-                        log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                        log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                         sys.exit()
                     await asyncio.sleep(1)
 
@@ -1497,13 +1379,15 @@ async def daily_task():
                 difference = list(set(new) - set(old))
                 users = (await users_op.get_all_users_data())
 
+                # все запросы сразу, темп задает лимитер клиента по ключу каждого юзера
+                tasks = []
                 for index, user in users.iterrows():
                     # print(user['telegram_id'], user['main_api_key'], user['main_secret_key'], user['max_leverage'])
                     # print(user['telegram_id'], user['demo_api_key'], user['demo_secret_key'], user['max_leverage'])
                     for element in difference:
-                        await set_lev_linears(user['telegram_id'], element, user['max_leverage'], demo=False)
-                        await set_lev_linears(user['telegram_id'], element, user['max_leverage'], demo=True)
-                    await asyncio.sleep(1)
+                        tasks.append(set_lev_linears_by_settings(user, element, user['max_leverage'], demo=False))
+                        tasks.append(set_lev_linears_by_settings(user, element, user['max_leverage'], demo=True))
+                await asyncio.gather(*tasks)
 
                 print("Закончили ежедневную задачу по получению новых монет и обновлению плечей")
 
@@ -1511,7 +1395,7 @@ async def daily_task():
                 # traceback.print_exc()
                 log_error(logger, "tp_execution", e)
                 if "too many clients already" in str(e):
-                    log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                    log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                     sys.exit()
                 await asyncio.sleep(1)
 
@@ -1519,20 +1403,25 @@ async def daily_task():
             # checking_api_keys
             try:
                 if not users.empty:
-                    for index, row in users.iterrows():
-                        if row['trade_type'] == 'demo':
-                            res = await get_wallet_balance(row['telegram_id'], demo=True, coin=None)
-                            if res == -1:
-                                await alerts_ops.upsert_alerts({
-                                    'type': 'api_demo',
-                                    'telegram_id': row['telegram_id']})
-                        else:
-                            res = await get_wallet_balance(row['telegram_id'], demo=None, coin=None)
-                            if res == -1:
-                                await alerts_ops.upsert_alerts({
-                                    'type': 'api_real',
-                                    'telegram_id': row['telegram_id']})
-                        await asyncio.sleep(5)
+                    # ключи разных юзеров проверяем параллельно, ограничиваем только нагрузку на БД
+                    check_limit = asyncio.Semaphore(10)
+
+                    async def check_api_keys(row):
+                        async with check_limit:
+                            if row['trade_type'] == 'demo':
+                                res = await get_wallet_balance(row['telegram_id'], demo=True, coin=None)
+                                if res == -1:
+                                    await alerts_ops.upsert_alerts({
+                                        'type': 'api_demo',
+                                        'telegram_id': row['telegram_id']})
+                            else:
+                                res = await get_wallet_balance(row['telegram_id'], demo=None, coin=None)
+                                if res == -1:
+                                    await alerts_ops.upsert_alerts({
+                                        'type': 'api_real',
+                                        'telegram_id': row['telegram_id']})
+
+                    await asyncio.gather(*[check_api_keys(row) for index, row in users.iterrows()])
             except Exception as e:
                 print("Произошла ошибка при ежедневной проверке ключей:", e)
                 if "too many clients already" in str(e):
@@ -1541,16 +1430,8 @@ async def daily_task():
 
             try:
 
-                spot_pairs_op = SpotPairsOperations(DATABASE_URL)
-                linear_pairs_op = LinearPairsOperations(DATABASE_URL)
-
-                tasks_res = await process_spot_linear_settings()
 
-                tasks = [
-                    asyncio.create_task(spot_pairs_op.insert_spot_pairs(tasks_res[0])),
-                    asyncio.create_task(linear_pairs_op.insert_linear_pairs(tasks_res[1])),
-                ]
-                await asyncio.gather(*tasks)
+                print_pairs_reports(await pairs_refresher.refresh_all())
 
             except Exception as e:
                 print("Произошла ошибка при ежедневном обновлении сеттингов", e)
@@ -1562,112 +1443,69 @@ async def daily_task():
             # traceback.print_exc()
             log_error(logger, "tp_execution", e)
             if "too many clients already" in str(e):
-                log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                 sys.exit()
             await asyncio.sleep(1)
 
 
-def run_on_start_process():
-    spot_pairs_op = SpotPairsOperations(DATABASE_URL)
-    linear_pairs_op = LinearPairsOperations(DATABASE_URL)
-    users_op = UsersOperations(DATABASE_URL)
-    tg_channels_op = TgChannelsOperations(DATABASE_URL)
-    signals_op = SignalsOperations(DATABASE_URL)
-    db_positions = PositionsOperations(DATABASE_URL)
+def run_bot_process():
+    asyncio.run(run_with_client(beating(start_bot())))
 
-    asyncio.run(on_start(spot_pairs_op, linear_pairs_op, users_op, tg_channels_op, signals_op, db_positions))
-
-def run_trade_performance_process(price_queue):
+def run_trade_performance_process(price_book):
     while True:
         try:
-            asyncio.run(trade_performance(DATABASE_URL, price_queue))
+            asyncio.run(run_with_client(beating(trade_performance(DATABASE_URL, price_book))))
         except Exception as e:
             # traceback.print_exc()
             log_error(logger, "tp_execution", e)
             if "too many clients already" in str(e):
-                log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
+                log_error(logger, "Критичная ошибка в БД, перезапуск процесса", e)
                 sys.exit()
             time.sleep(1)
 
-async def update_prices(price_queue):
+async def update_prices(price_book):
+    # единственный писатель в общую книгу цен, остальные процессы только читают
     while True:
         try:
-            spot_prices, linear_prices = await get_prices()
-            if not price_queue.full():
-                if not price_queue.empty():
-                    price_queue.get_nowait()
-                price_queue.put_nowait((spot_prices, linear_prices))
-            await asyncio.sleep(0.5)
+            await TickerStream(price_book).run()
         except Exception as e:
             # traceback.print_exc()
-            log_error(logger, "tp_execution", e)
-            if "too many clients already" in str(e):
-                log_error(logger, "Критичная ошибка в БД, перезапуск программы", e)
-                sys.exit()
+            log_error(logger, "update_prices", e)
             await asyncio.sleep(1)
 
-def run_update_prices_process(price_queue):
-    asyncio.run(update_prices(price_queue))
+def run_update_prices_process(price_book):
+    asyncio.run(run_with_client(beating(update_prices(price_book))))
 
 def run_daily_task_process():
-    asyncio.run(daily_task())
+    asyncio.run(run_with_client(beating(daily_task())))
 
 
 def main():
-    processes = [
-        Process(target=run_on_start_process),
-        Process(target=run_trade_performance_process, args=(price_queue,)),
-        Process(target=run_update_prices_process, args=(price_queue,)),
-        Process(target=run_daily_task_process),
-        Process(target=run_tp_execution_process, args=(price_queue,))
-    ]
-
-    # Запускаем все процессы
-    for process in processes:
-        process.start()
-
-    initial_process_count = len(processes)
+    # книга цен в общей памяти живет в главном процессе, воркеры подключаются к ней
+    # и после перезапуска любого из них цены не теряются
+    price_book = SharedPriceBook()
+    supervisor = Supervisor()
+    # цены начинают грузиться сразу, параллельно с подготовкой схемы
+    supervisor.add('update_prices', run_update_prices_process, (price_book,))
 
     try:
-        while True:
-            current_process_count = sum(1 for process in processes if process.is_alive())
-            # print(f"Текущее количество активных процессов: {current_process_count}")
-
-            # Если количество активных процессов уменьшилось
-            if current_process_count < initial_process_count:
-                print("Количество активных процессов изменилось. Завершение программы...")
-
-                # Завершаем все оставшиеся активные процессы
-                for process in processes:
-                    if process.is_alive():
-                        print(f"Завершаем процесс {process.name} с PID {process.pid}")
-                        process.terminate()
-                        process.join(timeout=5)  # Ждем 5 секунд завершения процесса
-
-                        # Если процесс не завершился, убиваем его принудительно
-                        if process.is_alive():
-                            print(f"Принудительное завершение процесса {process.name} с PID {process.pid}")
-                            process.kill()
-                            process.join()
-
-                break  # После завершения всех процессов выходим из цикла
+        # барьер готовности: остальные процессы стартуют только после схемы, настроек пар и первых цен
+        asyncio.run(run_with_client(startup(DATABASE_URL, price_book)))
+        supervisor.add('bot', run_bot_process)
+        supervisor.add('trade_performance', run_trade_performance_process, (price_book,))
+        supervisor.add('daily_task', run_daily_task_process)
+        supervisor.add('tp_execution', run_tp_execution_process, (price_book,))
 
-            # Проверяем процессы каждую секунду
-            time.sleep(5)
+        # упавший процесс перезапускается один, остальные работают дальше
+        supervisor.run()
 
     except Exception as e:
         print(f"Ошибка в процессе: {e}")
 
     finally:
         # В любом случае проверяем, что все процессы завершены
-        for process in processes:
-            if process.is_alive():
-                print(f"Принудительное завершение процесса {process.name} с PID {process.pid}")
-                process.terminate()
-                process.join(timeout=5)
-                if process.is_alive():
-                    process.kill()
-                    process.join()
+        supervisor.stop()
+        price_book.close()
 
 
 if __name__ == "__main__":
@@ -5,6 +5,12 @@ mainnet_url = 'https://api.bybit.com'
 testnet_url = 'https://api-testnet.bybit.com'
 demo_url = 'https://api-demo.bybit.com'
 
+# public market data streams (always mainnet, like the REST market getters)
+public_ws_urls = {
+    'spot': 'wss://stream.bybit.com/v5/public/spot',
+    'linear': 'wss://stream.bybit.com/v5/public/linear',
+}
+
 ENDPOINTS = {
     # market endpoints
     'get_instruments_info': '/v5/market/instruments-info',
@@ -27,10 +33,87 @@ ENDPOINTS = {
     'set_leverage': '/v5/position/set-leverage',
 }
 
+# exchange http client, one per process (api/client.py)
+HTTP_CLIENT = {
+    'timeout': 10,  # total seconds per request
+    'connect_timeout': 5,
+    'limit': 200,  # connections per process
+    'limit_per_host': 50,
+    'dns_ttl': 300,  # seconds to cache resolved hosts
+    'keepalive_timeout': 60,
+}
+
+# one pool per process, shared by every *Operations table wrapper
+DB_POOL = {
+    'pool_size': 10,
+    'max_overflow': 5,
+    'pool_timeout': 30,  # seconds to wait for a free connection
+    'pool_recycle': 1800,
+    'pool_pre_ping': True,
+}
+
+# signal dispatcher of trade_performance
+SIGNALS = {
+    'batch_size': 50,  # signals dequeued at once
+    'max_coins': 8,  # coins processed concurrently, one coin is always sequential
+    'per_user': 1,  # concurrent orders of one user across signals
+}
+
+# USDT balances for order sizing, see api.budget.BudgetService
+BUDGET = {
+    'refresh_interval': 15,  # seconds between batched refreshes of all users
+    'max_age': 60,  # older balances are fetched again before use
+    'concurrency': 10,  # wallet requests in flight
+}
+
+# REST order reconciliation, see api.reconcile
+RECONCILE = {
+    'concurrency': 10,  # order requests in flight, the per-key rate limiter still applies
+}
+
+# TP loop, see main.tp_execution and api.triggers.TpTriggerEngine
+TP = {
+    'tick_interval': 0.2,  # seconds between checks of new prices against first TP thresholds
+    'trail_interval': 1,  # seconds between spot trailing passes
+    'retry_delay': 1,  # a failed first TP is re-armed after this many seconds
+    'concurrency': 10,  # users whose TP orders are placed or amended at once
+}
+
+# cold start, see main.startup
+STARTUP = {
+    'price_timeout': 30,  # seconds to wait for the first prices before trading starts anyway
+}
+
+# worker processes, see supervisor.Supervisor
+SUPERVISOR = {
+    'check_interval': 1,  # seconds between checks of the workers
+    'backoff': 1,  # first restart delay, doubles on every restart
+    'max_backoff': 60,
+    'stable_after': 300,  # a worker up this long gets its backoff reset
+    'heartbeat_interval': 5,  # seconds between heartbeats of a worker event loop
+    'stale_after': 600,  # a worker without heartbeats this long is restarted
+    'report_interval': 300,  # seconds between health reports
+    'pool_report_interval': 300,  # seconds between DB pool metrics of every worker, see db.engine.pool_status
+}
+
+# spot trailing TP amends, see api.triggers.AmendScheduler
+AMEND = {
+    'min_ticks': 1,  # smallest trigger move worth an amend, in price ticks
+    'min_percent': 0.1,  # and in percent of the current trigger
+    'min_interval': 2,  # seconds between amends of one order
+    'per_key_rate': 5,  # amends per second of one user
+}
+
 if IF_TEST:
     base_url = testnet_url
 else:
     base_url = mainnet_url
 
+# private order/execution/wallet streams, 'main' follows base_url like the signed REST calls
+private_ws_urls = {
+    'main': 'wss://stream-testnet.bybit.com/v5/private' if IF_TEST else 'wss://stream.bybit.com/v5/private',
+    'demo': 'wss://stream-demo.bybit.com/v5/private',
+}
+
 if __name__ == '__main__':
     print(base_url)
@@ -0,0 +1,205 @@
+import asyncio
+import signal
+import sys
+import time
+from multiprocessing import Array, Process, current_process
+
+import code.settings as st
+from code.db.engine import pool_status
+
+# (общий массив пульсов, слот процесса) - задается в дочернем процессе воркера
+_heartbeat = None
+
+
+def _run_worker(index, beats, target, args):
+    global _heartbeat
+    # остановку воркера ведет супервизор, обработчик главного процесса не наследуем
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _heartbeat = (beats, index)
+    beats[index] = time.time()
+    target(*args)
+
+
+def report_pool():
+    """
+    Prints the connection pool metrics of the current process, see db.engine.pool_status.
+    """
+    name = current_process().name
+    for url, pool in pool_status().items():
+        print(f"Пул БД {name} ({url}): размер {pool['size']}, занято {pool['checked_out']}, "
+              f"overflow {pool['overflow']}, ожиданий {pool['waits']}, "
+              f"среднее {pool['wait_avg'] * 1000:.1f} мс, максимум {pool['wait_max'] * 1000:.1f} мс")
+
+
+async def beating(coro):
+    """
+    Runs coro while the event loop of the worker sends heartbeats to the
+    supervisor. A blocked loop stops beating and the worker shows as stalled.
+    Pool metrics of the worker are printed every pool_report_interval seconds.
+    """
+    async def beat():
+        last_pool_report = time.monotonic()
+        while True:
+            if _heartbeat is not None:
+                beats, index = _heartbeat
+                beats[index] = time.time()
+            if time.monotonic() - last_pool_report >= st.SUPERVISOR['pool_report_interval']:
+                last_pool_report = time.monotonic()
+                report_pool()
+            await asyncio.sleep(st.SUPERVISOR['heartbeat_interval'])
+
+    task = asyncio.create_task(beat())
+    try:
+        return await coro
+    finally:
+        task.cancel()
+
+
+class Worker:
+    """
+    One supervised process: its target, restart history and backoff.
+    """
+
+    def __init__(self, name, target, args=()):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.process = None
+        self.started = None  # time.monotonic() последнего старта
+        self.restarts = 0
+        self.exitcode = None  # код последнего завершения
+        self.restart_at = None  # время перезапуска, пока процесс ждет backoff
+        self.backoff = st.SUPERVISOR['backoff']
+
+
+class Supervisor:
+    """
+    Keeps every worker process running on its own.
+
+    A worker that exits or stops sending heartbeats for stale_after seconds is
+    restarted alone, after a backoff that doubles up to max_backoff and resets
+    once the worker has stayed up for stable_after seconds. The other workers
+    and the state owned by the main process, like the shared price book, are
+    not touched. Workers send heartbeats by running their coroutine under
+    beating(). health() tells the state of every worker, report() prints it.
+    """
+
+    def __init__(self, capacity=16):
+        self.settings = st.SUPERVISOR
+        self.workers = []
+        # время последнего пульса каждого воркера, пишут дочерние процессы
+        self._beats = Array('d', capacity, lock=False)
+        self._last_report = time.monotonic()
+
+    def add(self, name, target, args=()):
+        """
+        Starts a new worker right away.
+        """
+        if len(self.workers) >= len(self._beats):
+            raise ValueError(f'supervisor capacity {len(self._beats)} exceeded')
+        self.workers.append(Worker(name, target, args))
+        self._start(len(self.workers) - 1)
+
+    def _start(self, i):
+        worker = self.workers[i]
+        self._beats[i] = 0.0
+        worker.process = Process(target=_run_worker, args=(i, self._beats, worker.target, worker.args),
+                                 name=worker.name)
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+
+    def _heartbeat_age(self, i):
+        beat = self._beats[i]
+        return time.time() - beat if beat else None
+
+    def check(self):
+        """
+        Restarts workers whose backoff is over and schedules restarts of dead or stalled ones.
+        """
+        now = time.monotonic()
+        for i, worker in enumerate(self.workers):
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.restarts += 1
+                    print(f'Перезапуск процесса {worker.name}, попытка {worker.restarts}')
+                    self._start(i)
+                continue
+
+            process = worker.process
+            if process.is_alive():
+                age = self._heartbeat_age(i)
+                if age is None or age < self.settings['stale_after']:
+                    if now - worker.started >= self.settings['stable_after']:
+                        worker.backoff = self.settings['backoff']
+                    continue
+                print(f'Процесс {worker.name} не отвечает {age:.0f} c, останавливаем')
+                self._stop(process)
+
+            worker.exitcode = process.exitcode
+            print(f'Процесс {worker.name} завершился с кодом {worker.exitcode}, '
+                  f'перезапуск через {worker.backoff} c')
+            worker.restart_at = now + worker.backoff
+            worker.backoff = min(worker.backoff * 2, self.settings['max_backoff'])
+
+    def health(self) -> dict:
+        """
+        Returns {name: {status, pid, restarts, exitcode, uptime, heartbeat_age}}.
+        status is 'ok', 'stalled', 'no heartbeat' or 'restarting'.
+        """
+        now = time.monotonic()
+        health = {}
+        for i, worker in enumerate(self.workers):
+            age = self._heartbeat_age(i)
+            if worker.restart_at is not None or not worker.process.is_alive():
+                status = 'restarting'
+            elif age is None:
+                status = 'no heartbeat'
+            elif age > 3 * self.settings['heartbeat_interval']:
+                status = 'stalled'
+            else:
+                status = 'ok'
+            health[worker.name] = {
+                'status': status,
+                'pid': worker.process.pid,
+                'restarts': worker.restarts,
+                'exitcode': worker.exitcode,
+                'uptime': now - worker.started if status != 'restarting' else 0.0,
+                'heartbeat_age': age,
+            }
+        return health
+
+    def report(self):
+        for name, state in self.health().items():
+            age = state['heartbeat_age']
+            print(f"{name}: {state['status']}, pid {state['pid']}, перезапусков {state['restarts']}, "
+                  f"работает {state['uptime']:.0f} c, пульс {'-' if age is None else f'{age:.1f} c'}")
+
+    def run(self):
+        """
+        Supervises the workers until the main process is stopped.
+        """
+        # SIGTERM главному процессу - штатная остановка с завершением воркеров
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        while True:
+            self.check()
+            if time.monotonic() - self._last_report >= self.settings['report_interval']:
+                self._last_report = time.monotonic()
+                self.report()
+            time.sleep(self.settings['check_interval'])
+
+    @staticmethod
+    def _stop(process):
+        if process.is_alive():
+            print(f"Завершаем процесс {process.name} с PID {process.pid}")
+            process.terminate()
+            process.join(timeout=5)  # Ждем 5 секунд завершения процесса
+            # Если процесс не завершился, убиваем его принудительно
+            if process.is_alive():
+                print(f"Принудительное завершение процесса {process.name} с PID {process.pid}")
+                process.kill()
+        process.join()
+
+    def stop(self):
+        for worker in self.workers:
+            self._stop(worker.process)
@@ -36,6 +36,7 @@ db_users_op = UsersOperations(DATABASE_URL)
 db_spot_pairs = SpotPairsOperations(DATABASE_URL)
 db_linear_pairs = LinearPairsOperations(DATABASE_URL)
 alerts_ops = AlertsOperations(DATABASE_URL)
+db_signals = SignalsOperations(DATABASE_URL)
 
 
 ADMIN_ID = os.getenv('owner_id')
@@ -74,8 +75,6 @@ async def get_user_settings(user_id):
 @dp.channel_post()
 async def channel_message_handler(message: Message):
 
-    db_signals = SignalsOperations(DATABASE_URL)
-
     try:
         text = message.text
 
@@ -1430,7 +1429,7 @@ async def confirm_change(callback_query):
             )
 
             try:
-                await set_lev_for_all_linears(telegram_id, 1, demo=False, batch_size=8, delay=1)
+                await set_lev_for_all_linears(telegram_id, 1, demo=False)
                 fields = {'spot': False}
                 await db_users_op.update_user_fields(telegram_id, fields)
                 await bot.send_message(
@@ -1452,7 +1451,7 @@ async def confirm_change(callback_query):
                 return
 
             try:
-                await set_lev_for_all_linears(telegram_id, 1, demo=True, batch_size=8, delay=1)
+                await set_lev_for_all_linears(telegram_id, 1, demo=True)
                 await bot.send_message(
                     chat_id=telegram_id,
                     text='🟢 Настройки плечей успешно применены для основного и демо акканутов',
@@ -1691,7 +1690,7 @@ async def handle_leverage_message(message: types.Message):
     )
         # Пробуем для основного акканута
     try:
-        await set_lev_for_all_linears(telegram_id, result, demo=False, batch_size=8, delay=1)
+        await set_lev_for_all_linears(telegram_id, result, demo=False)
         await bot.send_message(
             chat_id=telegram_id,
             text='🟢 Настройки плечей для основного акканута успешно применены'
@@ -1712,7 +1711,7 @@ async def handle_leverage_message(message: types.Message):
         )
         return
     try:
-        await set_lev_for_all_linears(telegram_id, result, demo=True, batch_size=8, delay=1)
+        await set_lev_for_all_linears(telegram_id, result, demo=True)
         text = "🟢  Изменения применены для основного и демо-акканута!"
         params = await get_user_settings(int(telegram_id))
         await bot.send_message(